@@ -0,0 +1,295 @@
+import json
+import logging
+import threading
+from datetime import datetime
+from typing import Callable
+import functions as func
+import metrics
+from db import Database
+from metrics import logger
+from throttle import Throttle
+
+# Необязательный драйвер PostgreSQL (см. functions.py)
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+# Регистрация агента
+"""
+Добавляет агента в таблицу agents или обновляет его запись при перезапуске (состояние online)
+Аренды, оставшиеся от прежнего запуска агента с тем же идентификатором, снимаются
+Обрабатываются ошибки при записи в БД
+Возвращает True, если агент зарегистрирован
+"""
+def register_agent(conn, agent_id: str, host: str) -> bool:
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO agents (agent_id, host, status, started_at, last_heartbeat)
+                VALUES (%s, %s, 'online', LOCALTIMESTAMP, LOCALTIMESTAMP)
+                ON CONFLICT (agent_id) DO UPDATE
+                SET host = EXCLUDED.host, status = 'online', started_at = EXCLUDED.started_at, last_heartbeat = EXCLUDED.last_heartbeat
+            """, (agent_id, host))
+            cur.execute("UPDATE resource_monitoring SET lease_owner = NULL, lease_expires = NULL WHERE lease_owner = %s", (agent_id,))
+        conn.commit()
+        logger.info("Агент зарегистрирован", extra={"agent": agent_id, "host": host})
+        return True
+    except psycopg2.Error as e:
+        print(f"Ошибка при регистрации агента {agent_id}: {e}")
+        conn.rollback()
+        return False
+
+# Сигнал агента
+"""
+Обновляет время последнего сигнала агента и продлевает его аренды на lease_ttl секунд
+Время аренд и сигналов берется по часам сервера БД, поэтому расхождение часов хостов на них не влияет
+Возвращает кол-во продленных аренд или None при ошибке
+"""
+def agent_heartbeat(conn, agent_id: str, lease_ttl: int = None) -> int:
+    try:
+        with conn.cursor() as cur:
+            cur.execute("UPDATE agents SET last_heartbeat = LOCALTIMESTAMP, status = 'online' WHERE agent_id = %s", (agent_id,))
+            cur.execute("""
+                UPDATE resource_monitoring SET lease_expires = LOCALTIMESTAMP + %s * INTERVAL '1 second'
+                WHERE lease_owner = %s
+            """, (lease_ttl or func.AGENT_LEASE_TTL, agent_id))
+            extended = cur.rowcount
+        conn.commit()
+        return extended
+    except psycopg2.Error as e:
+        print(f"Ошибка при отправке сигнала агента {agent_id}: {e}")
+        conn.rollback()
+        return None
+
+# Аренда ресурсов агентом
+"""
+Выбирает до limit ресурсов хоста host, которым пора по расписанию и которые не арендованы (или аренда истекла),
+по убыванию приоритета и закрепляет их за агентом на lease_ttl секунд
+Строки выбираются с FOR UPDATE SKIP LOCKED, поэтому агенты одного хоста не получают одни и те же ресурсы
+Срок проверки и аренды считается по часам сервера БД (LOCALTIMESTAMP), поэтому расхождение часов агентов
+не влияет на выбор ресурсов; now подменяет текущее время (для проверки)
+Возвращает список путей и время ближайшей будущей проверки ресурсов хоста (None, если такой нет)
+"""
+def lease_resources(conn, agent_id: str, host: str, limit: int = None, lease_ttl: int = None, now: datetime = None) -> tuple:
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                WITH clock AS (SELECT COALESCE(%s::timestamp, LOCALTIMESTAMP) AS now),
+                picked AS (
+                    SELECT ctid AS row_id
+                    FROM resource_monitoring, clock
+                    WHERE host = %s AND (next_check IS NULL OR next_check <= clock.now)
+                      AND (lease_owner IS NULL OR lease_expires < clock.now)
+                    ORDER BY priority DESC, next_check NULLS FIRST
+                    LIMIT %s
+                    FOR UPDATE OF resource_monitoring SKIP LOCKED
+                )
+                UPDATE resource_monitoring r
+                SET lease_owner = %s, lease_expires = clock.now + %s * INTERVAL '1 second'
+                FROM picked, clock
+                WHERE r.ctid = picked.row_id
+                RETURNING r.resource_path
+            """, (now, host, limit or func.AGENT_LEASE_SIZE, agent_id, lease_ttl or func.AGENT_LEASE_TTL))
+            leased = [path for path, in cur.fetchall()]
+            cur.execute("""
+                SELECT MIN(next_check) FROM resource_monitoring
+                WHERE host = %s AND next_check > COALESCE(%s::timestamp, LOCALTIMESTAMP)
+            """, (host, now))
+            next_due = cur.fetchone()[0]
+        conn.commit()
+        metrics.inc("ic_agent_leased_total", len(leased))
+        return leased, next_due
+    except psycopg2.Error as e:
+        print(f"Ошибка при аренде ресурсов агентом {agent_id}: {e}")
+        conn.rollback()
+        return [], None
+
+# Снятие аренд агента
+"""
+Снимает аренды агента с ресурсов resource_paths (None - со всех его ресурсов)
+Возвращает кол-во снятых аренд
+"""
+def release_leases(conn, agent_id: str, resource_paths: list = None) -> int:
+    query = "UPDATE resource_monitoring SET lease_owner = NULL, lease_expires = NULL WHERE lease_owner = %s"
+    params = (agent_id,)
+    if resource_paths is not None:
+        query += " AND resource_path = ANY(%s)"
+        params = (agent_id, list(resource_paths))
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            released = cur.rowcount
+        conn.commit()
+        return released
+    except psycopg2.Error as e:
+        print(f"Ошибка при снятии аренд агента {agent_id}: {e}")
+        conn.rollback()
+        return 0
+
+# Остановка агента
+"""
+Снимает все аренды агента и помечает его остановленным (stopped), чтобы координатор не считал его упавшим
+"""
+def stop_agent(conn, agent_id: str) -> None:
+    release_leases(conn, agent_id)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("UPDATE agents SET status = 'stopped' WHERE agent_id = %s", (agent_id,))
+        conn.commit()
+    except psycopg2.Error as e:
+        print(f"Ошибка при остановке агента {agent_id}: {e}")
+        conn.rollback()
+
+# Снятие аренд недоступных агентов
+"""
+Агенты в состоянии online без сигнала дольше timeout секунд помечаются offline, их аренды снимаются сразу,
+не дожидаясь окончания срока, а также снимаются все истекшие аренды
+Освобожденные ресурсы берут в аренду другие агенты того же хоста
+Возвращает (список недоступных агентов, кол-во снятых аренд)
+"""
+def reap_agents(conn, timeout: int = None) -> tuple:
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE agents SET status = 'offline'
+                WHERE status = 'online' AND last_heartbeat < LOCALTIMESTAMP - %s * INTERVAL '1 second'
+                RETURNING agent_id
+            """, (timeout or func.AGENT_TIMEOUT,))
+            dead = [agent_id for agent_id, in cur.fetchall()]
+            cur.execute("""
+                UPDATE resource_monitoring SET lease_owner = NULL, lease_expires = NULL
+                WHERE lease_owner = ANY(%s::text[]) OR lease_expires < LOCALTIMESTAMP
+            """, (dead,))
+            released = cur.rowcount
+        conn.commit()
+        for agent_id in dead:
+            metrics.report(logging.WARNING, "Агент недоступен, аренды сняты", f"Агент {agent_id} недоступен, аренды сняты", agent=agent_id)
+        return dead, released
+    except psycopg2.Error as e:
+        print(f"Ошибка при снятии аренд недоступных агентов: {e}")
+        conn.rollback()
+        return [], 0
+
+# Состояние агентов
+"""
+Возвращает список (агент, хост, состояние, время запуска, последний сигнал, кол-во аренд,
+проверено ресурсов, нарушений) по хостам и агентам; проверки считаются по check_runs
+"""
+def get_agents(conn) -> list:
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT a.agent_id, a.host, a.status, a.started_at, a.last_heartbeat,
+                       (SELECT COUNT(*) FROM resource_monitoring r WHERE r.lease_owner = a.agent_id),
+                       COALESCE(SUM(c.total_count), 0), COALESCE(SUM(c.failed_count), 0)
+                FROM agents a
+                LEFT JOIN check_runs c ON c.agent_id = a.agent_id AND c.started_at >= a.started_at
+                GROUP BY a.agent_id
+                ORDER BY a.host, a.agent_id
+            """)
+            rows = cur.fetchall()
+        conn.commit()
+        return rows
+    except psycopg2.Error as e:
+        print(f"Ошибка при получении состояния агентов: {e}")
+        conn.rollback()
+        return []
+
+# Нарушения по хостам
+"""
+Возвращает список нарушений (время, хост, путь, агент, изменения) с since, начиная с последнего
+Хост и агент - те, что записаны в результате проверки (check_results; агент результатов, записанных до версии 5
+схемы, - из check_runs), для проверок не агентами агент - None
+"""
+def get_host_violations(conn, since: datetime) -> list:
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT cr.checked_at, cr.host, cr.resource_path, COALESCE(cr.agent_id, c.agent_id), cr.details
+                FROM check_results cr
+                JOIN check_runs c ON c.run_id = cr.run_id
+                WHERE cr.status = 'failed' AND cr.checked_at >= %s
+                ORDER BY cr.checked_at DESC
+            """, (since,))
+            rows = cur.fetchall()
+        conn.commit()
+        return [(checked_at, host, path, agent_id, json.loads(details) if details else None) for checked_at, host, path, agent_id, details in rows]
+    except psycopg2.Error as e:
+        print(f"Ошибка при получении нарушений по хостам: {e}")
+        conn.rollback()
+        return []
+
+# Агент распределенной проверки
+"""
+conn - пул Database. Регистрирует агента, циклически берет в аренду до lease_size ресурсов своего хоста,
+проверяет их (check_all_hashes от имени агента) и снимает аренды; фоновый поток продлевает аренды сигналами
+После каждой пачки вызывает on_results(results); если он вернул False, работа прекращается
+"""
+def run_agent(conn: Database, agent_id: str, host: str, stop_event: threading.Event, mode: str, on_results: Callable[[dict], bool], lease_size: int = None, lease_ttl: int = None, default_interval: int = None, workers: int = None, throttle: Throttle = None) -> None:
+    lease_ttl = lease_ttl or func.AGENT_LEASE_TTL
+    if not conn.run(register_agent, agent_id, host):
+        return
+    heartbeat_stop = threading.Event()
+
+    def heartbeat():
+        while not heartbeat_stop.wait(lease_ttl / 3):
+            try:
+                conn.run(agent_heartbeat, agent_id, lease_ttl)
+            except psycopg2.Error as e:
+                metrics.report(logging.WARNING, "Не удалось отправить сигнал агента", f"Не удалось отправить сигнал агента {agent_id}: {e}", agent=agent_id, error=str(e))
+
+    heartbeat_thread = threading.Thread(target=heartbeat, name="ic-agent-heartbeat", daemon=True)
+    heartbeat_thread.start()
+    try:
+        while not stop_event.is_set():
+            leased, next_due = conn.run(lease_resources, agent_id, host, lease_size, lease_ttl)
+            if not leased:
+                delay = func.SCHEDULER_MAX_SLEEP
+                if next_due is not None:
+                    delay = (next_due - datetime.now()).total_seconds()
+                stop_event.wait(min(max(delay, func.SCHEDULER_MIN_SLEEP), func.SCHEDULER_MAX_SLEEP))
+                continue
+            with metrics.timer("ic_background_cycle_seconds", kind="agent"):
+                results = conn.run(func.check_all_hashes, stop_event, workers, mode=mode, resource_paths=leased,
+                                   default_interval=default_interval, throttle=throttle, agent_id=agent_id, host=host, retry=False)
+            conn.run(release_leases, agent_id, leased)
+            if stop_event.is_set():
+                break
+            if not results:
+                # Ошибка БД при проверке: пауза, чтобы не брать те же ресурсы в аренду без остановки
+                stop_event.wait(func.SCHEDULER_MIN_SLEEP)
+            elif not on_results(results):
+                break
+    finally:
+        heartbeat_stop.set()
+        heartbeat_thread.join()
+        try:
+            conn.run(stop_agent, agent_id)
+        except psycopg2.Error as e:
+            print(f"Не удалось снять аренды агента {agent_id}: {e}")
+
+# Координатор распределенной проверки
+"""
+Раз в interval секунд снимает аренды недоступных агентов (reap_agents) и собирает состояние агентов
+и нарушения на всех хостах с прошлого цикла
+Вызывает on_cycle(сводка) со словарем: agents - состояние агентов (get_agents), reaped - недоступные агенты,
+released - кол-во снятых аренд, violations - новые нарушения (get_host_violations)
+Если on_cycle вернул False, работа прекращается
+"""
+def run_coordinator(conn, stop_event: threading.Event, on_cycle: Callable[[dict], bool], interval: float = None, agent_timeout: int = None) -> None:
+    since = datetime.now()
+    while not stop_event.is_set():
+        cycle_started = datetime.now()
+        with func.use_connection(conn) as cycle_conn, metrics.timer("ic_background_cycle_seconds", kind="coordinator"):
+            reaped, released = reap_agents(cycle_conn, agent_timeout)
+            summary = {
+                "agents": get_agents(cycle_conn),
+                "reaped": reaped,
+                "released": released,
+                "violations": get_host_violations(cycle_conn, since),
+            }
+        since = cycle_started
+        if stop_event.is_set() or not on_cycle(summary):
+            break
+        stop_event.wait(interval or func.COORDINATOR_INTERVAL)
@@ -0,0 +1,327 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+import functions as func
+
+# Наборы синтетических данных: кол-во и размер файлов при scale=1
+TINY_FILES = 5000 # Много маленьких файлов
+TINY_FILE_SIZE = 512
+HUGE_FILES = 3 # Несколько больших файлов
+HUGE_FILE_SIZE = 128 * 1024 * 1024
+DEEP_LEVELS = 40 # Глубокая вложенность
+DEEP_FILES_PER_LEVEL = 5
+DEEP_FILE_SIZE = 16 * 1024
+
+RENDER_ROWS = 20000 # Кол-во строк синтетической таблицы ресурсов
+REGRESSION_THRESHOLD = 0.10 # Допустимое замедление при сравнении с предыдущим прогоном
+
+_stdout = sys.stdout # Вывод JSON, не затрагиваемый подавлением сообщений функций
+
+# Запись файла детерминированного содержимого
+"""
+Содержимое генерируется из rng блоками, чтобы большие файлы не держать в памяти целиком
+"""
+def _write_file(path: str, size: int, rng: random.Random) -> None:
+    with open(path, "wb") as f:
+        while size > 0:
+            chunk = min(size, 4 * 1024 * 1024)
+            f.write(rng.randbytes(chunk))
+            size -= chunk
+
+# Генерация синтетических деревьев
+"""
+В папке base создаются три набора: tiny (много маленьких файлов в подпапках по 500),
+huge (несколько больших файлов) и deep (цепочка из DEEP_LEVELS вложенных папок)
+Кол-во маленьких файлов и размер больших умножаются на scale, содержимое зависит только от seed
+Возвращает словарь: имя набора -> путь
+"""
+def generate_trees(base: str, scale: float = 1.0, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    trees = {}
+
+    tiny = os.path.join(base, "tiny")
+    for index in range(max(1, int(TINY_FILES * scale))):
+        folder = os.path.join(tiny, f"d{index // 500:03d}")
+        os.makedirs(folder, exist_ok=True)
+        _write_file(os.path.join(folder, f"f{index:06d}.bin"), TINY_FILE_SIZE, rng)
+    trees["tiny"] = tiny
+
+    huge = os.path.join(base, "huge")
+    os.makedirs(huge, exist_ok=True)
+    for index in range(HUGE_FILES):
+        _write_file(os.path.join(huge, f"f{index}.bin"), max(1, int(HUGE_FILE_SIZE * scale)), rng)
+    trees["huge"] = huge
+
+    deep = os.path.join(base, "deep")
+    folder = deep
+    for level in range(DEEP_LEVELS):
+        folder = os.path.join(folder, f"l{level:02d}")
+        os.makedirs(folder, exist_ok=True)
+        for index in range(DEEP_FILES_PER_LEVEL):
+            _write_file(os.path.join(folder, f"f{index}.bin"), DEEP_FILE_SIZE, rng)
+    trees["deep"] = deep
+    return trees
+
+# Объем и кол-во файлов в дереве
+def tree_size(path: str) -> tuple:
+    total, count = 0, 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+            count += 1
+    return total, count
+
+# Замер времени
+"""
+Вызывает fn() repeat раз после одного прогревочного вызова (данные в кэше страниц, поэтому замеряется
+стоимость хэширования, а не диска)
+Возвращает словарь с лучшим и медианным временем и результатом последнего вызова
+"""
+def measure(fn, repeat: int) -> dict:
+    fn()
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    return {"best_seconds": min(timings), "median_seconds": statistics.median(timings), "runs": len(timings), "result": result}
+
+# Запись результата замера
+def _record(results: list, name: str, timing: dict, size: int = None, files: int = None, **extra) -> None:
+    entry = {"name": name, "best_seconds": round(timing["best_seconds"], 6),
+             "median_seconds": round(timing["median_seconds"], 6), "runs": timing["runs"]}
+    if size is not None:
+        entry["bytes"] = size
+        entry["mb_per_s"] = round(size / 2**20 / timing["best_seconds"], 2) if timing["best_seconds"] else None
+    if files is not None:
+        entry["files"] = files
+        entry["files_per_s"] = round(files / timing["best_seconds"], 1) if timing["best_seconds"] else None
+    entry.update(extra)
+    results.append(entry)
+    print(f"{name}: {entry['best_seconds']} сек" + (f", {entry['mb_per_s']} МБ/с" if entry.get("mb_per_s") else ""), file=sys.stderr)
+
+# Производительность calculate_hash
+"""
+Для каждого набора и алгоритма замеряется расчет хэша ресурса целиком в одном потоке
+"""
+def bench_calculate_hash(results: list, trees: dict, algorithms: list, repeat: int) -> None:
+    for tree_name, path in trees.items():
+        size, files = tree_size(path)
+        for algorithm in algorithms:
+            timing = measure(lambda: func.calculate_hash(path, algorithm), repeat)
+            _record(results, f"calculate_hash.{tree_name}.{algorithm}", timing, size, files)
+
+# Производительность пула хэширования
+"""
+Заменяет сквозной замер update_all_hashes/check_all_hashes, когда БД не задана:
+все наборы считаются через hash_resources, как при расчете эталонов, с разным кол-вом исполнителей
+"""
+def bench_pipeline(results: list, trees: dict, workers_list: list, repeat: int) -> None:
+    size, files = 0, 0
+    for path in trees.values():
+        tree_bytes, tree_files = tree_size(path)
+        size += tree_bytes
+        files += tree_files
+    tasks = [{"path": path, "algorithm": func.DEFAULT_HASH_ALGORITHM} for path in trees.values()]
+    for workers in workers_list:
+        timing = measure(lambda: len(list(func.hash_resources(tasks, workers=workers))), repeat)
+        _record(results, f"hash_resources.workers{workers}", timing, size, files, workers=workers)
+
+# Сквозной замер операций с БД
+"""
+Ресурсы-наборы добавляются в БД, замеряются update_all_hashes, check_all_hashes в полном и быстром режимах
+и list_all_resources, после замера ресурсы удаляются
+update_all_hashes обрабатывает все ресурсы БД, поэтому нужна отдельная база для замеров
+"""
+def bench_database(results: list, trees: dict, db, repeat: int) -> None:
+    size, files = 0, 0
+    for path in trees.values():
+        tree_bytes, tree_files = tree_size(path)
+        size += tree_bytes
+        files += tree_files
+    paths = list(trees.values())
+    db.run(func.init_db)
+    for path in paths:
+        db.run(func.add_resource_to_db, path)
+    try:
+        timing = measure(lambda: db.run(func.update_all_hashes, retry=False), repeat)
+        _record(results, "db.update_all_hashes", timing, size, files)
+        for mode in (func.CHECK_MODE_PARANOID, func.CHECK_MODE_FAST):
+            timing = measure(lambda: db.run(func.check_all_hashes, mode=mode, resource_paths=paths, record=False, retry=False), repeat)
+            _record(results, f"db.check_all_hashes.{mode}", timing, size, files)
+        timing = measure(lambda: len(db.run(func.list_all_resources)), repeat)
+        _record(results, "db.list_all_resources", timing, rows=timing["result"])
+    finally:
+        for path in paths:
+            db.run(func.remove_resource_from_db, path)
+
+# Замер отрисовки таблицы ресурсов
+"""
+Создает окно приложения без подключения к БД и отрисовывает синтетический список из rows ресурсов:
+первая загрузка страницы, повторная отрисовка без изменений и отрисовка после смены статусов
+Если дисплей недоступен, замер пропускается
+"""
+def bench_render(results: list, rows: int, repeat: int) -> None:
+    try:
+        import tkinter as tk
+        from tkinter import ttk
+        import main
+        root = tk.Tk()
+    except Exception as e:
+        print(f"Замер отрисовки пропущен: {e}", file=sys.stderr)
+        results.append({"name": "render_rows", "skipped": str(e)})
+        return
+    try:
+        root.withdraw()
+        app = main.IntegrityMonitoringApp.__new__(main.IntegrityMonitoringApp)
+        app.root = root
+        app.check_status = {}
+        app.row_cache = {}
+        app.row_keys = {}
+        app.loaded_count = main.PAGE_SIZE
+        app.tree = ttk.Treeview(root, columns=("status", "path", "host", "name", "type", "added_date", "hash_date"), show="headings")
+        now = datetime.now()
+        app.resources = [
+            (f"/bench/resource{index:06d}", f"resource{index:06d}", "file" if index % 3 else "folder",
+             now - timedelta(days=1), "0" * 64, now, None)
+            for index in range(rows)
+        ]
+
+        def first_render():
+            app.tree.delete(*app.tree.get_children())
+            app.row_cache.clear()
+            app.render_rows()
+            root.update_idletasks()
+
+        def unchanged_render():
+            app.render_rows()
+            root.update_idletasks()
+
+        def status_render():
+            status = "failed" if app.check_status.get((None, app.resources[0][0])) != "failed" else "passed"
+            app.check_status = {(res[6], res[0]): status for res in app.resources}
+            app.render_rows()
+            root.update_idletasks()
+
+        for name, fn in (("first", first_render), ("unchanged", unchanged_render), ("statuses", status_render)):
+            _record(results, f"render_rows.{name}", measure(fn, repeat), rows=min(rows, app.loaded_count))
+    finally:
+        root.destroy()
+
+# Сравнение с предыдущим прогоном
+"""
+Сравнивает best_seconds замеров с одинаковыми именами и печатает изменение в процентах
+Возвращает список имен замеров, замедлившихся больше чем на threshold
+"""
+def compare(current: dict, previous: dict, threshold: float) -> list:
+    previous_results = {entry["name"]: entry for entry in previous.get("results", []) if "best_seconds" in entry}
+    regressions = []
+    for entry in current["results"]:
+        before = previous_results.get(entry["name"])
+        if before is None or "best_seconds" not in entry or not before["best_seconds"]:
+            continue
+        change = entry["best_seconds"] / before["best_seconds"] - 1
+        marker = ""
+        if change > threshold:
+            marker = " РЕГРЕССИЯ"
+            regressions.append(entry["name"])
+        print(f"{entry['name']}: {before['best_seconds']} -> {entry['best_seconds']} сек ({change:+.1%}){marker}", file=sys.stderr)
+    return regressions
+
+# Сведения об окружении прогона
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "hash_workers": func.HASH_WORKERS,
+        "algorithms_available": list(func.HASH_ALGORITHMS),
+    }
+
+# Разбор аргументов командной строки
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="benchmark", description="Замеры производительности хэширования и работы с БД")
+    parser.add_argument("--scale", type=float, default=1.0, help="множитель объема синтетических данных")
+    parser.add_argument("--seed", type=int, default=0, help="начальное значение генератора содержимого")
+    parser.add_argument("--repeat", type=int, default=3, help="кол-во замеров каждой операции")
+    parser.add_argument("--data-dir", help="папка для синтетических данных (по умолчанию временная, удаляется после прогона)")
+    parser.add_argument("--algorithms", nargs="+", default=list(func.HASH_ALGORITHMS), choices=list(func.HASH_ALGORITHMS))
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, func.HASH_WORKERS], help="кол-во исполнителей для замера пула")
+    parser.add_argument("--render-rows", type=int, default=RENDER_ROWS, help="кол-во строк для замера отрисовки (0 - пропустить)")
+    parser.add_argument("--dbname", help="отдельная база для сквозного замера с БД (без нее БД не используется)")
+    parser.add_argument("--user", default=os.environ.get("IC_DB_USER", "postgres"))
+    parser.add_argument("--password", default=os.environ.get("IC_DB_PASSWORD"))
+    parser.add_argument("--host", default=os.environ.get("IC_DB_HOST", "localhost"))
+    parser.add_argument("--port", default=os.environ.get("IC_DB_PORT", "5432"))
+    parser.add_argument("--output", help="файл для результатов в JSON (по умолчанию stdout)")
+    parser.add_argument("--compare", help="JSON предыдущего прогона для сравнения")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="допустимое замедление при сравнении (0.1 = 10%%)")
+    return parser
+
+# Точка входа
+"""
+Возвращает 1, если при сравнении с --compare найдены регрессии, иначе 0
+"""
+def main(argv: list = None) -> int:
+    args = build_parser().parse_args(argv)
+    func.PRINT_RESOURCE_RESULTS = False
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="ic_bench_")
+    results = []
+    try:
+        print(f"Генерация данных в {data_dir}", file=sys.stderr)
+        trees = generate_trees(data_dir, args.scale, args.seed)
+        # Сообщения функций о каждом ресурсе не нужны в выводе замеров
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            bench_calculate_hash(results, trees, args.algorithms, args.repeat)
+            bench_pipeline(results, trees, sorted(set(args.workers)), args.repeat)
+            if args.dbname:
+                from db import Database
+                db = Database(args.dbname, args.user, args.password, args.host, args.port, maxconn=2)
+                try:
+                    bench_database(results, trees, db, args.repeat)
+                finally:
+                    db.close()
+            if args.render_rows > 0:
+                bench_render(results, args.render_rows, args.repeat)
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = {"environment": environment(),
+              "settings": {"scale": args.scale, "seed": args.seed, "repeat": args.repeat, "database": bool(args.dbname)},
+              "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        print(json.dumps(report, ensure_ascii=False, indent=2), file=_stdout)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print(f"Замедлились: {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    return 0
+
+# Запуск из командной строки
+if __name__ == "__main__":
+    sys.exit(main())
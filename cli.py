@@ -0,0 +1,739 @@
+import argparse
+import contextlib
+import json
+import os
+import signal
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+import agents
+import functions as func
+import hashcache
+import metrics
+import scheduler
+import throttle
+from db import Database
+from storage import PostgresStorage, SQLiteStorage
+
+# Коды завершения для cron и systemd
+EXIT_OK = 0 # Нарушений нет
+EXIT_VIOLATIONS = 1 # Обнаружены нарушения целостности
+EXIT_ERROR = 2 # Ошибка подключения или выполнения
+
+# Ошибки PostgreSQL (без psycopg2 - пусто) и ошибки любой из БД
+PG_ERRORS = (func.psycopg2.Error,) if func.psycopg2 is not None else ()
+DB_ERRORS = (*PG_ERRORS, sqlite3.Error)
+
+_stdout = sys.stdout # Вывод результатов, не затрагиваемый перенаправлением сообщений в stderr
+
+# Разбор аргументов командной строки
+"""
+Параметры подключения берутся из аргументов или переменных окружения IC_DB_NAME, IC_DB_USER, IC_DB_PASSWORD,
+IC_DB_HOST, IC_DB_PORT. Если пароль не задан, psycopg2 использует PGPASSWORD или ~/.pgpass
+С --sqlite (IC_SQLITE) данные хранятся во встроенной БД SQLite, параметры PostgreSQL нужны только команде sync
+Возвращает настроенный ArgumentParser
+"""
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="ic", description="Система контроля целостности без графического интерфейса")
+    parser.add_argument("--dbname", default=os.environ.get("IC_DB_NAME", "ic_db"))
+    parser.add_argument("--user", default=os.environ.get("IC_DB_USER", "postgres"))
+    parser.add_argument("--password", default=os.environ.get("IC_DB_PASSWORD"))
+    parser.add_argument("--host", default=os.environ.get("IC_DB_HOST", "localhost"))
+    parser.add_argument("--port", default=os.environ.get("IC_DB_PORT", "5432"))
+    parser.add_argument("--sqlite", default=os.environ.get("IC_SQLITE"), metavar="PATH", help="встроенная БД SQLite вместо сервера PostgreSQL")
+    parser.add_argument("--json", action="store_true", help="машиночитаемый вывод в JSON, сообщения - в stderr")
+    parser.add_argument("--quiet", action="store_true", help="не печатать результат по каждому ресурсу")
+    parser.add_argument("--log-level", default=os.environ.get("IC_LOG_LEVEL", "WARNING"),
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"], type=str.upper, help="уровень журнала в stderr")
+    parser.add_argument("--log-json", action="store_true", help="журнал в виде строк JSON")
+    parser.add_argument("--metrics-port", type=int, help="отдавать метрики Prometheus по HTTP на этом порту")
+    parser.add_argument("--metrics-file", help="записывать метрики Prometheus в файл (textfile collector)")
+    parser.add_argument("--hash-cache", default=os.environ.get("IC_HASH_CACHE"), help="файл SQLite кэша хэшей между запусками (быстрые проверки)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("init", help="создать или обновить схему БД")
+
+    add = commands.add_parser("add", help="добавить файлы и папки")
+    add.add_argument("paths", nargs="+")
+    add.add_argument("--ignore", action="append", default=[], metavar="GLOB", help="правило исключения для добавляемых папок (можно повторять)")
+    add.add_argument("--node", help="закрепить ресурсы за хостом: их проверяют агент и проверки, запущенные на этом хосте (только PostgreSQL)")
+
+    bulk = commands.add_parser("import", help="массовое добавление: поиск файлов в папке и/или список путей")
+    bulk.add_argument("paths", nargs="*", help="файлы и папки, добавляемые как есть")
+    bulk.add_argument("--root", action="append", default=[], help="папка, в которой ищутся файлы (можно повторять)")
+    bulk.add_argument("--include", action="append", default=[], metavar="GLOB", help="добавлять только подходящие файлы (можно повторять)")
+    bulk.add_argument("--exclude", action="append", default=[], metavar="GLOB", help="не добавлять подходящие файлы и папки (можно повторять)")
+    bulk.add_argument("--common-excludes", action="store_true", help="исключить типовые кэши, журналы и временные файлы")
+    bulk.add_argument("--no-recursive", action="store_true", help="искать файлы только на верхнем уровне --root")
+    bulk.add_argument("--from-file", help="файл со списком путей, по одному в строке ('-' - stdin)")
+    bulk.add_argument("--ignore", action="append", default=[], metavar="GLOB", help="правило исключения для добавляемых папок (можно повторять)")
+    bulk.add_argument("--batch-size", type=int, help="кол-во ресурсов в одном INSERT")
+    bulk.add_argument("--node", help="закрепить ресурсы за хостом: их проверяют агент и проверки, запущенные на этом хосте (только PostgreSQL)")
+
+    remove = commands.add_parser("remove", help="удалить ресурсы")
+    remove.add_argument("paths", nargs="+")
+    remove.add_argument("--node", help="удалить ресурсы, закрепленные за этим хостом (по умолчанию - ресурсы без хоста, только PostgreSQL)")
+
+    commands.add_parser("list", help="список ресурсов с последними статусами")
+
+    schedule = commands.add_parser("schedule", help="интервал и приоритет проверки ресурсов (без параметров - показать расписание)")
+    schedule.add_argument("paths", nargs="*")
+    schedule.add_argument("--interval", type=int, help="интервал проверки ресурса, сек (0 - общий интервал)")
+    schedule.add_argument("--priority", type=int, help="приоритет (больше - раньше)")
+    schedule.add_argument("--node", help="ресурсы, закрепленные за этим хостом (по умолчанию - ресурсы без хоста)")
+
+    baseline = commands.add_parser("baseline", help="рассчитать эталонные хэши")
+    baseline.add_argument("--algorithm", choices=list(func.HASH_ALGORITHMS), help="перевести эталоны на алгоритм")
+    baseline.add_argument("--progress", action="store_true", help="показывать прогресс в stderr")
+    _add_pool_arguments(baseline)
+    _add_throttle_arguments(baseline)
+
+    check = commands.add_parser("check", help="проверить целостность")
+    check.add_argument("--progress", action="store_true", help="показывать прогресс в stderr")
+    check.add_argument("--async", dest="use_async", action="store_true", help="асинхронный конвейер: чтение БД, диска и хэширование одновременно")
+    check.add_argument("--async-driver", choices=["threads", "psycopg"], default="threads",
+                       help="доступ к БД в асинхронном режиме: пул psycopg2 в потоках или psycopg 3")
+    _add_check_arguments(check)
+
+    commands.add_parser("sync", help="отправить эталоны и проверки из БД SQLite (--sqlite) на сервер PostgreSQL")
+
+    watch = commands.add_parser("watch", help="периодическая проверка (режим демона)")
+    watch.add_argument("--interval", type=int, default=300, help="интервал между проверками (с --events - между полными проверками), сек")
+    watch.add_argument("--events", action="store_true", help="проверять ресурсы по событиям inotify")
+    watch.add_argument("--debounce", type=float, default=2.0, help="затишье после событий перед проверкой, сек")
+    watch.add_argument("--scheduled", action="store_true", help="проверять ресурсы по расписанию (--interval - интервал по умолчанию)")
+    watch.add_argument("--max-runtime", type=float, help="предельное время цикла проверки по расписанию, сек")
+    watch.add_argument("--io-rate", type=float, help="средний объем чтения при проверке по расписанию, МБ/с")
+    watch.add_argument("--full-interval", type=int, default=func.FULL_CHECK_INTERVAL,
+                       help="с --mode sampled: период полной проверки (paranoid) между выборочными, сек")
+    _add_check_arguments(watch)
+
+    agent = commands.add_parser("agent", help="агент распределенной проверки: проверяет ресурсы своего хоста, взятые в аренду")
+    agent.add_argument("--node", default=func.LOCAL_HOST, help="хост агента (по умолчанию имя этого хоста)")
+    agent.add_argument("--agent-id", help="идентификатор агента (по умолчанию хост:pid)")
+    agent.add_argument("--lease-size", type=int, default=func.AGENT_LEASE_SIZE, help="кол-во ресурсов в одной аренде")
+    agent.add_argument("--lease-ttl", type=int, default=func.AGENT_LEASE_TTL, help="срок аренды, сек (продлевается, пока агент работает)")
+    agent.add_argument("--interval", type=int, default=func.SCHEDULE_DEFAULT_INTERVAL, help="интервал проверки ресурсов без собственного, сек")
+    _add_check_arguments(agent)
+
+    coordinator = commands.add_parser("coordinator", help="координатор: снятие аренд недоступных агентов и сводка нарушений по хостам")
+    coordinator.add_argument("--interval", type=float, default=func.COORDINATOR_INTERVAL, help="пауза между циклами, сек")
+    coordinator.add_argument("--agent-timeout", type=int, default=func.AGENT_TIMEOUT, help="агент без сигналов дольше этого времени недоступен, сек")
+    return parser
+
+# Аргументы пула хэширования
+def _add_pool_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--workers", type=int, default=None, help="кол-во параллельных исполнителей")
+    parser.add_argument("--processes", action="store_true", default=None, help="считать хэши в процессах, а не в потоках")
+
+# Аргументы проверки
+def _add_check_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--mode", choices=[func.CHECK_MODE_FAST, func.CHECK_MODE_PARANOID, func.CHECK_MODE_SAMPLED], default=func.CHECK_MODE_PARANOID,
+                        help="sampled - большие файлы по выборочному дайджесту (только PostgreSQL, без --async)")
+    _add_pool_arguments(parser)
+    _add_throttle_arguments(parser)
+
+# Аргументы щадящего режима
+def _add_throttle_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--low-impact", action="store_true", help="щадящий режим с настройками по умолчанию")
+    parser.add_argument("--max-mbps", type=float, help="предельная скорость чтения, МБ/с")
+    parser.add_argument("--max-files-per-sec", type=float, help="предельное кол-во файлов в секунду")
+    parser.add_argument("--max-load", type=float, help="пауза при средней загрузке на ядро выше этого значения")
+    parser.add_argument("--max-iowait", type=float, help="пауза при доле iowait выше этого значения (0-1)")
+    parser.add_argument("--idle", action="store_true", help="читать с приоритетом ввода-вывода idle и nice 19")
+
+# Ограничение нагрузки по аргументам
+"""
+Явно заданные параметры заменяют соответствующие настройки --low-impact
+Возвращает Throttle или None, если ограничения не заданы
+"""
+def build_throttle(args):
+    settings = throttle.low_impact().settings() if args.low_impact else {}
+    if args.max_mbps:
+        settings["bytes_per_sec"] = args.max_mbps * 2**20
+    if args.max_files_per_sec:
+        settings["files_per_sec"] = args.max_files_per_sec
+    if args.max_load:
+        settings["max_load"] = args.max_load
+    if args.max_iowait:
+        settings["max_iowait"] = args.max_iowait
+    if args.idle:
+        settings["idle_priority"] = True
+    return throttle.Throttle(**settings) if settings else None
+
+# Вывод результата команды
+"""
+В режиме JSON печатает объект одной строкой в stdout
+Иначе печатает текст text
+"""
+def emit(args, data, text: str = None) -> None:
+    if args.json:
+        print(json.dumps(data, ensure_ascii=False, default=str), file=_stdout, flush=True)
+    elif text is not None:
+        print(text, file=_stdout, flush=True)
+
+# Выгрузка метрик в файл
+"""
+Вызывается после каждой команды и каждого цикла watch, если задан --metrics-file
+"""
+def export_metrics(args) -> None:
+    if not args.metrics_file:
+        return
+    try:
+        metrics.registry.write_textfile(args.metrics_file)
+    except OSError as e:
+        print(f"Не удалось записать метрики в {args.metrics_file}: {e}", file=sys.stderr)
+
+# Сообщения функций
+"""
+В режиме JSON вывод функций из functions.py перенаправляется в stderr, чтобы stdout содержал только JSON
+"""
+def messages(args):
+    return contextlib.redirect_stdout(sys.stderr) if args.json else contextlib.nullcontext()
+
+# Вывод прогресса в stderr
+"""
+Возвращает callback для progress_callback или None, если прогресс не запрошен
+"""
+def progress_printer(args):
+    if not getattr(args, "progress", False):
+        return None
+
+    def on_progress(info: dict) -> None:
+        print(f"Прогресс: {func.format_progress(info)} {info['current'] or ''}", file=sys.stderr, flush=True)
+
+    return on_progress
+
+# Пул PostgreSQL для команд, не поддерживаемых встроенной БД
+"""
+Возвращает Database или None (с сообщением об ошибке), если выбрано хранилище SQLite
+"""
+def postgres_db(args, store):
+    if isinstance(store, PostgresStorage):
+        return store.db
+    print(f"Команда {args.command} с этими параметрами доступна только для PostgreSQL", file=sys.stderr)
+    return None
+
+# Команда init
+def cmd_init(args, store) -> int:
+    with messages(args):
+        ready = store.init()
+    emit(args, {"schema_ready": ready, "schema_version": store.schema_version},
+         f"Схема БД готова (версия {store.schema_version})" if ready else "Не удалось подготовить схему БД")
+    return EXIT_OK if ready else EXIT_ERROR
+
+# Команда add
+"""
+Пути добавляются одной массовой вставкой, уже добавленные и недоступные пропускаются
+"""
+def cmd_add(args, store) -> int:
+    if args.node and postgres_db(args, store) is None:
+        return EXIT_ERROR
+    with messages(args):
+        results = store.add_resources(args.paths, args.ignore, host=args.node)
+    skipped = results["existing"] + results["failed"]
+    emit(args, {"added": results["added"], "skipped": skipped}, f"Добавлено: {len(results['added'])}, пропущено: {len(skipped)}")
+    return EXIT_OK
+
+# Пути из файла списка
+"""
+Пустые строки и строки, начинающиеся с '#', пропускаются
+Возвращает генератор путей
+"""
+def read_path_list(list_path: str):
+    with (contextlib.nullcontext(sys.stdin) if list_path == "-" else open(list_path, encoding="utf-8")) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+
+# Команда import
+"""
+Пути собираются из аргументов, файла списка и поиска в папках --root и добавляются пачками
+"""
+def cmd_import(args, store) -> int:
+    if not (args.paths or args.root or args.from_file):
+        print("Укажите пути, --root или --from-file", file=sys.stderr)
+        return EXIT_ERROR
+    if args.node and postgres_db(args, store) is None:
+        return EXIT_ERROR
+    exclude = args.exclude + (func.COMMON_IGNORE_PATTERNS if args.common_excludes else [])
+
+    def paths():
+        yield from args.paths
+        if args.from_file:
+            yield from read_path_list(args.from_file)
+        for root in args.root:
+            yield from func.discover_resources(root, args.include, exclude, recursive=not args.no_recursive)
+
+    try:
+        with messages(args):
+            results = store.add_resources(paths(), args.ignore, args.batch_size, args.node)
+    except OSError as e:
+        print(f"Не удалось прочитать список путей: {e}", file=sys.stderr)
+        return EXIT_ERROR
+    emit(args, results, f"Добавлено: {len(results['added'])}, уже в БД: {len(results['existing'])}, ошибок: {len(results['failed'])}")
+    return EXIT_OK if not results["failed"] else EXIT_ERROR
+
+# Команда remove
+def cmd_remove(args, store) -> int:
+    if args.node and postgres_db(args, store) is None:
+        return EXIT_ERROR
+    removed, missing = [], []
+    with messages(args):
+        for path in args.paths:
+            path = os.path.abspath(path)
+            (removed if store.remove_resource(path, args.node) else missing).append(path)
+    emit(args, {"removed": removed, "missing": missing}, f"Удалено: {len(removed)}, не найдено: {len(missing)}")
+    return EXIT_OK
+
+# Команда list
+"""
+Ресурсы читаются из БД потоком, в текстовом режиме строки печатаются по мере получения
+"""
+def cmd_list(args, store) -> int:
+    with messages(args):
+        statuses = store.last_statuses()
+        rows = []
+        try:
+            for path, name, rtype, added, hash_value, hash_date, host in store.iter_resources():
+                row = {"path": path, "host": host, "name": name, "type": rtype, "added_date": added, "hash": hash_value,
+                       "hash_date": hash_date, "status": statuses.get((host, path))}
+                if args.json:
+                    rows.append(row)
+                else:
+                    print(f"{row['status'] or '-':<12} {row['type']:<7} {func.resource_label(host, path)}", file=_stdout)
+        except DB_ERRORS as e:
+            print(f"Ошибка при получении списка ресурсов: {e}", file=sys.stderr)
+            return EXIT_ERROR
+    emit(args, rows)
+    return EXIT_OK
+
+# Команда schedule
+def cmd_schedule(args, store) -> int:
+    db = postgres_db(args, store)
+    if db is None:
+        return EXIT_ERROR
+    if args.paths:
+        if args.interval is None and args.priority is None:
+            print("Укажите --interval и/или --priority", file=sys.stderr)
+            return EXIT_ERROR
+        updated, missing = [], []
+        with messages(args):
+            for path in args.paths:
+                path = os.path.abspath(path)
+                (updated if db.run(func.set_resource_schedule, path, args.interval, args.priority, args.node) else missing).append(path)
+        emit(args, {"updated": updated, "missing": missing}, f"Обновлено: {len(updated)}, не найдено: {len(missing)}")
+        return EXIT_OK
+    with messages(args):
+        schedule = db.run(func.get_schedule)
+    rows = [
+        {"path": path, "host": host, "check_interval": interval, "priority": priority, "last_checked": last_checked, "next_check": next_check}
+        for path, host, interval, priority, last_checked, next_check in schedule
+    ]
+    text = "\n".join(
+        f"{row['priority']:>4} {row['check_interval'] or '-':>8} {row['next_check'] or 'сейчас'!s:<26} {func.resource_label(row['host'], row['path'])}"
+        for row in rows
+    )
+    emit(args, rows, text)
+    return EXIT_OK
+
+# Команда baseline
+def cmd_baseline(args, store) -> int:
+    with messages(args):
+        updated = store.update_hashes(workers=args.workers, use_processes=args.processes, algorithm=args.algorithm,
+                                      progress_callback=progress_printer(args), throttle=build_throttle(args))
+    emit(args, {"updated": updated}, f"Обновлено эталонов: {updated}")
+    return EXIT_OK
+
+# Одна проверка целостности
+"""
+Запускает проверку в хранилище (check_all_hashes на соединении из пула или SQLiteStorage.check) и собирает итог проверки
+mode - режим этой проверки (по умолчанию --mode)
+"""
+def run_check(args, store, stop_flag: threading.Event = None, mode: str = None) -> dict:
+    started_at = datetime.now()
+    changes = {}
+    mode = mode or args.mode
+    with messages(args):
+        results = store.check(stop_flag, workers=args.workers, use_processes=args.processes, mode=mode, changes=changes,
+                              progress_callback=progress_printer(args), throttle=build_throttle(args))
+    return summarize(args, started_at, results, changes, mode)
+
+# Итог проверки
+"""
+Возвращает словарь с временем, длительностью, кол-вом ресурсов по статусам, результатами и изменениями
+по ресурсам (ключи - functions.resource_label)
+"""
+def summarize(args, started_at: datetime, results: dict, changes: dict = None, mode: str = None) -> dict:
+    counts = {}
+    for status in results.values():
+        counts[status] = counts.get(status, 0) + 1
+    return {
+        "started_at": started_at,
+        "duration_seconds": round((datetime.now() - started_at).total_seconds(), 3),
+        "mode": mode or args.mode,
+        "counts": counts,
+        "violations": sorted(func.resource_label(*key) for key, status in results.items() if status == "failed"),
+        "results": {func.resource_label(*key): status for key, status in results.items()},
+        "changes": {func.resource_label(*key): resource_changes for key, resource_changes in (changes or {}).items()},
+    }
+
+# Текстовый итог проверки
+def format_check(summary: dict) -> str:
+    counts = ", ".join(f"{status}: {count}" for status, count in sorted(summary["counts"].items())) or "ресурсов нет"
+    lines = [f"Проверка ({summary['mode']}) за {summary['duration_seconds']} сек: {counts}"]
+    lines += [f"НАРУШЕНИЕ: {path}" for path in summary["violations"]]
+    return "\n".join(lines)
+
+# Асинхронная проверка целостности
+"""
+Запускает pipeline.check_pipeline в новом цикле событий, SIGINT отменяет проверку
+Прогресс и процессы пула в асинхронном режиме не поддерживаются
+"""
+def run_async_check(args, db: Database) -> dict:
+    import asyncio
+    import pipeline
+    started_at = datetime.now()
+    changes = {}
+
+    async def check():
+        if args.async_driver == "psycopg":
+            conninfo = " ".join(f"{key}={value}" for key, value in (("dbname", args.dbname), ("user", args.user),
+                                ("password", args.password), ("host", args.host), ("port", args.port)) if value)
+            store = pipeline.PsycopgAsyncStore(conninfo)
+        else:
+            store = pipeline.ThreadedStore(db)
+        try:
+            return await pipeline.check_pipeline(store, mode=args.mode, workers=args.workers, changes=changes,
+                                                 throttle=build_throttle(args))
+        finally:
+            await store.close()
+
+    with messages(args):
+        results = asyncio.run(check())
+    return summarize(args, started_at, results, changes)
+
+# Выборочный режим
+"""
+Выборочные эталоны есть только в PostgreSQL, асинхронный конвейер их не использует
+Возвращает False (с сообщением об ошибке), если режим sampled выбран там, где он не поддерживается
+"""
+def sampled_supported(args, store) -> bool:
+    if args.mode != func.CHECK_MODE_SAMPLED:
+        return True
+    if getattr(args, "use_async", False):
+        print("Режим sampled не поддерживается асинхронным конвейером", file=sys.stderr)
+        return False
+    if not isinstance(store, PostgresStorage):
+        print("Режим sampled не поддерживается встроенной БД", file=sys.stderr)
+        return False
+    return True
+
+# Команда check
+def cmd_check(args, store) -> int:
+    if not sampled_supported(args, store):
+        return EXIT_ERROR
+    if args.use_async:
+        db = postgres_db(args, store)
+        if db is None:
+            return EXIT_ERROR
+        import pipeline
+        try:
+            summary = run_async_check(args, db)
+        except (RuntimeError, *pipeline.DRIVER_ERRORS) as e:
+            print(f"Ошибка асинхронной проверки: {e}", file=sys.stderr)
+            return EXIT_ERROR
+    else:
+        summary = run_check(args, store)
+    emit(args, summary, format_check(summary))
+    return EXIT_VIOLATIONS if summary["violations"] else EXIT_OK
+
+# Обработка сигналов завершения
+"""
+SIGTERM и SIGINT устанавливают stop_event (и wake_event, чтобы прервать ожидание)
+Если передан wake_event, SIGHUP устанавливает его
+"""
+def handle_stop_signals(stop_event: threading.Event, wake_event: threading.Event = None) -> None:
+    def on_stop(signum, frame):
+        print(f"Получен сигнал {signal.Signals(signum).name}, завершение работы", file=sys.stderr)
+        stop_event.set()
+        if wake_event is not None:
+            wake_event.set()
+
+    signal.signal(signal.SIGTERM, on_stop)
+    signal.signal(signal.SIGINT, on_stop)
+    if wake_event is not None and hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: wake_event.set())
+
+# Команда watch (режим демона)
+"""
+Выполняет проверку каждые interval секунд до получения SIGTERM или SIGINT
+С --events проверяются только ресурсы с событиями inotify, а полная проверка выполняется каждые interval секунд
+С --scheduled проверяются ресурсы, которым пора по расписанию, interval - интервал ресурсов без собственного
+С --mode sampled (без --events и --scheduled) раз в --full-interval секунд проверка выполняется в режиме paranoid
+SIGTERM/SIGINT прерывают текущую проверку и завершают работу, SIGHUP запускает проверку немедленно (без --events)
+После каждой проверки печатает итог (в режиме JSON - одну строку JSON)
+Возвращает EXIT_VIOLATIONS, если в последней проверке были нарушения
+"""
+def cmd_watch(args, store) -> int:
+    if args.interval <= 0:
+        print("Интервал должен быть положительным числом", file=sys.stderr)
+        return EXIT_ERROR
+    if not sampled_supported(args, store):
+        return EXIT_ERROR
+    stop_event = threading.Event()
+    wake_event = threading.Event()
+    handle_stop_signals(stop_event, wake_event)
+
+    with messages(args):
+        if not store.init():
+            return EXIT_ERROR
+    if args.scheduled or args.events:
+        db = postgres_db(args, store)
+        if db is None:
+            return EXIT_ERROR
+        if args.scheduled:
+            return watch_scheduled(args, db, stop_event)
+        return watch_events(args, db, stop_event)
+    exit_code = EXIT_OK
+    cadence = scheduler.FullCheckCadence(args.mode, args.full_interval)
+    while not stop_event.is_set():
+        cycle_started = time.monotonic()
+        wake_event.clear()
+        mode = cadence.cycle_mode()
+        try:
+            summary = run_check(args, store, stop_event, mode)
+        except DB_ERRORS as e:
+            print(f"Ошибка БД при проверке: {e}", file=sys.stderr)
+            summary = None
+        if summary is not None and not stop_event.is_set():
+            emit(args, summary, format_check(summary))
+            exit_code = EXIT_VIOLATIONS if summary["violations"] else EXIT_OK
+        export_metrics(args)
+        wake_event.wait(max(0, args.interval - (time.monotonic() - cycle_started)))
+    return exit_code
+
+# Наблюдение по событиям файловой системы
+def watch_events(args, db: Database, stop_event: threading.Event) -> int:
+    exit_code = EXIT_OK
+    cycle_started = datetime.now()
+
+    def on_results(results: dict) -> bool:
+        nonlocal exit_code, cycle_started
+        summary = summarize(args, cycle_started, results)
+        if results:
+            emit(args, summary, format_check(summary))
+            exit_code = EXIT_VIOLATIONS if summary["violations"] else EXIT_OK
+        export_metrics(args)
+        cycle_started = datetime.now()
+        return True
+
+    while not stop_event.is_set():
+        try:
+            with messages(args):
+                scheduler.run_event_watch(db, args.interval, stop_event, args.mode, on_results, args.debounce, build_throttle(args),
+                                     args.full_interval)
+        except PG_ERRORS as e:
+            print(f"Ошибка БД при проверке: {e}", file=sys.stderr)
+            stop_event.wait(min(args.interval, 30))
+        except OSError as e:
+            print(f"Не удалось запустить наблюдение inotify: {e}", file=sys.stderr)
+            return EXIT_ERROR
+    return exit_code
+
+# Проверка по расписанию
+def watch_scheduled(args, db: Database, stop_event: threading.Event) -> int:
+    exit_code = EXIT_OK
+    cycle_started = datetime.now()
+
+    def on_results(results: dict) -> bool:
+        nonlocal exit_code, cycle_started
+        summary = summarize(args, cycle_started, results)
+        emit(args, summary, format_check(summary))
+        exit_code = EXIT_VIOLATIONS if summary["violations"] else EXIT_OK
+        export_metrics(args)
+        cycle_started = datetime.now()
+        return True
+
+    while not stop_event.is_set():
+        try:
+            with messages(args):
+                scheduler.run_scheduler(db, args.interval, stop_event, args.mode, on_results, args.max_runtime, args.io_rate,
+                                   build_throttle(args), args.full_interval)
+        except PG_ERRORS as e:
+            print(f"Ошибка БД при проверке: {e}", file=sys.stderr)
+            stop_event.wait(func.SCHEDULER_MAX_SLEEP)
+    return exit_code
+
+# Команда agent
+"""
+Регистрирует агента и проверяет ресурсы хоста --node, которым пора по расписанию, беря их в аренду пачками
+по --lease-size (agents.run_agent). После каждой пачки печатает итог
+SIGTERM/SIGINT прерывают текущую пачку, аренды снимаются, и агент завершает работу
+Возвращает EXIT_VIOLATIONS, если в последней пачке были нарушения
+"""
+def cmd_agent(args, store) -> int:
+    db = postgres_db(args, store)
+    if db is None:
+        return EXIT_ERROR
+    stop_event = threading.Event()
+    handle_stop_signals(stop_event)
+    agent_id = args.agent_id or f"{args.node}:{os.getpid()}"
+    exit_code = EXIT_OK
+    cycle_started = datetime.now()
+
+    def on_results(results: dict) -> bool:
+        nonlocal exit_code, cycle_started
+        summary = summarize(args, cycle_started, results)
+        summary["agent"] = agent_id
+        emit(args, summary, format_check(summary))
+        exit_code = EXIT_VIOLATIONS if summary["violations"] else EXIT_OK
+        export_metrics(args)
+        cycle_started = datetime.now()
+        return True
+
+    with messages(args):
+        if not store.init():
+            return EXIT_ERROR
+    while not stop_event.is_set():
+        try:
+            with messages(args):
+                agents.run_agent(db, agent_id, args.node, stop_event, args.mode, on_results, args.lease_size, args.lease_ttl,
+                               args.interval, args.workers, build_throttle(args))
+        except PG_ERRORS as e:
+            print(f"Ошибка БД в агенте: {e}", file=sys.stderr)
+        # Агент завершается без остановки только при ошибке БД (в том числе при регистрации)
+        stop_event.wait(func.SCHEDULER_MAX_SLEEP)
+    return exit_code
+
+# Команда coordinator
+"""
+Циклически снимает аренды недоступных агентов и печатает состояние агентов и новые нарушения по хостам
+(agents.run_coordinator). SIGTERM/SIGINT завершают работу
+Возвращает EXIT_VIOLATIONS, если в последнем цикле были нарушения
+"""
+def cmd_coordinator(args, store) -> int:
+    db = postgres_db(args, store)
+    if db is None:
+        return EXIT_ERROR
+    stop_event = threading.Event()
+    handle_stop_signals(stop_event)
+    exit_code = EXIT_OK
+
+    def on_cycle(summary: dict) -> bool:
+        nonlocal exit_code
+        data = {
+            "agents": [
+                {"agent": agent_id, "host": host, "status": status, "started_at": started_at, "last_heartbeat": last_heartbeat,
+                 "leased": leased, "checked": checked, "violations": violations}
+                for agent_id, host, status, started_at, last_heartbeat, leased, checked, violations in summary["agents"]
+            ],
+            "reaped": summary["reaped"],
+            "released": summary["released"],
+            "violations": [
+                {"checked_at": checked_at, "host": host, "path": path, "agent": agent_id, "changes": changes}
+                for checked_at, host, path, agent_id, changes in summary["violations"]
+            ],
+        }
+        lines = [f"Агенты: {sum(agent['status'] == 'online' for agent in data['agents'])} в сети из {len(data['agents'])}, "
+                 f"снято аренд: {data['released']}"]
+        lines += [f"НЕДОСТУПЕН: {agent_id}" for agent_id in data["reaped"]]
+        lines += [f"НАРУШЕНИЕ: {row['host'] or '-'} {row['path']}" for row in data["violations"]]
+        emit(args, data, "\n".join(lines))
+        exit_code = EXIT_VIOLATIONS if data["violations"] else EXIT_OK
+        export_metrics(args)
+        return True
+
+    with messages(args):
+        if not store.init():
+            return EXIT_ERROR
+    while not stop_event.is_set():
+        try:
+            with messages(args):
+                agents.run_coordinator(db, stop_event, on_cycle, args.interval, args.agent_timeout)
+        except PG_ERRORS as e:
+            print(f"Ошибка БД в координаторе: {e}", file=sys.stderr)
+            stop_event.wait(min(args.interval, func.SCHEDULER_MAX_SLEEP))
+    return exit_code
+
+# Команда sync
+"""
+Отправляет эталоны и не отправленные проверки из встроенной БД (--sqlite) на сервер PostgreSQL
+"""
+def cmd_sync(args, store) -> int:
+    if not isinstance(store, SQLiteStorage):
+        print("Команда sync отправляет данные из встроенной БД, укажите --sqlite", file=sys.stderr)
+        return EXIT_ERROR
+    try:
+        with messages(args):
+            db = Database(args.dbname, args.user, args.password, args.host, args.port, maxconn=1)
+    except (RuntimeError, *PG_ERRORS) as e:
+        print(f"Не удалось подключиться к базе данных: {e}", file=sys.stderr)
+        return EXIT_ERROR
+    try:
+        with messages(args):
+            if not db.run(func.init_db):
+                return EXIT_ERROR
+            synced = store.sync_to(db)
+    finally:
+        db.close()
+    emit(args, synced, f"Отправлено ресурсов: {synced['resources']}, проверок: {synced['runs']}")
+    return EXIT_OK
+
+COMMANDS = {
+    "init": cmd_init,
+    "add": cmd_add,
+    "import": cmd_import,
+    "remove": cmd_remove,
+    "list": cmd_list,
+    "schedule": cmd_schedule,
+    "baseline": cmd_baseline,
+    "check": cmd_check,
+    "watch": cmd_watch,
+    "agent": cmd_agent,
+    "coordinator": cmd_coordinator,
+    "sync": cmd_sync,
+}
+
+# Открытие хранилища
+"""
+Встроенная БД SQLite создается при первом открытии, для PostgreSQL создается пул соединений
+Возвращает SQLiteStorage или PostgresStorage
+"""
+def open_storage(args):
+    if args.sqlite:
+        store = SQLiteStorage(args.sqlite)
+        store.init()
+        return store
+    return PostgresStorage(Database(args.dbname, args.user, args.password, args.host, args.port, maxconn=2))
+
+# Точка входа
+def main(argv: list = None) -> int:
+    args = build_parser().parse_args(argv)
+    metrics.setup_logging(args.log_level, args.log_json)
+    func.PRINT_RESOURCE_RESULTS = not args.quiet
+    hashcache.HASH_CACHE_PATH = args.hash_cache
+    if args.metrics_port:
+        try:
+            metrics.start_http_server(args.metrics_port)
+        except OSError as e:
+            print(f"Не удалось открыть порт метрик {args.metrics_port}: {e}", file=sys.stderr)
+            return EXIT_ERROR
+    try:
+        with messages(args):
+            store = open_storage(args)
+    except (RuntimeError, *DB_ERRORS) as e:
+        print(f"Не удалось подключиться к базе данных: {e}", file=sys.stderr)
+        return EXIT_ERROR
+    try:
+        return COMMANDS[args.command](args, store)
+    finally:
+        store.close()
+        export_metrics(args)
+
+# Запуск из командной строки
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+import metrics
+
+# Необязательный драйвер PostgreSQL: без него доступна только встроенная БД (storage.SQLiteStorage)
+try:
+    import psycopg2
+    import psycopg2.extensions
+    import psycopg2.pool
+except ImportError:
+    psycopg2 = None
+
+# Курсор с замером запросов
+"""
+Время каждого execute/executemany учитывается в метрике ic_db_query_seconds с меткой операции
+(первое слово запроса: SELECT, INSERT, UPDATE...), ошибки - в ic_db_errors_total
+Передается в psycopg2.connect как cursor_factory, поэтому замеряются все запросы, включая execute_values
+"""
+class TimedCursor(psycopg2.extensions.cursor if psycopg2 is not None else object):
+    def execute(self, query, vars=None):
+        with _query_metrics(query):
+            return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        with _query_metrics(query):
+            return super().executemany(query, vars_list)
+
+# Учет времени и ошибок запроса
+@contextmanager
+def _query_metrics(query):
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    operation = str(query).split(None, 1)[0].upper() if str(query).strip() else "EMPTY"
+    started = time.perf_counter()
+    try:
+        yield
+    except psycopg2.Error as e:
+        metrics.inc("ic_db_errors_total", kind=type(e).__name__)
+        raise
+    finally:
+        metrics.observe("ic_db_query_seconds", time.perf_counter() - started, operation=operation)
+
+# Пул соединений с базой данных
+"""
+Каждый поток (главный поток Tk, потоки ручных операций, фоновая проверка) берет из пула своё соединение,
+поэтому запросы не ждут друг друга и не смешивают состояние транзакций
+Соединения, разорванные сервером (closed != 0), не возвращаются в пул, а закрываются,
+следующий запрос получает новое соединение
+После обнаружения разрыва остальные простаивающие соединения перед выдачей проверяются запросом SELECT 1,
+так как после перезапуска сервера они тоже разорваны
+Если сервер недоступен, подключение повторяется retries раз с паузой retry_delay секунд
+Если psycopg2 не установлен, выбрасывает RuntimeError
+"""
+class Database:
+    # Создание пула
+    def __init__(self, dbname: str, user: str, password: str, host: str = "localhost", port: str = "5432",
+                 minconn: int = 1, maxconn: int = 10, retries: int = 3, retry_delay: float = 1.0):
+        if psycopg2 is None:
+            raise RuntimeError("Модуль psycopg2 не установлен, доступна только встроенная БД (--sqlite)")
+        self.dbname = dbname
+        self.params = dict(dbname=dbname, user=user, password=password, host=host, port=port, cursor_factory=TimedCursor)
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._slots = threading.BoundedSemaphore(maxconn) # Ожидание свободного соединения вместо PoolError
+        self._lock = threading.Lock()
+        self._pool = None
+        self._generation = 0 # Увеличивается при каждом обнаруженном разрыве
+        self._conn_generation = {} # id соединения -> поколение, в котором оно последний раз было исправно
+        self._create_pool()
+
+    # Создание пула соединений с повтором при недоступности сервера
+    def _create_pool(self):
+        for attempt in range(1, self.retries + 1):
+            try:
+                self._pool = psycopg2.pool.ThreadedConnectionPool(self.minconn, self.maxconn, **self.params)
+                print(f"Успешно подключено к базе данных {self.dbname}")
+                return
+            except psycopg2.OperationalError as e:
+                print(f"Ошибка подключения к БД (попытка {attempt} из {self.retries}): {e}")
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.retry_delay * attempt)
+
+    # Получение рабочего соединения из пула
+    def _getconn(self):
+        for attempt in range(1, self.retries + 1):
+            try:
+                with self._lock:
+                    if self._pool is None or self._pool.closed:
+                        self._create_pool()
+                    conn = self._pool.getconn()
+                    generation = self._generation
+                    # Поколение соединения читается под той же блокировкой, под которой его меняют _discard и выдача
+                    conn_generation = self._conn_generation.get(id(conn), generation)
+                if not conn.closed and conn_generation < generation:
+                    try:
+                        with conn.cursor() as cur:
+                            cur.execute("SELECT 1")
+                        conn.rollback()
+                    except psycopg2.Error:
+                        pass
+                if conn.closed:
+                    self._discard(conn)
+                    continue
+                with self._lock:
+                    self._conn_generation[id(conn)] = generation
+                return conn
+            except psycopg2.OperationalError as e:
+                print(f"Ошибка подключения к БД (попытка {attempt} из {self.retries}): {e}")
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.retry_delay * attempt)
+        raise psycopg2.OperationalError("Не удалось получить соединение с БД")
+
+    # Закрытие разорванного соединения
+    def _discard(self, conn):
+        with self._lock:
+            self._generation += 1
+            self._conn_generation.pop(id(conn), None)
+        self._pool.putconn(conn, close=True)
+
+    # Соединение на время блока with
+    """
+    Блокируется, пока в пуле нет свободного соединения
+    После блока незафиксированная транзакция откатывается, разорванное соединение закрывается
+    """
+    @contextmanager
+    def connection(self):
+        self._slots.acquire()
+        conn = None
+        try:
+            conn = self._getconn()
+            yield conn
+        finally:
+            if conn is not None:
+                broken = bool(conn.closed)
+                if not broken:
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        broken = True
+                if broken:
+                    print("Соединение с БД разорвано, будет установлено новое")
+                    self._discard(conn)
+                else:
+                    self._pool.putconn(conn)
+            self._slots.release()
+
+    # Выполнение функции с отдельным соединением
+    """
+    Вызывает func(conn, *args, **kwargs) с соединением из пула
+    Если во время вызова соединение было разорвано (например, перезапуск сервера), вызов повторяется один раз
+    с новым соединением. Повтор включается только для идемпотентных функций (retry=True)
+    Возвращает результат func
+    """
+    def run(self, func: Callable, *args, retry: bool = True, **kwargs):
+        with self.connection() as conn:
+            result = func(conn, *args, **kwargs)
+            if not (retry and conn.closed):
+                return result
+        with self.connection() as conn:
+            return func(conn, *args, **kwargs)
+
+    # Закрытие всех соединений
+    def close(self):
+        with self._lock:
+            if self._pool is not None and not self._pool.closed:
+                self._pool.closeall()
@@ -1,28 +1,360 @@
+import fnmatch
 import hashlib
+import itertools
+import json
+import mmap
 import os
-import psycopg2
+import secrets
+import socket
+import stat
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Callable
+from typing import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+import logging
 import threading
+import time
+from db import Database, TimedCursor
+import metrics
+from metrics import logger
+from throttle import Throttle, set_idle_priority
+import hashcache
+from hashcache import HashCache
+
+# Необязательный драйвер PostgreSQL: без него модуль используется встроенной БД (storage.SQLiteStorage)
+try:
+    import psycopg2
+    import psycopg2.extras
+except ImportError:
+    psycopg2 = None
+
+# Необязательные быстрые алгоритмы хэширования
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 # Глобальные переменные для управления потокамии и фоновой проверкой
 _stop_background = False
 _background_thread = None
 _background_event = None
 
+# Настройки пула для расчета хэшей
+HASH_WORKERS = min(8, (os.cpu_count() or 1) * 2) # Кол-во параллельных потоков/процессов
+HASH_USE_PROCESSES = False # Использовать процессы вместо потоков
+
+# Доступные алгоритмы хэширования: имя -> конструктор объекта хэша
+HASH_ALGORITHMS = {
+    "sha256": hashlib.sha256,
+    "blake2b": hashlib.blake2b,
+}
+if blake3 is not None:
+    HASH_ALGORITHMS["blake3"] = blake3.blake3
+if xxhash is not None:
+    HASH_ALGORITHMS["xxh3_128"] = xxhash.xxh3_128
+DEFAULT_HASH_ALGORITHM = "sha256" # Алгоритм новых эталонов и эталонов, созданных до появления выбора
+
+# Формат хэша по частям (версия 1)
+"""
+Алгоритм "<алгоритм>+chunked1": файл до HASH_CHUNK_SIZE байт хэшируется как обычно, больший файл делится на части
+по HASH_CHUNK_SIZE байт, которые читаются и хэшируются параллельно. Итоговый хэш - "c1:" + хэш заголовка
+(b"ic-chunked-v1", размер файла и размер части) и двоичных хэшей частей по порядку
+Хэш зависит от HASH_CHUNK_SIZE, поэтому размер части входит в версию формата и не меняется
+"""
+CHUNKED_SUFFIX = "+chunked1"
+CHUNKED_PREFIX = "c1:"
+HASH_CHUNK_SIZE = 64 * 1024 * 1024
+for _name in list(HASH_ALGORITHMS):
+    HASH_ALGORITHMS[_name + CHUNKED_SUFFIX] = HASH_ALGORITHMS[_name]
+
+# Выборочный дайджест (версия 1)
+"""
+Дайджест "s1:" - хэш заголовка (b"ic-sampled-v1", размер файла и размер блока), первого и последнего блоков файла
+и SAMPLE_BLOCKS блоков между ними, номера которых выводятся из seed ресурса (sha256 от seed и номера попытки)
+Каждый блок хэшируется вместе со своим смещением. Читается не больше (SAMPLE_BLOCKS + 2) * SAMPLE_BLOCK_SIZE байт
+независимо от размера файла, поэтому дайджест подходит для частой проверки больших файлов на подмену
+Изменение вне прочитанных блоков дайджест не замечает, поэтому полная проверка по-прежнему нужна, но реже
+seed хранится в БД, а не рядом с файлом, поэтому по самому файлу нельзя узнать, какие блоки проверяются
+Параметры (алгоритм, кол-во и размер блоков) записываются с эталоном в sample_kind и берутся оттуда при проверке,
+поэтому их изменение не ломает сохраненные эталоны
+"""
+SAMPLED_PREFIX = "s1:"
+SAMPLE_BLOCKS = 16
+SAMPLE_BLOCK_SIZE = 1024 * 1024
+SAMPLE_MIN_SIZE = 256 * 1024 * 1024 # Файлы от этого размера получают выборочный эталон при расчете эталонов
+
+# Параллельная обработка одной папки
+FOLDER_WORKERS = min(8, os.cpu_count() or 1) # Кол-во потоков для обхода папки, хэширования ее файлов и частей файла, 1 - без пула
+_folder_pools = {} # Общие пулы потоков для папок и частей файлов: idle -> (пул, pid создавшего процесса), создаются при первом использовании
+_folder_pool_lock = threading.Lock()
+
+# Настройки чтения файлов
+HASH_BUFFER_SIZE = 1024 * 1024 # Размер буфера чтения, 1-8 МиБ
+# Файлы от этого размера читаются через mmap, None - не использовать mmap (по умолчанию)
+# Усечение файла во время чтения через mmap приводит к SIGBUS и завершению процесса; размер проверяется перед
+# каждым блоком, но между проверкой и чтением файл все равно может быть усечен, поэтому mmap стоит включать
+# только для файлов, которые не перезаписываются во время проверки
+HASH_MMAP_THRESHOLD = None
+HASH_DROP_CACHE = True # Сбрасывать страницы прочитанного файла из кэша ОС (posix_fadvise DONTNEED)
+_read_buffers = threading.local() # Буфер чтения, переиспользуемый в каждом потоке
+
+# Кэш хэшей файлов (hashcache.HashCache): одинаковые файлы разных ресурсов читаются за проверку один раз
+HASH_CACHE_ENABLED = True
+# Файл кэша между запусками задается в hashcache.HASH_CACHE_PATH и используется только быстрыми проверками
+
+# Прогресс расчета хэшей
+PROGRESS_INTERVAL = 0.25 # Минимальный интервал между уведомлениями о прогрессе, сек
+_worker_local = threading.local() # ProgressTracker (tracker), Throttle (throttle), HashCache (cache) и флаг остановки (stop_flag) текущей операции в рабочем потоке
+
+# Печатать результат по каждому ресурсу (на больших наборах печать заметно замедляет проверку)
+# Итоги операций пишутся в журнал "ic" (metrics.logger) независимо от этой настройки
+PRINT_RESOURCE_RESULTS = True
+
+# Кол-во строк (ресурсов и строк манифестов), записываемых в БД одной транзакцией
+UPDATE_BATCH_SIZE = 500
+
+# Потоковое чтение таблицы ресурсов
+RESOURCE_ITERSIZE = 2000 # Кол-во строк, получаемых с сервера за один запрос серверного курсора
+RESOURCE_PAGE_SIZE = 500 # Размер страницы списка ресурсов по умолчанию
+_cursor_names = itertools.count(1) # Номера для уникальных имен серверных курсоров
+
+# Правила исключения (glob)
+"""
+Шаблон без '/' сравнивается с именем каждого файла и папки на пути ("*.log", "__pycache__"),
+шаблон с '/' - с относительным путем от корня ресурса или обхода ("logs/*", "var/cache")
+Исключенная папка не обходится целиком
+IGNORE_PATTERNS действуют во всех папках-ресурсах в дополнение к правилам самого ресурса (колонка ignore_patterns)
+Изменение правил меняет хэш и отпечаток папок, поэтому после него нужно пересчитать эталоны
+"""
+IGNORE_PATTERNS = []
+# Типовые кэши, журналы и временные файлы (предлагаются при массовом добавлении)
+COMMON_IGNORE_PATTERNS = ["*.log", "*.tmp", "*.swp", "*~", "__pycache__", "*.pyc", ".cache"]
+BULK_INSERT_BATCH_SIZE = 1000 # Кол-во ресурсов в одном INSERT при массовом добавлении
+
+# Режимы проверки целостности
+CHECK_MODE_FAST = "fast" # Перехэшируются только ресурсы с изменившимся отпечатком метаданных
+CHECK_MODE_PARANOID = "paranoid" # Полное чтение всех ресурсов (плановый глубокий аудит)
+CHECK_MODE_SAMPLED = "sampled" # Файлы с выборочным эталоном - по выборочному дайджесту, остальные ресурсы - как в быстром режиме
+FULL_CHECK_INTERVAL = 24 * 3600 # Период полной проверки в фоновой проверке с выборочным режимом, сек
+
+# Планировщик проверок
+SCHEDULE_DEFAULT_INTERVAL = 3600 # Интервал проверки ресурса без собственного интервала, сек
+SCHEDULER_MIN_SLEEP = 1.0 # Минимальная пауза между циклами планировщика, сек
+SCHEDULER_MAX_SLEEP = 60.0 # Максимальная пауза (новые и измененные ресурсы замечаются не позже), сек
+
+# Распределенная проверка (агенты на хостах и координатор)
+AGENT_LEASE_SIZE = 50 # Кол-во ресурсов, которые агент берет в аренду за один раз
+AGENT_LEASE_TTL = 120 # Срок аренды, сек: если агент не продлил аренду, ресурсы достаются другим агентам хоста
+AGENT_TIMEOUT = 90 # Агент без сигналов дольше этого времени считается недоступным, его аренды снимаются, сек
+COORDINATOR_INTERVAL = 30 # Пауза между циклами координатора, сек
+LOCAL_HOST = socket.gethostname() # Хост этого процесса: здесь проверяются ресурсы без хоста и ресурсы этого хоста (см. host_scope)
+
+# Ключ ресурса - (хост, путь), NULL-хост совпадает только с NULL (уникальный индекс resource_monitoring_host_path_key)
+RESOURCE_CONFLICT = "ON CONFLICT ((COALESCE(host, '')), resource_path)"
+
+# Миграции схемы БД
+"""
+Список (версия, описание, операторы) по возрастанию версии, примененные версии записываются в schema_migrations
+Версия 1 - таблица ресурсов в исходном виде, она же приводит к версиям базы, созданные до их появления
+Каждое следующее изменение схемы - новая версия в конце списка, примененные версии не меняются
+"""
+MIGRATIONS = [
+    (1, "Базовая схема", [
+        """
+        CREATE TABLE IF NOT EXISTS resource_monitoring (
+            resource_path TEXT NOT NULL,
+            resource_name TEXT,
+            resource_type TEXT,
+            added_date TIMESTAMP,
+            hash TEXT,
+            hash_date TIMESTAMP
+        )
+        """,
+    ]),
+    (2, "Отпечатки метаданных файлов", [
+        "ALTER TABLE resource_monitoring ADD COLUMN IF NOT EXISTS file_size BIGINT",
+        "ALTER TABLE resource_monitoring ADD COLUMN IF NOT EXISTS file_mtime_ns BIGINT",
+        "ALTER TABLE resource_monitoring ADD COLUMN IF NOT EXISTS file_ctime_ns BIGINT",
+        "ALTER TABLE resource_monitoring ADD COLUMN IF NOT EXISTS file_inode BIGINT",
+        "ALTER TABLE resource_monitoring ADD COLUMN IF NOT EXISTS file_device BIGINT",
+    ]),
+    (3, "Манифест папок", [
+        """
+        CREATE TABLE IF NOT EXISTS resource_files (
+            resource_path TEXT NOT NULL,
+            rel_path TEXT NOT NULL,
+            entry_type TEXT NOT NULL,
+            file_size BIGINT,
+            file_mtime_ns BIGINT,
+            hash TEXT,
+            PRIMARY KEY (resource_path, rel_path)
+        )
+        """,
+    ]),
+    (4, "Алгоритм эталона и история эталонов", [
+        f"ALTER TABLE resource_monitoring ADD COLUMN IF NOT EXISTS hash_algorithm TEXT NOT NULL DEFAULT '{DEFAULT_HASH_ALGORITHM}'",
+        """
+        CREATE TABLE IF NOT EXISTS hash_history (
+            resource_path TEXT NOT NULL,
+            hash TEXT,
+            hash_algorithm TEXT,
+            hash_date TIMESTAMP,
+            archived_date TIMESTAMP
+        )
+        """,
+    ]),
+    (5, "История проверок", [
+        """
+        CREATE TABLE IF NOT EXISTS check_runs (
+            run_id SERIAL PRIMARY KEY,
+            started_at TIMESTAMP NOT NULL,
+            finished_at TIMESTAMP,
+            duration_seconds DOUBLE PRECISION,
+            check_mode TEXT,
+            total_count INTEGER,
+            passed_count INTEGER,
+            failed_count INTEGER,
+            unavailable_count INTEGER,
+            no_hash_count INTEGER,
+            bytes_hashed BIGINT,
+            stopped BOOLEAN NOT NULL DEFAULT FALSE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS check_results (
+            run_id INTEGER NOT NULL REFERENCES check_runs (run_id) ON DELETE CASCADE,
+            resource_path TEXT NOT NULL,
+            status TEXT NOT NULL,
+            checked_at TIMESTAMP NOT NULL,
+            details TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS check_results_path_idx ON check_results (resource_path, checked_at DESC)",
+        "CREATE INDEX IF NOT EXISTS check_results_violations_idx ON check_results (checked_at) WHERE status = 'failed'",
+    ]),
+    (6, "Расписание проверок", [
+        "ALTER TABLE resource_monitoring ADD COLUMN IF NOT EXISTS check_interval INTEGER",
+        "ALTER TABLE resource_monitoring ADD COLUMN IF NOT EXISTS priority INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE resource_monitoring ADD COLUMN IF NOT EXISTS next_check TIMESTAMP",
+        "ALTER TABLE resource_monitoring ADD COLUMN IF NOT EXISTS last_checked TIMESTAMP",
+        "CREATE INDEX IF NOT EXISTS resource_monitoring_next_check_idx ON resource_monitoring (next_check)",
+    ]),
+    (7, "Индекс постраничного списка", [
+        "CREATE INDEX IF NOT EXISTS resource_monitoring_list_idx ON resource_monitoring ((COALESCE(added_date, '-infinity'::timestamp)), resource_path)",
+    ]),
+    # Дубликаты путей сводятся к строке с последним эталоном, эталоны остальных - в hash_history
+    (8, "Один ресурс на путь и правила исключения", [
+        """
+        DO $$
+        DECLARE
+            duplicates TEXT;
+        BEGIN
+            IF to_regclass('resource_monitoring_path_key') IS NULL THEN
+                SELECT string_agg(resource_path, ', ' ORDER BY resource_path) INTO duplicates FROM (
+                    SELECT resource_path FROM resource_monitoring GROUP BY resource_path HAVING count(*) > 1
+                ) d;
+                IF duplicates IS NOT NULL THEN
+                    WITH ranked AS (
+                        SELECT ctid AS row_id, row_number() OVER (
+                            PARTITION BY resource_path
+                            ORDER BY hash IS NULL, hash_date DESC NULLS LAST, added_date DESC NULLS LAST, ctid
+                        ) AS rank
+                        FROM resource_monitoring
+                    ), removed AS (
+                        DELETE FROM resource_monitoring
+                        WHERE ctid IN (SELECT row_id FROM ranked WHERE rank > 1)
+                        RETURNING resource_path, hash, hash_algorithm, hash_date
+                    )
+                    INSERT INTO hash_history (resource_path, hash, hash_algorithm, hash_date, archived_date)
+                    SELECT resource_path, hash, hash_algorithm, hash_date, now() FROM removed WHERE hash IS NOT NULL;
+                    RAISE WARNING 'Удалены дубликаты ресурсов (оставлена строка с последним эталоном, прежние эталоны - в hash_history): %', duplicates;
+                END IF;
+            END IF;
+        END
+        $$
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS resource_monitoring_path_key ON resource_monitoring (resource_path)",
+        "ALTER TABLE resource_monitoring ADD COLUMN IF NOT EXISTS ignore_patterns TEXT[]",
+    ]),
+    # Ограничения NOT VALID проверяются для новых и измененных строк, старые строки не блокируют миграцию
+    (9, "Первичный ключ, ограничения значений и индекс истории эталонов", [
+        "ALTER TABLE resource_monitoring ADD CONSTRAINT resource_monitoring_path_key PRIMARY KEY USING INDEX resource_monitoring_path_key",
+        "ALTER TABLE resource_monitoring ADD CONSTRAINT resource_monitoring_type_check CHECK (resource_type IN ('file', 'folder')) NOT VALID",
+        "ALTER TABLE resource_monitoring ADD CONSTRAINT resource_monitoring_hash_check CHECK (hash ~ '^(c1:)?[0-9a-f]+$') NOT VALID",
+        "ALTER TABLE resource_monitoring ADD CONSTRAINT resource_monitoring_algorithm_check CHECK (hash_algorithm <> '') NOT VALID",
+        "ALTER TABLE resource_monitoring ADD CONSTRAINT resource_monitoring_interval_check CHECK (check_interval > 0) NOT VALID",
+        "ALTER TABLE resource_files ADD CONSTRAINT resource_files_entry_type_check CHECK (entry_type IN ('file', 'dir')) NOT VALID",
+        "ALTER TABLE check_results ADD CONSTRAINT check_results_status_check CHECK (status IN ('passed', 'failed', 'unavailable', 'no_hash')) NOT VALID",
+        "CREATE INDEX IF NOT EXISTS hash_history_path_idx ON hash_history (resource_path, archived_date DESC)",
+    ]),
+    (10, "Хосты ресурсов, аренды и агенты распределенной проверки", [
+        "ALTER TABLE resource_monitoring ADD COLUMN IF NOT EXISTS host TEXT",
+        "ALTER TABLE resource_monitoring ADD COLUMN IF NOT EXISTS lease_owner TEXT",
+        "ALTER TABLE resource_monitoring ADD COLUMN IF NOT EXISTS lease_expires TIMESTAMP",
+        "CREATE INDEX IF NOT EXISTS resource_monitoring_host_idx ON resource_monitoring (host, next_check)",
+        "CREATE INDEX IF NOT EXISTS resource_monitoring_lease_idx ON resource_monitoring (lease_owner) WHERE lease_owner IS NOT NULL",
+        """
+        CREATE TABLE IF NOT EXISTS agents (
+            agent_id TEXT PRIMARY KEY,
+            host TEXT NOT NULL,
+            status TEXT NOT NULL CHECK (status IN ('online', 'offline', 'stopped')),
+            started_at TIMESTAMP NOT NULL,
+            last_heartbeat TIMESTAMP NOT NULL
+        )
+        """,
+        "ALTER TABLE check_runs ADD COLUMN IF NOT EXISTS agent_id TEXT",
+        "CREATE INDEX IF NOT EXISTS check_runs_agent_idx ON check_runs (agent_id) WHERE agent_id IS NOT NULL",
+    ]),
+    (11, "Выборочные эталоны больших файлов", [
+        "ALTER TABLE resource_monitoring ADD COLUMN IF NOT EXISTS sample_hash TEXT",
+        "ALTER TABLE resource_monitoring ADD COLUMN IF NOT EXISTS sample_kind TEXT",
+        "ALTER TABLE resource_monitoring ADD COLUMN IF NOT EXISTS sample_seed BIGINT",
+        "ALTER TABLE resource_monitoring ADD CONSTRAINT resource_monitoring_sample_check CHECK ((sample_hash IS NULL) = (sample_kind IS NULL)) NOT VALID",
+    ]),
+    # Ресурс без хоста и одноименные ресурсы разных хостов - разные строки, уникальность пути заменяется
+    # уникальностью (хост, путь) - цель RESOURCE_CONFLICT; пустое имя хоста запрещено, чтобы не совпасть с NULL
+    (12, "Ключ ресурса (хост, путь), хосты проверок и результатов", [
+        "CREATE UNIQUE INDEX IF NOT EXISTS resource_monitoring_host_path_key ON resource_monitoring ((COALESCE(host, '')), resource_path)",
+        "ALTER TABLE resource_monitoring DROP CONSTRAINT IF EXISTS resource_monitoring_path_key",
+        "CREATE INDEX IF NOT EXISTS resource_monitoring_path_idx ON resource_monitoring (resource_path)",
+        "ALTER TABLE resource_monitoring ADD CONSTRAINT resource_monitoring_host_check CHECK (host <> '') NOT VALID",
+        "ALTER TABLE resource_files ADD COLUMN IF NOT EXISTS host TEXT",
+        "ALTER TABLE resource_files DROP CONSTRAINT IF EXISTS resource_files_pkey",
+        "CREATE UNIQUE INDEX IF NOT EXISTS resource_files_host_path_key ON resource_files ((COALESCE(host, '')), resource_path, rel_path)",
+        "ALTER TABLE hash_history ADD COLUMN IF NOT EXISTS host TEXT",
+        "ALTER TABLE check_runs ADD COLUMN IF NOT EXISTS host TEXT",
+        "ALTER TABLE check_results ADD COLUMN IF NOT EXISTS host TEXT",
+        "ALTER TABLE check_results ADD COLUMN IF NOT EXISTS agent_id TEXT",
+    ]),
+    (13, "Хост в индексе списка ресурсов", [
+        "DROP INDEX IF EXISTS resource_monitoring_list_idx",
+        "CREATE INDEX IF NOT EXISTS resource_monitoring_list_idx ON resource_monitoring ((COALESCE(added_date, '-infinity'::timestamp)), resource_path, (COALESCE(host, '')))",
+    ]),
+    (14, "Хост ресурса в результатах проверки", [
+        "ALTER TABLE check_results ADD COLUMN IF NOT EXISTS resource_host TEXT",
+    ]),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0] # Версия схемы, которую ожидает этот код
+_MIGRATION_LOCK_ID = 0x1C5C4E4A # Ключ pg_advisory_xact_lock: миграции нескольких процессов выполняются по очереди
+
 # Подключение к базе данных
 """"
 На вход подаются параметры настройки подключения к БД
 Возвращает строку подключения
 """
-def connect_to_db(dbname: str, user: str, password: str, host: str = "localhost", port: str = "5432") -> psycopg2.extensions.connection:
+def connect_to_db(dbname: str, user: str, password: str, host: str = "localhost", port: str = "5432") -> "psycopg2.extensions.connection":
     try:
         conn = psycopg2.connect(
             dbname=dbname,
             user=user,
             password=password,
             host=host,
-            port=port
+            port=port,
+            cursor_factory=TimedCursor
         )
         print(f"Успешно подключено к базе данных {dbname}")
         return conn
@@ -30,49 +362,560 @@ def connect_to_db(dbname: str, user: str, password: str, host: str = "localhost"
         print(f"Ошибка подключения к БД: {e}")
         raise
 
+# Соединение для операции
+"""
+Если передан пул Database, на время блока из него берется отдельное соединение
+Иначе используется переданное соединение
+"""
+@contextmanager
+def use_connection(conn):
+    if isinstance(conn, Database):
+        with conn.connection() as pooled_conn:
+            yield pooled_conn
+    else:
+        yield conn
+
+# Условие на ресурсы хоста
+"""
+Ресурсы без хоста (host NULL) и ресурсы, закрепленные за этим хостом: именно они проверяются на нем.
+Одно условие используется при расчете эталонов, проверке, в планировщике и при отслеживании событий
+column - колонка хоста (с псевдонимом таблицы), имя хоста передается параметром запроса (по умолчанию LOCAL_HOST)
+"""
+def host_scope(column: str = "host") -> str:
+    return f"({column} IS NULL OR {column} = %s)"
+
+# Подпись ресурса в сообщениях: путь, у ресурса, закрепленного за хостом, - хост:путь
+def resource_label(host: str, resource_path: str) -> str:
+    return f"{host}:{resource_path}" if host else resource_path
+
+# Подготовка схемы БД
+"""
+Применяет не выполненные миграции MIGRATIONS по порядку и записывает их версии в schema_migrations
+Все миграции выполняются в одной транзакции под advisory-блокировкой, поэтому процессы, запущенные одновременно,
+не применяют одну миграцию дважды, а при ошибке схема остается в прежней версии
+Если схема БД новее, чем знает этот код, изменения не выполняются и возвращается False: код не должен работать
+со схемой, которую он не знает
+Предупреждения сервера при миграции (например, об удаленных дубликатах) выводятся
+Обрабатываются ошибки при изменении схемы
+Возвращает True, если схема готова
+"""
+def init_db(conn) -> bool:
+    notices = getattr(conn, "notices", [])
+    notices_seen = len(notices)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (_MIGRATION_LOCK_ID,))
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMP NOT NULL DEFAULT now()
+                )
+            """)
+            cur.execute("SELECT version FROM schema_migrations")
+            applied = {version for version, in cur.fetchall()}
+            if applied and max(applied) > SCHEMA_VERSION:
+                print(f"Схема БД версии {max(applied)} новее поддерживаемой ({SCHEMA_VERSION}), обновите программу")
+                conn.rollback()
+                return False
+            for version, description, statements in MIGRATIONS:
+                if version in applied:
+                    continue
+                for statement in statements:
+                    cur.execute(statement)
+                cur.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)", (version, description))
+                logger.info("Применена миграция схемы БД", extra={"version": version, "description": description})
+                for notice in notices[notices_seen:]:
+                    metrics.report(logging.WARNING, "Предупреждение миграции схемы БД", notice.strip(), version=version)
+                notices_seen = len(notices)
+        conn.commit()
+        return True
+    except psycopg2.Error as e:
+        print(f"Ошибка при подготовке схемы БД: {e}")
+        conn.rollback()
+        return False
+
+# Создание объекта хэша
+"""
+Ищет алгоритм в HASH_ALGORITHMS
+Если алгоритм неизвестен или его модуль не установлен, выбрасывает ValueError
+Возвращает новый объект для вычисления хэша
+"""
+def new_hasher(algorithm: str = DEFAULT_HASH_ALGORITHM):
+    constructor = HASH_ALGORITHMS.get(algorithm)
+    if constructor is None:
+        raise ValueError(f"Алгоритм хэширования {algorithm} недоступен")
+    return constructor()
+
+# Подсказка ОС о характере чтения файла
+"""
+Вызывает posix_fadvise, если он есть в системе
+Ошибки игнорируются, так как подсказка не влияет на результат
+"""
+def _fadvise(fd: int, advice_name: str) -> None:
+    advice = getattr(os, advice_name, None)
+    if advice is None or not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, advice)
+    except OSError:
+        pass
+
+# Буфер чтения текущего потока
+"""
+Буфер создается один раз на поток и переиспользуется для всех файлов
+Возвращает пару (bytearray, memoryview)
+"""
+def _get_read_buffer(buffer_size: int) -> tuple:
+    buffer = getattr(_read_buffers, "buffer", None)
+    if buffer is None or len(buffer) != buffer_size:
+        buffer = bytearray(buffer_size)
+        _read_buffers.buffer = buffer
+        _read_buffers.view = memoryview(buffer)
+    return buffer, _read_buffers.view
+
 # Расчет хэша для файла
 """
-Создается объект для вычисления хэша
-Чтение файла происходит блоками по 4096 байт до конца файла, каждый блок добавляется в объект хэш
+Файл читается без буферизации Python через readinto в переиспользуемый буфер или, от HASH_MMAP_THRESHOLD байт, через mmap
+Файл, уже прочитанный в этой операции (HashCache задачи потока), не перечитывается
 Обрабатываются ошибки при чтении файла
 Возвращает хэш в 16-ом формате
 """
-def hash_file(file_path: str) -> str:
-    sha256 = hashlib.sha256()
+def hash_file(file_path: str, algorithm: str = DEFAULT_HASH_ALGORITHM, buffer_size: int = None) -> str:
+    cache = getattr(_worker_local, "cache", None)
+    if cache is not None and cache.active:
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            st = None
+        if st is not None and stat.S_ISREG(st.st_mode):
+            return cache.get_or_compute(HashCache.key(st, algorithm), lambda: _read_file_hash(file_path, algorithm, buffer_size))
+    return _read_file_hash(file_path, algorithm, buffer_size)
+
+# Чтение файла и расчет хэша (см. hash_file)
+def _read_file_hash(file_path: str, algorithm: str, buffer_size: int = None) -> str:
+    if algorithm.endswith(CHUNKED_SUFFIX):
+        return _hash_file_chunked(file_path, algorithm, buffer_size)
+    _on_file(file_path)
+    started = time.perf_counter()
+    try:
+        hasher = new_hasher(algorithm)
+        buffer_size = buffer_size or HASH_BUFFER_SIZE
+        with open(file_path, 'rb', buffering=0) as f:
+            fd = f.fileno()
+            _fadvise(fd, "POSIX_FADV_SEQUENTIAL")
+            size = os.fstat(fd).st_size
+            if HASH_MMAP_THRESHOLD is not None and size >= HASH_MMAP_THRESHOLD:
+                with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapped:
+                    view = memoryview(mapped)
+                    try:
+                        for offset in range(0, len(view), buffer_size):
+                            # Обращение к странице за концом усеченного файла - SIGBUS, поэтому размер проверяется заранее
+                            if os.fstat(fd).st_size < len(view):
+                                raise OSError(f"файл усечен во время чтения ({len(view)} байт при открытии)")
+                            chunk = view[offset:offset + buffer_size]
+                            hasher.update(chunk)
+                            _on_read(len(chunk))
+                            chunk.release()
+                    finally:
+                        view.release()
+            else:
+                buffer, view = _get_read_buffer(buffer_size)
+                while True:
+                    read_size = f.readinto(buffer)
+                    if not read_size:
+                        break
+                    hasher.update(view[:read_size])
+                    _on_read(read_size)
+            if HASH_DROP_CACHE:
+                _fadvise(fd, "POSIX_FADV_DONTNEED")
+        metrics.inc("ic_hash_files_total", algorithm=algorithm)
+        metrics.inc("ic_hash_bytes_total", size, algorithm=algorithm)
+        metrics.observe("ic_hash_file_seconds", time.perf_counter() - started, algorithm=algorithm)
+        return hasher.hexdigest()
+    except Exception as e:
+        metrics.inc("ic_hash_errors_total", kind="file")
+        metrics.report(logging.WARNING, "Ошибка при чтении файла", f"Ошибка при чтении файла {file_path}: {e}", path=file_path, error=str(e))
+        return None
+
+# Хэш файла по частям
+"""
+См. формат "+chunked1" (CHUNKED_SUFFIX). Части хэшируются в общем пуле FOLDER_WORKERS,
+а если файл уже обрабатывается в потоке этого пула - по очереди
+Обрабатываются ошибки при чтении файла
+Возвращает хэш с префиксом CHUNKED_PREFIX
+"""
+def _hash_file_chunked(file_path: str, algorithm: str, buffer_size: int = None) -> str:
+    base_algorithm = algorithm[:-len(CHUNKED_SUFFIX)]
+    try:
+        size = os.stat(file_path).st_size
+    except OSError as e:
+        metrics.inc("ic_hash_errors_total", kind="file")
+        print(f"Ошибка при чтении файла {file_path}: {e}")
+        return None
+    if size <= HASH_CHUNK_SIZE:
+        return _read_file_hash(file_path, base_algorithm, buffer_size)
+    _on_file(file_path)
+    started = time.perf_counter()
     try:
-        with open(file_path, 'rb') as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                sha256.update(chunk)
-        return sha256.hexdigest()
+        offsets = range(0, size, HASH_CHUNK_SIZE)
+        digests = _map_ordered(lambda offset: _hash_file_range(file_path, base_algorithm, offset, HASH_CHUNK_SIZE, buffer_size), offsets)
+        hasher = new_hasher(base_algorithm)
+        hasher.update(b"ic-chunked-v1" + size.to_bytes(8, "big") + HASH_CHUNK_SIZE.to_bytes(8, "big"))
+        for digest in digests:
+            hasher.update(digest)
+        metrics.inc("ic_hash_files_total", algorithm=algorithm)
+        metrics.inc("ic_hash_bytes_total", size, algorithm=algorithm)
+        metrics.observe("ic_hash_file_seconds", time.perf_counter() - started, algorithm=algorithm)
+        return CHUNKED_PREFIX + hasher.hexdigest()
     except Exception as e:
+        metrics.inc("ic_hash_errors_total", kind="file")
+        metrics.report(logging.WARNING, "Ошибка при чтении файла", f"Ошибка при чтении файла {file_path}: {e}", path=file_path, error=str(e))
+        return None
+
+# Хэш части файла
+"""
+Читает length байт с позиции offset через readinto в переиспользуемый буфер потока
+Возвращает двоичный хэш части
+"""
+def _hash_file_range(file_path: str, algorithm: str, offset: int, length: int, buffer_size: int = None) -> bytes:
+    hasher = new_hasher(algorithm)
+    buffer, view = _get_read_buffer(buffer_size or HASH_BUFFER_SIZE)
+    with open(file_path, 'rb', buffering=0) as f:
+        f.seek(offset)
+        remaining = length
+        while remaining > 0:
+            read_size = f.readinto(view[:min(len(buffer), remaining)])
+            if not read_size:
+                break
+            hasher.update(view[:read_size])
+            _on_read(read_size)
+            remaining -= read_size
+        if HASH_DROP_CACHE and hasattr(os, "posix_fadvise") and hasattr(os, "POSIX_FADV_DONTNEED"):
+            try:
+                os.posix_fadvise(f.fileno(), offset, length, os.POSIX_FADV_DONTNEED)
+            except OSError:
+                pass
+    return hasher.digest()
+
+# Вид выборочного дайджеста
+"""
+Возвращает строку "s1/<алгоритм>/<кол-во блоков>x<размер блока>" для текущих настроек SAMPLE_BLOCKS и SAMPLE_BLOCK_SIZE
+Для алгоритмов по частям берется базовый алгоритм
+"""
+def sample_kind(algorithm: str = DEFAULT_HASH_ALGORITHM) -> str:
+    if algorithm.endswith(CHUNKED_SUFFIX):
+        algorithm = algorithm[:-len(CHUNKED_SUFFIX)]
+    return f"s1/{algorithm}/{SAMPLE_BLOCKS}x{SAMPLE_BLOCK_SIZE}"
+
+# Смещения блоков выборочного дайджеста
+"""
+Если в файле не больше blocks + 2 блоков, берутся все блоки, иначе первый, последний и blocks различных блоков между
+ними, номера которых выводятся из seed. Для одного seed и размера файла смещения всегда одинаковы
+Возвращает отсортированный список смещений
+"""
+def sample_offsets(size: int, seed: int, blocks: int, block_size: int) -> list:
+    last = max(0, size - 1) // block_size
+    if last + 1 <= blocks + 2:
+        return [index * block_size for index in range(last + 1)]
+    indices = {0, last}
+    attempt = 0
+    while len(indices) < blocks + 2:
+        digest = hashlib.sha256(f"{seed}:{attempt}".encode()).digest()
+        indices.add(1 + int.from_bytes(digest[:8], "big") % (last - 1))
+        attempt += 1
+    return [index * block_size for index in sorted(indices)]
+
+# Выборочный дайджест файла
+"""
+См. формат "s1:" (SAMPLED_PREFIX). kind - вид дайджеста из sample_kind (по умолчанию - для алгоритма algorithm
+и текущих настроек), seed - seed ресурса
+Обрабатываются ошибки при чтении файла
+Возвращает пару (дайджест с префиксом SAMPLED_PREFIX, прочитано байт) или (None, 0)
+"""
+def hash_file_sampled(file_path: str, seed: int, kind: str = None, algorithm: str = DEFAULT_HASH_ALGORITHM) -> tuple:
+    kind = kind or sample_kind(algorithm)
+    try:
+        version, base_algorithm, params = kind.split("/")
+        blocks, block_size = (int(value) for value in params.split("x"))
+        if version != "s1":
+            raise ValueError(f"неизвестный вид выборочного дайджеста {kind}")
+    except ValueError as e:
         print(f"Ошибка при чтении файла {file_path}: {e}")
+        return None, 0
+    _on_file(file_path)
+    started = time.perf_counter()
+    read_bytes = 0
+    try:
+        hasher = new_hasher(base_algorithm)
+        with open(file_path, 'rb', buffering=0) as f:
+            size = os.fstat(f.fileno()).st_size
+            hasher.update(b"ic-sampled-v1" + size.to_bytes(8, "big") + block_size.to_bytes(8, "big"))
+            for offset in sample_offsets(size, seed, blocks, block_size):
+                f.seek(offset)
+                block = f.read(block_size)
+                hasher.update(offset.to_bytes(8, "big"))
+                hasher.update(block)
+                read_bytes += len(block)
+                _on_read(len(block))
+        metrics.inc("ic_hash_files_total", algorithm=kind)
+        metrics.inc("ic_hash_bytes_total", read_bytes, algorithm=kind)
+        metrics.observe("ic_hash_file_seconds", time.perf_counter() - started, algorithm=kind)
+        return SAMPLED_PREFIX + hasher.hexdigest(), read_bytes
+    except Exception as e:
+        metrics.inc("ic_hash_errors_total", kind="file")
+        metrics.report(logging.WARNING, "Ошибка при чтении файла", f"Ошибка при чтении файла {file_path}: {e}", path=file_path, error=str(e))
+        return None, 0
+
+# Общий пул потоков для папок и частей файлов
+"""
+idle=True - отдельный пул, потоки которого при запуске переводятся на низкий приоритет (для операций с idle_priority),
+потоки обычного пула приоритет не меняют
+В дочернем процессе создается свой пул
+Возвращает ThreadPoolExecutor или None, если параллельная обработка папок отключена (FOLDER_WORKERS <= 1)
+"""
+def _get_folder_pool(idle: bool = False):
+    if FOLDER_WORKERS <= 1:
         return None
+    with _folder_pool_lock:
+        pool, pid = _folder_pools.get(idle, (None, None))
+        if pool is None or pid != os.getpid():
+            if idle:
+                pool = ThreadPoolExecutor(max_workers=FOLDER_WORKERS, thread_name_prefix="ic-folder-idle", initializer=set_idle_priority)
+            else:
+                pool = ThreadPoolExecutor(max_workers=FOLDER_WORKERS, thread_name_prefix="ic-folder")
+            _folder_pools[idle] = (pool, os.getpid())
+        return pool
+
+# Вызов функции в потоке общего пула с контекстом вызывающего потока
+"""
+ProgressTracker, Throttle, HashCache и флаг остановки операции передаются из вызывающего потока, поэтому прогресс,
+ограничение нагрузки и кэш работают и для файлов, считающихся в пуле
+"""
+def _run_in_folder_pool(context: tuple, func: Callable, arg):
+    _worker_local.tracker, _worker_local.throttle, _worker_local.cache, _worker_local.stop_flag = context
+    _worker_local.in_folder_pool = True
+    try:
+        return func(arg)
+    finally:
+        _worker_local.tracker = _worker_local.throttle = _worker_local.cache = _worker_local.stop_flag = None
+
+# Параллельное применение функции с сохранением порядка
+"""
+func вызывается для каждого элемента items в общем пуле (одновременно - не больше 2 * FOLDER_WORKERS задач),
+для операций с idle_priority - в пуле с низким приоритетом
+Если пул отключен или вызов уже идет из потока пула, элементы обрабатываются по очереди в текущем потоке
+Результаты возвращаются в порядке items, поэтому зависящие от порядка хэши не меняются
+Возвращает список результатов
+"""
+def _map_ordered(func: Callable, items: Iterable) -> list:
+    context = tuple(getattr(_worker_local, name, None) for name in ("tracker", "throttle", "cache", "stop_flag"))
+    throttle = context[1]
+    pool = None if getattr(_worker_local, "in_folder_pool", False) else _get_folder_pool(throttle is not None and throttle.idle_priority)
+    if pool is None:
+        return [func(item) for item in items]
+    results = []
+    window = []
+    for item in items:
+        window.append(pool.submit(_run_in_folder_pool, context, func, item))
+        if len(window) >= FOLDER_WORKERS * 2:
+            results.append(window.pop(0).result())
+    results.extend(future.result() for future in window)
+    return results
+
+# Содержимое одной папки
+"""
+Читает папку через os.scandir, stat берется из DirEntry (без повторного построения путей)
+Разделение на файлы и папки - как в os.walk: ссылка на папку считается папкой, но не обходится
+Ошибки чтения папки и stat игнорируются (stat - None)
+Возвращает (rel_dir, файлы [(имя, stat)], папки [(имя, stat, обходить ли)])
+"""
+def _scan_dir(folder_path: str, rel_dir: str, ignore: list) -> tuple:
+    files, dirs = [], []
+    try:
+        with os.scandir(os.path.join(folder_path, rel_dir) if rel_dir else folder_path) as it:
+            for entry in it:
+                rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                if ignore and is_ignored(rel_path, ignore):
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                try:
+                    st = entry.stat()
+                except OSError:
+                    st = None
+                if is_dir:
+                    try:
+                        descend = not entry.is_symlink()
+                    except OSError:
+                        descend = False
+                    dirs.append((entry.name, st, descend))
+                else:
+                    files.append((entry.name, st))
+    except OSError:
+        pass
+    return rel_dir, files, dirs
+
+# Обход папки
+"""
+Папки одного уровня читаются параллельно в общем пуле (см. _map_ordered), stat берется из DirEntry
+Файлы и папки, попадающие под правила ignore, пропускаются
+Возвращает словарь rel_dir папки ('' - корень) -> (файлы, папки) в формате _scan_dir
+"""
+def scan_folder(folder_path: str, ignore: Iterable[str] = None) -> dict:
+    ignore = list(ignore or ())
+    tree = {}
+    level = [""]
+    while level:
+        next_level = []
+        for rel_dir, files, dirs in _map_ordered(lambda rel_dir: _scan_dir(folder_path, rel_dir, ignore), level):
+            tree[rel_dir] = (files, dirs)
+            next_level += [os.path.join(rel_dir, name) if rel_dir else name for name, _, descend in dirs if descend]
+        level = next_level
+    return tree
+
+# Манифест папки
+"""
+Обходит папку (scan_folder) в прежнем порядке и хэширует файлы в общем пуле FOLDER_WORKERS, файлы из stored_files
+(rel_path -> (размер, mtime_ns, хэш)) с прежними размером и mtime_ns не перечитываются, недоступный файл получает хэш None
+Возвращает список кортежей (rel_path, размер, mtime_ns, хэш)
+"""
+def build_folder_manifest(folder_path: str, stored_files: dict = None, algorithm: str = DEFAULT_HASH_ALGORITHM, stats: dict = None, ignore: Iterable[str] = None) -> list:
+    tree = scan_folder(folder_path, ignore)
+    entries = []
+    for rel_dir in sorted(tree, key=lambda rel_dir: os.path.join(folder_path, rel_dir) if rel_dir else folder_path):
+        for filename, st in sorted(tree[rel_dir][0], key=lambda item: item[0]):
+            rel_path = os.path.join(rel_dir, filename) if rel_dir else filename
+            size, mtime_ns = (st.st_size, st.st_mtime_ns) if st is not None else (None, None)
+            stored = stored_files.get(rel_path) if stored_files else None
+            reuse = stored and size is not None and stored[0] == size and stored[1] == mtime_ns and stored[2]
+            entries.append((rel_path, size, mtime_ns, stored[2] if reuse else None))
+
+    to_hash = [rel_path for rel_path, _, _, stored_hash in entries if stored_hash is None]
+    hashes = dict(zip(to_hash, _map_ordered(lambda rel_path: hash_file(os.path.join(folder_path, rel_path), algorithm), to_hash)))
+    manifest = []
+    for rel_path, size, mtime_ns, file_hash in entries:
+        if file_hash is None:
+            file_hash = hashes[rel_path]
+            if stats is not None and file_hash:
+                stats["bytes"] = stats.get("bytes", 0) + size
+        if not file_hash:
+            print(f"Ошибка доступа к {os.path.join(folder_path, rel_path)}")
+        manifest.append((rel_path, size, mtime_ns, file_hash))
+    return manifest
+
+# Проверка пути по правилам исключения
+"""
+rel_path - путь относительно корня, patterns - шаблоны glob (см. IGNORE_PATTERNS)
+Возвращает True, если путь или одна из папок на нем исключены
+"""
+def is_ignored(rel_path: str, patterns: Iterable[str]) -> bool:
+    if not patterns:
+        return False
+    parts = rel_path.replace(os.sep, "/").split("/")
+    for i, name in enumerate(parts):
+        prefix = "/".join(parts[:i + 1])
+        for pattern in patterns:
+            if fnmatch.fnmatchcase(prefix if "/" in pattern else name, pattern.strip("/")):
+                return True
+    return False
+
+# Обход папки с правилами исключения
+"""
+Аналог os.walk, исключенные папки не обходятся, исключенные файлы не попадают в списки
+Возвращает генератор (папка, подпапки, файлы)
+"""
+def walk_folder(folder_path: str, ignore: Iterable[str] = None) -> Iterator[tuple]:
+    ignore = list(ignore or ())
+    for root, dirs, files in os.walk(folder_path):
+        if ignore:
+            rel_root = os.path.relpath(root, folder_path)
+            rel_root = "" if rel_root == "." else rel_root
+            dirs[:] = [name for name in dirs if not is_ignored(os.path.join(rel_root, name), ignore)]
+            files = [name for name in files if not is_ignored(os.path.join(rel_root, name), ignore)]
+        yield root, dirs, files
+
+# Правила исключения ресурса
+"""
+Общие IGNORE_PATTERNS и правила ресурса (ignore_patterns из БД)
+Возвращает кортеж шаблонов
+"""
+def resource_ignore_rules(patterns: Iterable[str] = None) -> tuple:
+    return tuple(IGNORE_PATTERNS) + tuple(patterns or ())
+
+# Хэши поддеревьев папки
+"""
+Для каждой папки манифеста (корень - '.') создается объект для вычисления хэша выбранным алгоритмом
+Относительный путь и хэш каждого файла добавляются в объекты хэша всех папок, в которых он лежит
+Хэш корня совпадает с прежним форматом hash_folder, поэтому старые эталоны остаются действительными
+Возвращает словарь rel_path папки -> хэш в 16-ом формате
+"""
+def folder_digests(manifest: list, algorithm: str = DEFAULT_HASH_ALGORITHM) -> dict:
+    hashers = {".": new_hasher(algorithm)}
+    for rel_path, _, _, file_hash in manifest:
+        data = rel_path.encode('utf-8') + (file_hash.encode('utf-8') if file_hash else b"")
+        parent = os.path.dirname(rel_path)
+        while parent:
+            if parent not in hashers:
+                hashers[parent] = new_hasher(algorithm)
+            hashers[parent].update(data)
+            parent = os.path.dirname(parent)
+        hashers["."].update(data)
+    return {rel_dir: hasher.hexdigest() for rel_dir, hasher in hashers.items()}
+
+# Сравнение манифестов папки
+"""
+Обход начинается с корня, поддеревья с одинаковым хэшем в старом и новом манифесте пропускаются
+В остальных папках сравниваются файлы и обходятся вложенные папки
+Возвращает словарь со списками added, removed, modified относительных путей файлов
+"""
+def diff_manifests(old_files: dict, old_dirs: dict, new_files: dict, new_dirs: dict) -> dict:
+    changes = {"added": [], "removed": [], "modified": []}
+    children = {}
+    for rel_path in set(old_files) | set(new_files):
+        parent = os.path.dirname(rel_path) or "."
+        children.setdefault(parent, (set(), set()))[1].add(rel_path)
+        while parent != ".":
+            grandparent = os.path.dirname(parent) or "."
+            children.setdefault(grandparent, (set(), set()))[0].add(parent)
+            parent = grandparent
+
+    stack = ["."]
+    while stack:
+        rel_dir = stack.pop()
+        if old_dirs.get(rel_dir) is not None and old_dirs.get(rel_dir) == new_dirs.get(rel_dir):
+            continue
+        subdirs, files = children.get(rel_dir, (set(), set()))
+        for rel_path in files:
+            if rel_path not in old_files:
+                changes["added"].append(rel_path)
+            elif rel_path not in new_files:
+                changes["removed"].append(rel_path)
+            elif old_files[rel_path] != new_files[rel_path]:
+                changes["modified"].append(rel_path)
+        stack.extend(subdirs)
+
+    for paths in changes.values():
+        paths.sort()
+    return changes
 
 # Расчет хэша для папки
 """
-Создается объект для вычисления хэша
-Происходит рекурсивный обход всех файлов в папке и ее подпапках
-Относительные пути к файлам добавляется в объект хэш
-В объект хэша добавляется хэш всех файлов
+Строит манифест папки и возвращает хэш ее корня
 Обрабатываются ошибки при чтении папки
 Возвращает хэш в 16-ом формате
 """
-def hash_folder(folder_path: str) -> str:
-    sha256 = hashlib.sha256()
+def hash_folder(folder_path: str, algorithm: str = DEFAULT_HASH_ALGORITHM, ignore: Iterable[str] = None) -> str:
+    if ignore is None:
+        ignore = IGNORE_PATTERNS
     try:
-        for root, _, files in sorted(os.walk(folder_path)):
-            for filename in sorted(files):
-                file_path = os.path.join(root, filename)
-                rel_path = os.path.relpath(file_path, folder_path).encode('utf-8')
-                sha256.update(rel_path)
-                file_hash = hash_file(file_path)
-                if file_hash:
-                    sha256.update(file_hash.encode('utf-8'))
-                else:
-                    print(f"Ошибка доступа к {file_path}")
-        return sha256.hexdigest()
+        with metrics.timer("ic_resource_hash_seconds", type="folder"):
+            return folder_digests(build_folder_manifest(folder_path, algorithm=algorithm, ignore=ignore), algorithm)["."]
     except Exception as e:
-        print(f"Ошибка при обработке папки {folder_path}: {e}")
+        metrics.inc("ic_hash_errors_total", kind="folder")
+        metrics.report(logging.WARNING, "Ошибка при обработке папки", f"Ошибка при обработке папки {folder_path}: {e}", path=folder_path, error=str(e))
         return None
 
 # Расчет хэша для ресурса
@@ -80,20 +923,327 @@ def hash_folder(folder_path: str) -> str:
 Если ресурс не существует, выводится сообщение об ошибке
 Если ресурс - файл, вызывается функция расчета хэша файла
 Если ресурс - папка, вызывается функция расчета хэша папки
+Хэш считается алгоритмом algorithm, в папке пропускаются пути по правилам ignore (по умолчанию IGNORE_PATTERNS)
 Возвращает применяемую функцию для ресурса
 """
-def calculate_hash(resource_path: str) -> str:
+def calculate_hash(resource_path: str, algorithm: str = DEFAULT_HASH_ALGORITHM, ignore: Iterable[str] = None) -> str:
     if not os.path.exists(resource_path):
         print(f"Файл/папка не существует: {resource_path}")
         return None
     if os.path.isfile(resource_path):
-        return hash_file(resource_path)
+        return hash_file(resource_path, algorithm)
     elif os.path.isdir(resource_path):
-        return hash_folder(resource_path)
+        return hash_folder(resource_path, algorithm, ignore)
     else:
         print(f"Неподдерживаемый тип: {resource_path}")
         return None
 
+# Отпечаток метаданных ресурса
+"""
+Для файла берется (размер, mtime_ns, ctime_ns, inode, устройство) из stat
+Для папки обходятся все вложенные файлы и папки (scan_folder): размер - суммарный, mtime_ns и ctime_ns - максимальные,
+inode и устройство - самой папки. Добавление, удаление, переименование и запись любого файла меняют отпечаток
+Пути папки, исключенные правилами ignore, не учитываются
+Чтение содержимого не выполняется
+Возвращает кортеж или None, если ресурс недоступен
+"""
+def get_fingerprint(resource_path: str, ignore: Iterable[str] = None) -> tuple:
+    try:
+        st = os.stat(resource_path)
+        if stat.S_ISREG(st.st_mode):
+            return (st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino, st.st_dev)
+        if not stat.S_ISDIR(st.st_mode):
+            return None
+        size, mtime_ns, ctime_ns = 0, st.st_mtime_ns, st.st_ctime_ns
+        for files, dirs in scan_folder(resource_path, ignore).values():
+            for entry in [entry for _, entry, _ in dirs] + [entry for _, entry in files]:
+                if entry is None:
+                    continue
+                if stat.S_ISREG(entry.st_mode):
+                    size += entry.st_size
+                mtime_ns = max(mtime_ns, entry.st_mtime_ns)
+                ctime_ns = max(ctime_ns, entry.st_ctime_ns)
+        return (size, mtime_ns, ctime_ns, st.st_ino, st.st_dev)
+    except OSError:
+        return None
+
+# Расчет хэша ресурса в рабочем потоке/процессе
+"""
+Задача - словарь с ключами path, host, algorithm, ignore, fingerprint, stored_files, sampled и sample_seed
+При совпавшем отпечатке содержимое не читается (или, если передан sampled, считается выборочный дайджест)
+Возвращает словарь с путем, хостом, хэшем, отпечатком, признаком перерасчета (rehashed) и объемом чтения (bytes),
+для папки - с манифестом (files) и хэшами поддеревьев (dirs), для выборочного эталона - с sample
+"""
+def _hash_worker(task: dict) -> dict:
+    resource_path = task["path"]
+    algorithm = task.get("algorithm") or DEFAULT_HASH_ALGORITHM
+    ignore = task.get("ignore", IGNORE_PATTERNS)
+    fingerprint = get_fingerprint(resource_path, ignore)
+    result = {"path": resource_path, "host": task.get("host"), "hash": None, "fingerprint": fingerprint, "rehashed": False, "bytes": 0}
+    fingerprint_matches = fingerprint is not None and task.get("fingerprint") == fingerprint
+    if task.get("sampled") and fingerprint_matches and os.path.isfile(resource_path):
+        seed, kind = task["sampled"]
+        with metrics.timer("ic_resource_hash_seconds", type="sampled"):
+            result["hash"], result["bytes"] = hash_file_sampled(resource_path, seed, kind)
+        result["sampled"] = True
+        return result
+    if fingerprint_matches and not task.get("sampled"):
+        return result
+    result["rehashed"] = True
+    if os.path.isdir(resource_path):
+        try:
+            stats = {}
+            with metrics.timer("ic_resource_hash_seconds", type="folder"):
+                files = build_folder_manifest(resource_path, task.get("stored_files"), algorithm, stats, ignore)
+                result["dirs"] = folder_digests(files, algorithm)
+            result["files"] = files
+            result["hash"] = result["dirs"]["."]
+            result["bytes"] = stats.get("bytes", 0)
+        except Exception as e:
+            metrics.inc("ic_hash_errors_total", kind="folder")
+            metrics.report(logging.WARNING, "Ошибка при обработке папки", f"Ошибка при обработке папки {resource_path}: {e}", path=resource_path, error=str(e))
+        return result
+    with metrics.timer("ic_resource_hash_seconds", type="file"):
+        result["hash"] = calculate_hash(resource_path, algorithm)
+    if result["hash"] and fingerprint:
+        result["bytes"] = fingerprint[0]
+    if result["hash"] and task.get("sample_seed") is not None and fingerprint and fingerprint[0] >= SAMPLE_MIN_SIZE:
+        kind = sample_kind(algorithm)
+        sample, read_bytes = hash_file_sampled(resource_path, task["sample_seed"], kind)
+        if sample:
+            result["sample"] = (sample, kind)
+            result["bytes"] += read_bytes
+    return result
+
+# Сообщение о результате по ресурсу
+"""
+Печатается, только если включен PRINT_RESOURCE_RESULTS, в журнал пишется на уровне DEBUG с полями fields
+"""
+def _resource_message(text: str, **fields) -> None:
+    if PRINT_RESOURCE_RESULTS:
+        print(text)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(text, extra=fields)
+
+# Отслеживание прогресса операции
+"""
+Считает обработанные ресурсы, прочитанные байты и текущий путь
+Рабочие потоки сообщают о прочитанных блоках через _on_read, в режиме процессов объем учитывается
+по завершении ресурса
+Не чаще раза в interval секунд (и в конце операции) вызывает callback со словарем:
+done, total - обработано ресурсов и всего, bytes - прочитано байт, rate - скорость, байт/сек,
+current - текущий путь, elapsed - прошло секунд, eta - оценка оставшегося времени, сек (None, если оценки нет)
+ETA считается по объему, если известен ожидаемый total_bytes, иначе по кол-ву ресурсов
+"""
+class ProgressTracker:
+    def __init__(self, callback: Callable[[dict], None], total: int, total_bytes: int = None, interval: float = PROGRESS_INTERVAL):
+        self.callback = callback
+        self.total = total
+        self.total_bytes = total_bytes or None
+        self.interval = interval
+        self.done = 0
+        self.bytes = 0
+        self.current = None
+        self.started = time.monotonic()
+        self._last_emit = 0
+        self._lock = threading.Lock()
+
+    # Прочитанные байты и текущий путь
+    def add_bytes(self, byte_count: int, current: str = None) -> None:
+        with self._lock:
+            self.bytes += byte_count
+            if current is not None:
+                self.current = current
+        self.emit()
+
+    # Завершение ресурса
+    def resource_done(self, resource_path: str, byte_count: int = 0) -> None:
+        with self._lock:
+            self.done += 1
+            self.bytes += byte_count
+            self.current = resource_path
+        self.emit()
+
+    # Уведомление о прогрессе
+    def emit(self, force: bool = False) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_emit < self.interval:
+                return
+            self._last_emit = now
+            elapsed = now - self.started
+            rate = self.bytes / elapsed if elapsed > 0 else 0
+            if self.total_bytes and rate > 0:
+                eta = max(0, self.total_bytes - self.bytes) / rate
+            elif self.done:
+                eta = elapsed * (self.total - self.done) / self.done
+            else:
+                eta = None
+            info = {"done": self.done, "total": self.total, "bytes": self.bytes, "rate": rate,
+                    "current": self.current, "elapsed": elapsed, "eta": eta}
+        self.callback(info)
+
+# Текстовое представление прогресса
+"""
+Возвращает строку вида "12/40, 1.5 ГБ, 85.3 МБ/с, осталось ~0:02:10"
+"""
+def format_progress(info: dict) -> str:
+    text = f"{info['done']}/{info['total']}, {info['bytes'] / 2**30:.2f} ГБ, {info['rate'] / 2**20:.1f} МБ/с"
+    if info["eta"] is not None:
+        eta = int(info["eta"])
+        text += f", осталось ~{eta // 3600}:{eta // 60 % 60:02d}:{eta % 60:02d}"
+    return text
+
+# Начало чтения файла в hash_file
+"""
+Если в текущем потоке выполняется задача с ProgressTracker или Throttle, сообщает им о файле
+Throttle может приостановить поток (ограничение кол-ва файлов, высокая нагрузка системы)
+"""
+def _on_file(file_path: str) -> None:
+    tracker = getattr(_worker_local, "tracker", None)
+    if tracker is not None:
+        tracker.add_bytes(0, file_path)
+    throttle = getattr(_worker_local, "throttle", None)
+    if throttle is not None:
+        throttle.file_started(getattr(_worker_local, "stop_flag", None))
+
+# Прочитан блок файла в hash_file
+def _on_read(byte_count: int) -> None:
+    tracker = getattr(_worker_local, "tracker", None)
+    if tracker is not None:
+        tracker.add_bytes(byte_count)
+    throttle = getattr(_worker_local, "throttle", None)
+    if throttle is not None:
+        throttle.bytes_read(byte_count, getattr(_worker_local, "stop_flag", None))
+
+# Расчет хэша ресурса с отслеживанием прогресса, ограничением нагрузки и кэшем хэшей
+"""
+stop_flag прерывает паузы throttle
+pooled=True - вызов из потока пула, созданного для операции: такой поток с idle_priority один раз переводится
+на низкий приоритет ввода-вывода. Приоритет потока нельзя вернуть без прав root, поэтому вызывающий поток
+(pooled=False) не понижается, а hash_resources при idle_priority всегда считает в пуле
+"""
+def _hash_worker_in_context(task: dict, tracker: ProgressTracker = None, throttle: Throttle = None, cache: HashCache = None, stop_flag: threading.Event = None, pooled: bool = False) -> dict:
+    _worker_local.tracker = tracker
+    _worker_local.throttle = throttle
+    _worker_local.cache = cache
+    _worker_local.stop_flag = stop_flag
+    if pooled and throttle is not None and throttle.idle_priority and not getattr(_worker_local, "idle", False):
+        _worker_local.idle = True
+        set_idle_priority()
+    try:
+        if tracker is not None:
+            tracker.add_bytes(0, task["path"])
+        return _hash_worker(task)
+    finally:
+        _worker_local.tracker = None
+        _worker_local.throttle = None
+        _worker_local.cache = None
+        _worker_local.stop_flag = None
+
+# Расчет хэша ресурса в потоке пула вызывающего кода
+"""
+Точка входа для внешних исполнителей (например, executor асинхронной проверки pipeline): задача в формате
+hash_resources, throttle, cache и stop_flag - как в hash_resources
+Поток считается потоком пула: при throttle с idle_priority он один раз переводится на низкий приоритет,
+поэтому executor должен быть выделен под расчет хэшей
+Возвращает словарь-результат задачи
+"""
+def hash_task(task: dict, throttle: Throttle = None, cache: HashCache = None, stop_flag: threading.Event = None) -> dict:
+    return _hash_worker_in_context(task, None, throttle, cache, stop_flag, pooled=True)
+
+_process_throttles = {} # Ограничения нагрузки в дочернем процессе пула: параметры -> Throttle
+
+# Расчет хэша ресурса в дочернем процессе с ограничением нагрузки
+"""
+Throttle не передается между процессами, поэтому каждый процесс создает свой по settings
+(доля общего ограничения, см. Throttle.settings)
+"""
+def _hash_worker_in_process(task: dict, settings: dict) -> dict:
+    key = tuple(sorted(settings.items()))
+    throttle = _process_throttles.get(key)
+    if throttle is None:
+        throttle = _process_throttles[key] = Throttle(**settings)
+    return _hash_worker_in_context(task, throttle=throttle, pooled=True)
+
+# Параллельный расчет хэшей для списка ресурсов
+"""
+Выполняет задачи _hash_worker в пуле потоков (или процессов) на workers исполнителей, передавая в пул не больше 2 * workers
+задач; stop_flag отменяет ожидающие задачи, progress, throttle и cache передаются рабочим потокам
+Возвращает генератор словарей-результатов _hash_worker в порядке готовности
+"""
+def hash_resources(tasks: Iterable[dict], stop_flag: threading.Event = None, workers: int = None, use_processes: bool = None, progress: ProgressTracker = None, throttle: Throttle = None, cache: HashCache = None) -> Iterator[dict]:
+    workers = workers or HASH_WORKERS
+    use_processes = HASH_USE_PROCESSES if use_processes is None else use_processes
+    in_processes = use_processes and workers > 1
+    tasks = iter(tasks)
+    # В процессах прогресс по блокам недоступен, объем учитывается по завершении ресурса
+    live_progress = progress is not None and not in_processes
+    in_context = live_progress or ((throttle is not None or cache is not None) and not in_processes)
+
+    def submit(executor, task: dict):
+        if in_processes and throttle is not None:
+            return executor.submit(_hash_worker_in_process, task, throttle.settings(workers))
+        if in_context:
+            return executor.submit(_hash_worker_in_context, task, progress if live_progress else None, throttle, cache, stop_flag, True)
+        return executor.submit(_hash_worker, task)
+
+    def finished(result: dict) -> dict:
+        if progress is not None:
+            progress.resource_done(result["path"], 0 if live_progress else result.get("bytes", 0))
+        return result
+
+    # Один исполнитель - считаем в текущем потоке без накладных расходов на пул
+    # С idle_priority и одним исполнителем создается пул из одного потока, чтобы не понижать приоритет вызывающего
+    if workers <= 1 and not (throttle is not None and throttle.idle_priority):
+        for task in tasks:
+            if stop_flag and stop_flag.is_set():
+                return
+            if in_context:
+                yield finished(_hash_worker_in_context(task, progress if live_progress else None, throttle, cache, stop_flag))
+            else:
+                yield finished(_hash_worker(task))
+        return
+
+    executor_class = ProcessPoolExecutor if in_processes else ThreadPoolExecutor
+    executor = executor_class(max_workers=workers)
+    pending = set()
+    try:
+        while True:
+            # Пополнение очереди задач
+            while len(pending) < workers * 2 and not (stop_flag and stop_flag.is_set()):
+                task = next(tasks, None)
+                if task is None:
+                    break
+                pending.add(submit(executor, task))
+            if not pending or (stop_flag and stop_flag.is_set()):
+                return
+            done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in done:
+                if stop_flag and stop_flag.is_set():
+                    return
+                yield finished(future.result())
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# Кэш хэшей на время операции
+"""
+persist=True - записи дополнительно читаются и сохраняются в файл hashcache.HASH_CACHE_PATH (если он задан)
+Полная проверка и расчет эталонов не доверяют хэшам прошлых запусков и используют только кэш в памяти
+Возвращает HashCache или None, если кэш отключен (HASH_CACHE_ENABLED)
+"""
+def open_hash_cache(persist: bool = False) -> HashCache:
+    if not HASH_CACHE_ENABLED:
+        return None
+    return HashCache(path=hashcache.HASH_CACHE_PATH if persist else None)
+
+# Закрытие кэша хэшей операции
+def close_hash_cache(cache: HashCache) -> None:
+    if cache is None:
+        return
+    cache.close()
+    logger.info("Кэш хэшей", extra={"hits": cache.hits, "misses": cache.misses})
+
 # Извлечение имени ресурса из пути
 """
 Функция извлекает имя ресурса из строки пути
@@ -113,141 +1263,596 @@ def get_resource_name(resource_path: str) -> str:
 Получает имя ресурса, тип ресурса, текущее системное время
 Проверяет наличие ресурса в системе
 Подключение к БД
-Получает кол-во таких же ресурсов в БД, если он уже есть в БД, то ресурс пропускается
-Если ресурса нет в БД, то он в нее добавляется
+Ресурс без хоста добавляется одним INSERT ... ON CONFLICT DO NOTHING по ключу (хост, путь) (RESOURCE_CONFLICT),
+если он уже есть в БД, то ресурс пропускается
+ignore_patterns - правила исключения папки-ресурса (glob, см. IGNORE_PATTERNS)
 """
-def add_resource_to_db(conn, resource_path: str) -> bool:
-    resource_name = get_resource_name(resource_path)
-    resource_type = "file" if os.path.isfile(resource_path) else "folder" if os.path.isdir(resource_path) else None
-    current_time = datetime.now()
-
-    if not resource_name or not resource_type or not os.path.exists(resource_path):
+def add_resource_to_db(conn, resource_path: str, ignore_patterns: list = None) -> bool:
+    row = _resource_row(resource_path, ignore_patterns)
+    if row is None:
         print(f"Не удалось добавить ресурс {resource_path}")
         return False
 
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT COUNT(*) FROM resource_monitoring WHERE resource_path = %s", (resource_path,))
-            count = cur.fetchone()[0]
-
-            if count > 0:
-                print(f"Ресурс {resource_path} уже существует в базе данных")
-                return False
-
-            cur.execute("""
-                INSERT INTO resource_monitoring (resource_path, resource_name, resource_type, added_date)
-                VALUES (%s, %s, %s, %s)
-            """, (resource_path, resource_name, resource_type, current_time))
+            cur.execute(f"""
+                INSERT INTO resource_monitoring (resource_path, resource_name, resource_type, added_date, ignore_patterns)
+                VALUES (%s, %s, %s, %s, %s)
+                {RESOURCE_CONFLICT} DO NOTHING
+            """, row)
+            added = cur.rowcount > 0
             conn.commit()
-            print(f"Ресурс {resource_path} успешно добавлен в БД")
-            return True
+            if added:
+                print(f"Ресурс {resource_path} успешно добавлен в БД")
+            else:
+                print(f"Ресурс {resource_path} уже существует в базе данных")
+            return added
     except psycopg2.Error as e:
         print(f"Ошибка при записи в БД для {resource_path}: {e}")
         conn.rollback()
         return False
 
-# Обновление хэшей для всех ресурсов
+# Строка нового ресурса
 """
-Подлкючается к БД
-Для всех ресурсов из БД получает путь, вычисляет новый хэш, обновляет значение хэша в БД
-Позволяет остановаить работу функции, которая работает в отдельном потоке
-Возвращает кол-во обновленных хэшей
+Возвращает (путь, имя, тип, дата добавления, правила исключения) или None, если ресурс недоступен
+Правила исключения сохраняются только для папок
+"""
+def _resource_row(resource_path: str, ignore_patterns: list = None) -> tuple:
+    resource_name = get_resource_name(resource_path)
+    resource_type = "file" if os.path.isfile(resource_path) else "folder" if os.path.isdir(resource_path) else None
+    if not resource_name or not resource_type:
+        return None
+    ignore_patterns = list(ignore_patterns) if ignore_patterns and resource_type == "folder" else None
+    return resource_path, resource_name, resource_type, datetime.now(), ignore_patterns
+
+# Поиск ресурсов в папке
+"""
+Рекурсивно обходит root (recursive=False - только верхний уровень) и возвращает пути файлов,
+подходящих под шаблоны include (None - все файлы) и не попадающих под шаблоны exclude
+Шаблоны сопоставляются так же, как правила исключения (см. IGNORE_PATTERNS), пути - относительно root
+Исключенные папки не обходятся
+Возвращает генератор абсолютных путей в порядке обхода
+"""
+def discover_resources(root: str, include: Iterable[str] = None, exclude: Iterable[str] = None, recursive: bool = True) -> Iterator[str]:
+    root = os.path.abspath(root)
+    include = list(include or ())
+    for folder, dirs, files in walk_folder(root, exclude):
+        dirs.sort()
+        if not recursive:
+            dirs[:] = []
+        for filename in sorted(files):
+            file_path = os.path.join(folder, filename)
+            if not include or is_ignored(os.path.relpath(file_path, root), include):
+                yield file_path
+
+# Массовое добавление ресурсов
+"""
+Ресурсы записываются пачками по batch_size через execute_values с INSERT ... ON CONFLICT DO NOTHING по ключу
+(хост, путь), каждая пачка фиксируется отдельно. Уже добавленные на этот хост пути и дубликаты во входных данных пропускаются
+Недоступные пути не добавляются
+ignore_patterns - правила исключения, сохраняемые для добавляемых папок
+host - хост агента, который будет проверять ресурсы (см. agents.run_agent), пути проверяются на текущем хосте,
+поэтому ресурсы добавляются на том хосте, где они находятся
+Обрабатываются ошибки при записи в БД, при ошибке теряется только эта пачка
+Возвращает словарь со списками added (добавлены), existing (уже были в БД) и failed (недоступны или ошибка записи)
+"""
+def add_resources_bulk(conn, resource_paths: Iterable[str], ignore_patterns: list = None, batch_size: int = None, host: str = None) -> dict:
+    batch_size = batch_size or BULK_INSERT_BATCH_SIZE
+    results = {"added": [], "existing": [], "failed": []}
+    batch = []
+
+    def flush():
+        try:
+            with conn.cursor() as cur:
+                added = psycopg2.extras.execute_values(cur, f"""
+                    INSERT INTO resource_monitoring (resource_path, resource_name, resource_type, added_date, ignore_patterns, host)
+                    VALUES %s
+                    {RESOURCE_CONFLICT} DO NOTHING
+                    RETURNING resource_path
+                """, [(*row, host) for row in batch], page_size=len(batch), fetch=True)
+            conn.commit()
+            added = {path for path, in added}
+            for row in batch:
+                results["added" if row[0] in added else "existing"].append(row[0])
+        except psycopg2.Error as e:
+            print(f"Ошибка при добавлении пачки из {len(batch)} ресурсов в БД: {e}")
+            conn.rollback()
+            results["failed"].extend(row[0] for row in batch)
+        batch.clear()
+
+    seen = set()
+    with metrics.timer("ic_bulk_add_seconds"):
+        for resource_path in resource_paths:
+            resource_path = os.path.abspath(resource_path)
+            if resource_path in seen:
+                continue
+            seen.add(resource_path)
+            row = _resource_row(resource_path, ignore_patterns)
+            if row is None:
+                results["failed"].append(resource_path)
+                continue
+            batch.append(row)
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+    logger.info("Массовое добавление завершено", extra={"added": len(results["added"]), "existing": len(results["existing"]), "failed": len(results["failed"])})
+    return results
+
+# Сохранение манифестов папок
+"""
+На вход подается список четверок (путь ресурса, хост ресурса, файлы манифеста, хэши поддеревьев)
+Удаляет прежние манифесты этих ресурсов (по ключу хост, путь) из resource_files одним запросом
+Записывает строки 'file' для каждого файла и строки 'dir' с хэшами поддеревьев пачкой через execute_values
+Вызывается внутри транзакции вызывающей функции
+"""
+def save_folder_manifests(cur, manifests: list) -> None:
+    if not manifests:
+        return
+    cur.execute("""
+        DELETE FROM resource_files f
+        USING unnest(%s::text[], %s::text[]) AS m(host_key, resource_path)
+        WHERE COALESCE(f.host, '') = m.host_key AND f.resource_path = m.resource_path
+    """, ([host or "" for _, host, _, _ in manifests], [resource_path for resource_path, _, _, _ in manifests]))
+    rows = []
+    for resource_path, host, files, dirs in manifests:
+        rows += [(resource_path, host, rel_path, "file", size, mtime_ns, file_hash) for rel_path, size, mtime_ns, file_hash in files]
+        rows += [(resource_path, host, rel_dir, "dir", None, None, dir_hash) for rel_dir, dir_hash in dirs.items()]
+    psycopg2.extras.execute_values(cur, """
+        INSERT INTO resource_files (resource_path, host, rel_path, entry_type, file_size, file_mtime_ns, hash)
+        VALUES %s
+    """, rows, page_size=1000)
+
+# Запись пачки новых эталонов
+"""
+На вход подаются строки (путь, хэш, алгоритм, дата хэша, размер, mtime_ns, ctime_ns, inode, устройство,
+выборочный эталон, вид, seed, хост) и манифесты папок из этой пачки (см. save_folder_manifests)
+Строки сопоставляются с ресурсами по ключу (хост, путь)
+Строки загружаются во временную таблицу hash_updates через execute_values
+Прежние эталоны, отличающиеся от новых, переносятся в hash_history одним INSERT ... SELECT
+Эталоны обновляются одним UPDATE ... FROM, затем пачка фиксируется
+Обрабатываются ошибки при записи в БД, при ошибке теряется только эта пачка
+Возвращает кол-во записанных эталонов
 """
-def update_all_hashes(conn, stop_flag: threading.Event = None) -> int:
+def _flush_hash_updates(conn, rows: list, manifests: list) -> int:
+    if not rows:
+        return 0
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT resource_path FROM resource_monitoring")
-            resources = cur.fetchall()
-
-            if not resources:
-                print("В базе данных нет ресурсов для расчета хэшей")
-                return 0
+            cur.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS hash_updates (
+                    resource_path TEXT,
+                    hash TEXT,
+                    hash_algorithm TEXT,
+                    hash_date TIMESTAMP,
+                    file_size BIGINT,
+                    file_mtime_ns BIGINT,
+                    file_ctime_ns BIGINT,
+                    file_inode BIGINT,
+                    file_device BIGINT,
+                    sample_hash TEXT,
+                    sample_kind TEXT,
+                    sample_seed BIGINT,
+                    host TEXT
+                ) ON COMMIT DELETE ROWS
+            """)
+            psycopg2.extras.execute_values(cur, "INSERT INTO hash_updates VALUES %s", rows, page_size=1000)
+            cur.execute("""
+                INSERT INTO hash_history (resource_path, host, hash, hash_algorithm, hash_date, archived_date)
+                SELECT r.resource_path, r.host, r.hash, r.hash_algorithm, r.hash_date, u.hash_date
+                FROM resource_monitoring r
+                JOIN hash_updates u ON u.resource_path = r.resource_path AND COALESCE(u.host, '') = COALESCE(r.host, '')
+                WHERE r.hash IS NOT NULL AND (r.hash <> u.hash OR r.hash_algorithm <> u.hash_algorithm)
+            """)
+            cur.execute("""
+                UPDATE resource_monitoring r
+                SET hash = u.hash, hash_algorithm = u.hash_algorithm, hash_date = u.hash_date,
+                    file_size = u.file_size, file_mtime_ns = u.file_mtime_ns, file_ctime_ns = u.file_ctime_ns,
+                    file_inode = u.file_inode, file_device = u.file_device,
+                    sample_hash = u.sample_hash, sample_kind = u.sample_kind, sample_seed = u.sample_seed
+                FROM hash_updates u
+                WHERE r.resource_path = u.resource_path AND COALESCE(r.host, '') = COALESCE(u.host, '')
+            """)
+            save_folder_manifests(cur, manifests)
+        conn.commit()
+        return len(rows)
+    except psycopg2.Error as e:
+        print(f"Ошибка при записи пачки из {len(rows)} хэшей в БД: {e}")
+        conn.rollback()
+        return 0
 
-            updated_count = 0
-            for (resource_path,) in resources:
-                if stop_flag and stop_flag.is_set():
-                    print("Расчёт хэшей остановлен")
-                    return updated_count
-                hash_value = calculate_hash(resource_path)
-                if hash_value:
-                    current_time = datetime.now()
-                    cur.execute("""
-                        UPDATE resource_monitoring
-                        SET hash = %s, hash_date = %s
-                        WHERE resource_path = %s
-                    """, (hash_value, current_time, resource_path))
-                    updated_count += 1
-                else:
-                    print(f"Не удалось рассчитать хэш для {resource_path}, пропускаем")
+# Загрузка манифеста папки
+"""
+Получает из resource_files строки манифеста ресурса с ключом (host, resource_path)
+Возвращает пару словарей: файлы rel_path -> (размер, mtime_ns, хэш) и папки rel_path -> хэш поддерева
+"""
+def load_folder_manifest(conn, resource_path: str, host: str = None) -> tuple:
+    files, dirs = {}, {}
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT rel_path, entry_type, file_size, file_mtime_ns, hash
+            FROM resource_files
+            WHERE COALESCE(host, '') = %s AND resource_path = %s
+        """, (host or "", resource_path))
+        for rel_path, entry_type, size, mtime_ns, entry_hash in cur.fetchall():
+            if entry_type == "dir":
+                dirs[rel_path] = entry_hash
+            else:
+                files[rel_path] = (size, mtime_ns, entry_hash)
+    return files, dirs
 
+# Потоковое чтение результата запроса
+"""
+Выполняет запрос через именованный (серверный) курсор: строки приходят с сервера порциями по RESOURCE_ITERSIZE,
+поэтому обработка начинается сразу, а память не зависит от размера таблицы
+withhold=True - курсор переживает commit (нужно, если во время чтения фиксируются транзакции); транзакция
+с объявлением курсора сразу фиксируется, иначе откат первой же пачки (rollback) уничтожил бы курсор
+Курсор закрывается, когда генератор исчерпан или закрыт (close())
+Возвращает генератор строк
+"""
+def stream_query(conn, query: str, params=None, withhold: bool = False) -> Iterator[tuple]:
+    with conn.cursor(name=f"ic_stream_{next(_cursor_names)}", withhold=withhold) as cur:
+        cur.itersize = RESOURCE_ITERSIZE
+        cur.execute(query, params)
+        if withhold:
             conn.commit()
-            print(f"Хэши успешно рассчитаны и обновлены для {updated_count} ресурсов")
-            return updated_count
+        yield from cur
+
+# Кол-во ресурсов и их суммарный сохраненный размер
+"""
+Учитываются ресурсы хоста host (по умолчанию LOCAL_HOST, см. host_scope)
+Если передан resource_paths, учитываются только эти ресурсы
+Возвращает (кол-во, размер в байтах)
+"""
+def count_resources(conn, resource_paths: list = None, host: str = None) -> tuple:
+    query, params = scoped_resources_query("SELECT COUNT(*), COALESCE(SUM(file_size), 0) FROM resource_monitoring", resource_paths, host)
+    with conn.cursor() as cur:
+        cur.execute(query, params)
+        return cur.fetchone()
+
+# Запрос к ресурсам хоста
+"""
+Добавляет к запросу условие host_scope для хоста host (по умолчанию LOCAL_HOST) и, если передан resource_paths,
+отбор по путям
+Возвращает (запрос, параметры)
+"""
+def scoped_resources_query(query: str, resource_paths: list = None, host: str = None) -> tuple:
+    query += " WHERE " + host_scope()
+    params = [host or LOCAL_HOST]
+    if resource_paths is not None:
+        query += " AND resource_path = ANY(%s)"
+        params.append(list(resource_paths))
+    return query, params
+
+# Обновление хэшей для всех ресурсов
+"""
+Пересчитывает эталоны ресурсов хоста host (см. host_scope) в пуле и записывает их пачками по batch_size,
+прежние эталоны переносятся в hash_history; algorithm - перевод эталонов на новый алгоритм
+Позволяет остановаить работу функции, которая работает в отдельном потоке, уже рассчитанные хэши при этом сохраняются
+Возвращает кол-во обновленных хэшей
+"""
+def update_all_hashes(conn, stop_flag: threading.Event = None, workers: int = None, use_processes: bool = None, algorithm: str = None, batch_size: int = None, progress_callback: Callable[[dict], None] = None, throttle: Throttle = None, host: str = None) -> int:
+    if algorithm is not None and algorithm not in HASH_ALGORITHMS:
+        print(f"Алгоритм хэширования {algorithm} недоступен")
+        return 0
+    batch_size = batch_size or UPDATE_BATCH_SIZE
+    started = time.monotonic()
+    try:
+        total, total_bytes = count_resources(conn, host=host)
     except psycopg2.Error as e:
         print(f"Ошибка при обновлении хэшей в БД: {e}")
         conn.rollback()
         return 0
 
+    if not total:
+        print("В базе данных нет ресурсов для расчета хэшей")
+        return 0
+
+    updated_count = 0
+    rows, manifests, pending_size = [], [], 0
+    algorithms = {} # Алгоритмы ресурсов, переданных в пул и еще не рассчитанных, по ключу (хост, путь)
+    seeds = {} # seed выборочных эталонов этих ресурсов
+
+    # Пачки фиксируются во время чтения, поэтому курсор создается с withhold
+    query, params = scoped_resources_query("SELECT resource_path, hash_algorithm, ignore_patterns, sample_seed, host FROM resource_monitoring", host=host)
+    resource_rows = stream_query(conn, query, params, withhold=True)
+    def generate_tasks():
+        for resource_path, stored_algorithm, ignore_patterns, sample_seed, resource_host in resource_rows:
+            key = (resource_host, resource_path)
+            algorithms[key] = algorithm or stored_algorithm
+            seeds[key] = sample_seed if sample_seed is not None else secrets.randbits(63)
+            yield {"path": resource_path, "host": resource_host, "algorithm": algorithms[key],
+                   "ignore": resource_ignore_rules(ignore_patterns), "sample_seed": seeds[key]}
+
+    progress = None
+    if progress_callback is not None:
+        progress = ProgressTracker(progress_callback, total, total_bytes)
+    cache = open_hash_cache()
+    try:
+        for result in hash_resources(generate_tasks(), stop_flag, workers, use_processes, progress, throttle, cache):
+            resource_path, resource_host, hash_value = result["path"], result["host"], result["hash"]
+            resource_algorithm = algorithms.pop((resource_host, resource_path))
+            seed = seeds.pop((resource_host, resource_path))
+            if not hash_value:
+                _resource_message(f"Не удалось рассчитать хэш для {resource_path}, пропускаем", path=resource_path, status="unavailable")
+                continue
+            fingerprint = result["fingerprint"] or (None,) * 5
+            sample, kind = result.get("sample") or (None, None)
+            rows.append((resource_path, hash_value, resource_algorithm, datetime.now(), *fingerprint, sample, kind, seed, resource_host))
+            pending_size += 1
+            if "files" in result:
+                manifests.append((resource_path, resource_host, result["files"], result["dirs"]))
+                pending_size += len(result["files"]) + len(result["dirs"])
+            if pending_size >= batch_size:
+                updated_count += _flush_hash_updates(conn, rows, manifests)
+                rows, manifests, pending_size = [], [], 0
+    except psycopg2.Error as e:
+        print(f"Ошибка при чтении ресурсов из БД: {e}")
+        conn.rollback()
+    finally:
+        resource_rows.close()
+        close_hash_cache(cache)
+    updated_count += _flush_hash_updates(conn, rows, manifests)
+    if progress is not None:
+        progress.emit(force=True)
+
+    stopped = bool(stop_flag and stop_flag.is_set())
+    logger.info("Расчёт эталонов завершён", extra={"updated": updated_count, "total": total, "stopped": stopped,
+                                                  "seconds": round(time.monotonic() - started, 3)})
+    if stopped:
+        print(f"Расчёт хэшей остановлен, сохранено {updated_count} хэшей")
+        return updated_count
+
+    print(f"Хэши успешно рассчитаны и обновлены для {updated_count} ресурсов")
+    return updated_count
+
 # Проверка хэшей для всех ресурсов
 """
-Подключается к БД
-Для всех ресурсов из БД получает путь, вычисляет текущий хэш и сравнивает его с хэшем из БД
-Позволяет остановаить работу функции, которая работает в отдельном потоке
-Для каждого ресурса пишет результат проверки
-Возвращает словарь с результатами проверки
+Сравнивает текущие хэши ресурсов хоста host (см. host_scope) с эталонами в режиме mode (CHECK_MODE_*),
+обновляет отпечатки и расписание, при record=True сохраняет проверку в check_runs и check_results
+resource_paths - проверить только эти ресурсы, changes - словарь для изменений в папках
+Возвращает словарь {(хост, путь): статус}
 """
-def check_all_hashes(conn, stop_flag: threading.Event = None) -> dict:
+def check_all_hashes(conn, stop_flag: threading.Event = None, workers: int = None, use_processes: bool = None, mode: str = CHECK_MODE_PARANOID, changes: dict = None, record: bool = True, resource_paths: list = None, progress_callback: Callable[[dict], None] = None, default_interval: int = None, throttle: Throttle = None, agent_id: str = None, host: str = None) -> dict:
+    host = host or LOCAL_HOST
     results = {}
+    started_at = datetime.now()
+    result_rows = []
+    bytes_hashed = 0
+    cache = open_hash_cache(persist=mode in (CHECK_MODE_FAST, CHECK_MODE_SAMPLED))
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT resource_path, hash FROM resource_monitoring")
-            resources = cur.fetchall()
-
-            if not resources:
+            total, total_bytes = count_resources(conn, resource_paths, host)
+            if not total:
                 print("В базе данных нет ресурсов для проверки")
                 return results
 
-            for resource_path, stored_hash in resources:
-                if stop_flag and stop_flag.is_set():
-                    print("Проверка целостности остановлена пользователем")
-                    return results
-                current_hash = calculate_hash(resource_path)
-                if current_hash is None:
-                    print(f"Ресурс {resource_path}: невозможно проверить (ресурс недоступен)")
-                    results[resource_path] = "unavailable"
-                elif stored_hash is None:
-                    print(f"Ресурс {resource_path}: хэш в БД отсутствует")
-                    results[resource_path] = "no_hash"
-                elif current_hash == stored_hash:
-                    print(f"Ресурс {resource_path}: целостность подтверждена")
-                    results[resource_path] = "passed"
-                else:
-                    print(f"Ресурс {resource_path}: целостность нарушена (хэш изменился)")
-                    results[resource_path] = "failed"
+            query, params = scoped_resources_query("""
+                SELECT resource_path, host, hash, hash_algorithm, ignore_patterns, sample_hash, sample_kind, sample_seed,
+                       file_size, file_mtime_ns, file_ctime_ns, file_inode, file_device
+                FROM resource_monitoring
+            """, resource_paths, host)
+
+            # Эталоны и отпечатки ресурсов, переданных в пул и еще не проверенных, по ключу (хост, путь)
+            stored = {}
+            # Отпечаток и манифест передаются в задачу только в быстром режиме и только при наличии эталона
+            # Манифесты загружаются по мере того, как пул забирает задачи
+            manifests = {}
+            def generate_tasks():
+                for resource_path, resource_host, stored_hash, stored_algorithm, ignore_patterns, sample_hash, kind, seed, *fingerprint in stream_query(conn, query, params):
+                    key = (resource_host, resource_path)
+                    fingerprint = tuple(fingerprint) if None not in fingerprint else None
+                    task = {"path": resource_path, "host": resource_host, "algorithm": stored_algorithm, "ignore": resource_ignore_rules(ignore_patterns)}
+                    if mode == CHECK_MODE_SAMPLED and sample_hash and stored_hash:
+                        # При прежнем отпечатке сравнивается выборочный эталон, при изменившемся - полный хэш
+                        stored[key] = (stored_hash, fingerprint, sample_hash)
+                        task["sampled"] = (seed, kind)
+                        task["fingerprint"] = fingerprint
+                        yield task
+                        continue
+                    stored[key] = (stored_hash, fingerprint, None)
+                    if stored_hash and os.path.isdir(resource_path):
+                        manifests[key] = load_folder_manifest(conn, resource_path, resource_host)
+                    if stored_hash and mode in (CHECK_MODE_FAST, CHECK_MODE_SAMPLED):
+                        task["fingerprint"] = fingerprint
+                        if key in manifests:
+                            task["stored_files"] = manifests[key][0]
+                    yield task
+
+            progress = None
+            if progress_callback is not None:
+                progress = ProgressTracker(progress_callback, total, total_bytes if mode == CHECK_MODE_PARANOID else None)
 
+            fingerprint_updates = []
+            checked_paths = []
+            # Запись накопленных отпечатков и расписания (без фиксации, она в конце проверки)
+            def flush_updates():
+                if fingerprint_updates:
+                    psycopg2.extras.execute_values(cur, """
+                        UPDATE resource_monitoring r
+                        SET file_size = v.file_size, file_mtime_ns = v.file_mtime_ns, file_ctime_ns = v.file_ctime_ns,
+                            file_inode = v.file_inode, file_device = v.file_device
+                        FROM (VALUES %s) AS v(resource_path, host_key, file_size, file_mtime_ns, file_ctime_ns, file_inode, file_device)
+                        WHERE r.resource_path = v.resource_path AND COALESCE(r.host, '') = v.host_key
+                    """, fingerprint_updates, template="(%s, %s, %s::bigint, %s::bigint, %s::bigint, %s::bigint, %s::bigint)", page_size=1000)
+                    fingerprint_updates.clear()
+                # Следующая проверка по расписанию
+                if checked_paths:
+                    checked_at = datetime.now()
+                    cur.execute(f"""
+                        UPDATE resource_monitoring
+                        SET last_checked = %s, next_check = %s + COALESCE(check_interval, %s) * INTERVAL '1 second'
+                        WHERE resource_path = ANY(%s) AND {host_scope()}
+                    """, (checked_at, checked_at, default_interval or SCHEDULE_DEFAULT_INTERVAL, checked_paths, host))
+                    checked_paths.clear()
+
+            tasks = generate_tasks()
+            for result in hash_resources(tasks, stop_flag, workers, use_processes, progress, throttle, cache):
+                resource_path = result["path"]
+                key = (result["host"], resource_path)
+                bytes_hashed += result.get("bytes", 0)
+                stored_hash, stored_fingerprint, sample_hash = stored.pop(key)
+                if result.get("sampled"):
+                    stored_hash = sample_hash
+                results[key], resource_changes, fingerprint = evaluate_check_result(
+                    result, stored_hash, stored_fingerprint, manifests.pop(key, None))
+                if fingerprint:
+                    fingerprint_updates.append((resource_path, result["host"] or "", *fingerprint))
+                if resource_changes and changes is not None:
+                    changes[key] = resource_changes
+                metrics.inc("ic_check_results_total", status=results[key], mode=mode)
+                result_rows.append((resource_path, results[key], datetime.now(), json.dumps(resource_changes) if resource_changes else None, result["host"]))
+                checked_paths.append(resource_path)
+                if len(checked_paths) >= UPDATE_BATCH_SIZE:
+                    flush_updates()
+            # При остановке серверный курсор закрывается до фиксации
+            tasks.close()
+            flush_updates()
+
+            if progress is not None:
+                progress.emit(force=True)
+            stopped = bool(stop_flag and stop_flag.is_set())
+            if stopped:
+                print("Проверка целостности остановлена пользователем")
             conn.commit()
-            return results
     except psycopg2.Error as e:
         print(f"Ошибка при проверке хэшей в БД: {e}")
         conn.rollback()
         return results
+    finally:
+        close_hash_cache(cache)
+
+    duration = (datetime.now() - started_at).total_seconds()
+    metrics.observe("ic_check_seconds", duration, mode=mode)
+    counts = {}
+    for status in results.values():
+        counts[status] = counts.get(status, 0) + 1
+    logger.info("Проверка целостности завершена", extra={"mode": mode, "seconds": round(duration, 3), "bytes": bytes_hashed,
+                                                         "counts": counts, "stopped": stopped})
+    if record:
+        save_check_run(conn, started_at, mode, results, result_rows, bytes_hashed, stopped, agent_id, host)
+    return results
+
+# Оценка результата проверки ресурса
+"""
+result - результат _hash_worker, stored_hash и stored_fingerprint - эталон и отпечаток из БД,
+stored_manifest - сохраненный манифест папки (файлы, папки) из load_folder_manifest или None
+Пишет результат по ресурсу (нарушения печатаются всегда)
+При нарушении в папке с манифестом сравнивает манифесты и печатает изменения
+Возвращает (статус, изменения или None, новый отпечаток для записи в БД или None)
+"""
+def evaluate_check_result(result: dict, stored_hash: str, stored_fingerprint: tuple, stored_manifest: tuple = None) -> tuple:
+    resource_path = result["path"]
+    current_hash = result["hash"] if result["rehashed"] or result.get("sampled") else stored_hash
+    if current_hash is None:
+        _resource_message(f"Ресурс {resource_path}: невозможно проверить (ресурс недоступен)", path=resource_path, status="unavailable")
+        return "unavailable", None, None
+    if stored_hash is None:
+        _resource_message(f"Ресурс {resource_path}: хэш в БД отсутствует", path=resource_path, status="no_hash")
+        return "no_hash", None, None
+    if current_hash == stored_hash:
+        _resource_message(f"Ресурс {resource_path}: целостность подтверждена", path=resource_path, status="passed")
+        if result["fingerprint"] and result["fingerprint"] != stored_fingerprint:
+            return "passed", None, result["fingerprint"]
+        return "passed", None, None
+    metrics.report(logging.WARNING, "Целостность нарушена", f"Ресурс {resource_path}: целостность нарушена (хэш изменился)", path=resource_path, status="failed")
+    stored_files, stored_dirs = stored_manifest or ({}, {})
+    if not (stored_files and "files" in result):
+        return "failed", None, None
+    current_files = {rel_path: (size, mtime_ns, file_hash) for rel_path, size, mtime_ns, file_hash in result["files"]}
+    # Сравниваются только хэши, размер и mtime не считаются изменением содержимого
+    resource_changes = diff_manifests(
+        {rel_path: entry[2] for rel_path, entry in stored_files.items()}, stored_dirs,
+        {rel_path: entry[2] for rel_path, entry in current_files.items()}, result["dirs"]
+    )
+    for kind, label in (("added", "добавлен"), ("removed", "удалён"), ("modified", "изменён")):
+        for rel_path in resource_changes[kind]:
+            print(f"    {label}: {rel_path}")
+    return "failed", resource_changes, None
+
+# Колонки записи проверки в check_runs и check_results
+CHECK_RUN_COLUMNS = ("started_at", "finished_at", "duration_seconds", "check_mode", "total_count", "passed_count",
+                     "failed_count", "unavailable_count", "no_hash_count", "bytes_hashed", "stopped", "agent_id", "host")
+CHECK_RESULT_COLUMNS = ("run_id", "resource_path", "status", "checked_at", "details", "resource_host", "host", "agent_id")
+
+# Запросы сохранения проверки
+"""
+Общие для save_check_run и хранилищ pipeline, поэтому состав записи проверки задается в одном месте
+results_values - подстановка значений check_results: "%s" для execute_values, None - строка из %s по кол-ву колонок
+(для executemany)
+Возвращает (INSERT в check_runs с RETURNING run_id, INSERT в check_results)
+"""
+def check_run_queries(results_values: str = None) -> tuple:
+    run_query = f"""
+        INSERT INTO check_runs ({", ".join(CHECK_RUN_COLUMNS)})
+        VALUES ({", ".join(["%s"] * len(CHECK_RUN_COLUMNS))})
+        RETURNING run_id
+    """
+    results_values = results_values or f"({', '.join(['%s'] * len(CHECK_RESULT_COLUMNS))})"
+    results_query = f"INSERT INTO check_results ({', '.join(CHECK_RESULT_COLUMNS)}) VALUES {results_values}"
+    return run_query, results_query
+
+# Значения записи в check_runs
+"""
+Время окончания - текущее, кол-во ресурсов по статусам считается по results
+Возвращает кортеж в порядке CHECK_RUN_COLUMNS
+"""
+def check_run_values(started_at: datetime, mode: str, results: dict, bytes_hashed: int = 0, stopped: bool = False, agent_id: str = None, host: str = None) -> tuple:
+    finished_at = datetime.now()
+    statuses = list(results.values())
+    return (started_at, finished_at, (finished_at - started_at).total_seconds(), mode, len(statuses),
+            statuses.count("passed"), statuses.count("failed"), statuses.count("unavailable"),
+            statuses.count("no_hash"), bytes_hashed, stopped, agent_id, host or LOCAL_HOST)
+
+# Значения записей в check_results
+"""
+result_rows - строки (путь, статус, время, изменения в JSON, хост ресурса), к ним добавляются проверка,
+хост и агент проверки
+Возвращает список кортежей в порядке CHECK_RESULT_COLUMNS
+"""
+def check_result_values(run_id: int, result_rows: list, agent_id: str = None, host: str = None) -> list:
+    host = host or LOCAL_HOST
+    return [(run_id, *row, host, agent_id) for row in result_rows]
+
+# Сохранение результатов проверки
+"""
+Создает запись о проверке в check_runs: время начала и окончания, длительность, режим, кол-во ресурсов по статусам,
+объем прочитанных данных, признак остановки, агент (None - проверка не агентом) и хост (по умолчанию LOCAL_HOST)
+Записывает результаты по ресурсам (путь, статус, время, изменения в JSON, хост ресурса, хост и агент) в check_results одним execute_values
+Запросы и значения - check_run_queries, check_run_values и check_result_values
+Обрабатываются ошибки при записи в БД
+Возвращает идентификатор проверки или None
+"""
+def save_check_run(conn, started_at: datetime, mode: str, results: dict, result_rows: list, bytes_hashed: int = 0, stopped: bool = False, agent_id: str = None, host: str = None) -> int:
+    run_query, results_query = check_run_queries("%s")
+    try:
+        with conn.cursor() as cur:
+            cur.execute(run_query, check_run_values(started_at, mode, results, bytes_hashed, stopped, agent_id, host))
+            run_id = cur.fetchone()[0]
+            psycopg2.extras.execute_values(cur, results_query, check_result_values(run_id, result_rows, agent_id, host), page_size=1000)
+        conn.commit()
+        return run_id
+    except psycopg2.Error as e:
+        print(f"Ошибка при сохранении результатов проверки: {e}")
+        conn.rollback()
+        return None
 
 # Удаление ресурса из базы данных
 """
 Подключается к БД
-Для пути проверяет есть ли он в БД, если есть, то удаляет его с БД
+Удаляет ресурс одним DELETE по ключу (хост, путь), host=None - ресурс без хоста,
+если ресурс был в БД, удаляет и его манифест
 """
-def remove_resource_from_db(conn, resource_path: str) -> bool:
+def remove_resource_from_db(conn, resource_path: str, host: str = None) -> bool:
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT COUNT(*) FROM resource_monitoring WHERE resource_path = %s", (resource_path,))
-            count = cur.fetchone()[0]
-            
-            if count == 0:
+            cur.execute("DELETE FROM resource_monitoring WHERE COALESCE(host, '') = %s AND resource_path = %s", (host or "", resource_path))
+            if cur.rowcount == 0:
+                conn.rollback()
                 print(f"Ресурс {resource_path} не найден в базе данных")
                 return False
-            
-            cur.execute("DELETE FROM resource_monitoring WHERE resource_path = %s", (resource_path,))
+
+            cur.execute("DELETE FROM resource_files WHERE COALESCE(host, '') = %s AND resource_path = %s", (host or "", resource_path))
             conn.commit()
             print(f"Ресурс {resource_path} успешно удалён из БД")
             return True
@@ -258,17 +1863,13 @@ def remove_resource_from_db(conn, resource_path: str) -> bool:
 
 # Получение списка всех ресурсов
 """
-Подключается к БД
-Возвращает список всех ресурсов с БД
+Возвращает ресурсы хоста host (по умолчанию LOCAL_HOST, см. host_scope): путь, имя, тип, даты, хэш и хост
+Для больших таблиц - iter_resources (поток) или list_resources_page (страницы)
 """
-def list_all_resources(conn) -> list:
+def list_all_resources(conn, host: str = None) -> list:
     try:
         with conn.cursor() as cur:
-            cur.execute("""
-                SELECT resource_path, resource_name, resource_type, added_date, hash, hash_date 
-                FROM resource_monitoring
-                ORDER BY added_date
-            """)
+            cur.execute(f"{_LIST_QUERY} WHERE {host_scope()} ORDER BY {_LIST_ORDER}", (host or LOCAL_HOST,))
             resources = cur.fetchall()
             return resources
     except psycopg2.Error as e:
@@ -276,16 +1877,198 @@ def list_all_resources(conn) -> list:
         conn.rollback()
         return []
 
+# Порядок списка ресурсов: по дате добавления (без даты - в начале), пути и хосту (индекс resource_monitoring_list_idx)
+_LIST_QUERY = "SELECT resource_path, resource_name, resource_type, added_date, hash, hash_date, host FROM resource_monitoring"
+_LIST_ORDER = "COALESCE(added_date, '-infinity'::timestamp), resource_path, COALESCE(host, '')"
+
+# Поток ресурсов хоста
+"""
+Строки те же, что у list_all_resources, но читаются серверным курсором порциями по RESOURCE_ITERSIZE
+Ошибки БД передаются вызывающему коду
+"""
+def iter_resources(conn, host: str = None) -> Iterator[tuple]:
+    yield from stream_query(conn, f"{_LIST_QUERY} WHERE {host_scope()} ORDER BY {_LIST_ORDER}", (host or LOCAL_HOST,))
+
+# Ключ строки для постраничного списка: (дата добавления, путь, хост), уникален вместе с ключом ресурса
+def page_key(resource: tuple) -> tuple:
+    return resource[3], resource[0], resource[6] or ""
+
+# Страница списка ресурсов
+"""
+Постраничный список ресурсов хоста host по ключу (keyset): after - ключ последней строки предыдущей страницы (page_key),
+None - первая страница. В отличие от OFFSET, время запроса не растет с номером страницы
+"""
+def list_resources_page(conn, after: tuple = None, limit: int = RESOURCE_PAGE_SIZE, host: str = None) -> list:
+    query = f"{_LIST_QUERY} WHERE {host_scope()}"
+    params = [host or LOCAL_HOST]
+    if after is not None:
+        query += f" AND ({_LIST_ORDER}) > (COALESCE(%s::timestamp, '-infinity'::timestamp), %s, %s)"
+        params.extend(after)
+    query += f" ORDER BY {_LIST_ORDER} LIMIT %s"
+    params.append(limit)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            return cur.fetchall()
+    except psycopg2.Error as e:
+        print(f"Ошибка при получении списка ресурсов: {e}")
+        conn.rollback()
+        return []
+
+# Получение истории эталонов ресурса
+"""
+Подключается к БД
+Использует индекс hash_history_path_idx
+Учитываются эталоны ресурса без хоста и ресурса хоста host (по умолчанию LOCAL_HOST, см. host_scope)
+Возвращает список прежних эталонов ресурса (хэш, алгоритм, дата хэша, дата замены), начиная с последнего
+"""
+def get_hash_history(conn, resource_path: str, host: str = None) -> list:
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT hash, hash_algorithm, hash_date, archived_date
+                FROM hash_history
+                WHERE resource_path = %s AND {host_scope()}
+                ORDER BY archived_date DESC
+            """, (resource_path, host or LOCAL_HOST))
+            return cur.fetchall()
+    except psycopg2.Error as e:
+        print(f"Ошибка при получении истории эталонов {resource_path}: {e}")
+        conn.rollback()
+        return []
+
+# Получение последних статусов ресурсов
+"""
+Подключается к БД
+Для каждого ресурса хоста host (по умолчанию LOCAL_HOST, см. host_scope) берет последний результат проверки
+на этом хосте, полученный не раньше его текущего эталона; результаты сопоставляются с ресурсами по ключу (хост, путь)
+Использует индекс check_results_path_idx
+Возвращает словарь (хост, путь) -> статус
+"""
+def get_last_statuses(conn, host: str = None) -> dict:
+    host = host or LOCAL_HOST
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT DISTINCT ON (COALESCE(r.host, ''), c.resource_path) r.host, c.resource_path, c.status
+                FROM check_results c
+                JOIN resource_monitoring r
+                  ON r.resource_path = c.resource_path AND COALESCE(r.host, '') = COALESCE(c.resource_host, '')
+                WHERE {host_scope("r.host")} AND {host_scope("c.host")}
+                  AND (r.hash_date IS NULL OR c.checked_at >= r.hash_date)
+                ORDER BY COALESCE(r.host, ''), c.resource_path, c.checked_at DESC
+            """, (host, host))
+            return {(resource_host, path): status for resource_host, path, status in cur.fetchall()}
+    except psycopg2.Error as e:
+        print(f"Ошибка при получении последних статусов: {e}")
+        conn.rollback()
+        return {}
+
+# Получение нарушений за период
+"""
+Возвращает нарушения на хосте host (по умолчанию LOCAL_HOST, см. host_scope) с since по until, начиная с последнего:
+(время, путь, хост, идентификатор проверки, изменения). Использует частичный индекс check_results_violations_idx
+"""
+def get_violations(conn, since: datetime, until: datetime = None, host: str = None) -> list:
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT checked_at, resource_path, host, run_id, details
+                FROM check_results
+                WHERE status = 'failed' AND checked_at >= %s AND checked_at < COALESCE(%s, 'infinity'::timestamp)
+                  AND {host_scope()}
+                ORDER BY checked_at DESC
+            """, (since, until, host or LOCAL_HOST))
+            return [(checked_at, path, result_host, run_id, json.loads(details) if details else None)
+                    for checked_at, path, result_host, run_id, details in cur.fetchall()]
+    except psycopg2.Error as e:
+        print(f"Ошибка при получении нарушений: {e}")
+        conn.rollback()
+        return []
+
+# Получение истории проверок
+"""
+Подключается к БД
+Возвращает последние limit проверок из check_runs, начиная с последней
+"""
+def get_check_runs(conn, limit: int = 20) -> list:
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT run_id, started_at, finished_at, duration_seconds, check_mode, total_count, passed_count,
+                       failed_count, unavailable_count, no_hash_count, bytes_hashed, stopped
+                FROM check_runs
+                ORDER BY started_at DESC
+                LIMIT %s
+            """, (limit,))
+            return cur.fetchall()
+    except psycopg2.Error as e:
+        print(f"Ошибка при получении истории проверок: {e}")
+        conn.rollback()
+        return []
+
+# Настройка расписания ресурса
+"""
+check_interval - интервал проверки в секундах, 0 - вернуть общий интервал; priority - приоритет
+Параметры, равные None, не меняются. Ресурс ставится в очередь на ближайшую проверку по новому интервалу
+Ресурс ищется по ключу (хост, путь), host=None - ресурс без хоста
+Возвращает True, если ресурс найден и обновлен
+"""
+def set_resource_schedule(conn, resource_path: str, check_interval: int = None, priority: int = None, host: str = None) -> bool:
+    if check_interval is not None and check_interval < 0:
+        print("Интервал должен быть неотрицательным числом")
+        return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE resource_monitoring
+                SET check_interval = CASE WHEN %(update_interval)s THEN NULLIF(%(interval)s, 0) ELSE check_interval END,
+                    priority = COALESCE(%(priority)s, priority),
+                    next_check = CASE WHEN %(update_interval)s AND last_checked IS NOT NULL
+                        THEN last_checked + COALESCE(NULLIF(%(interval)s, 0), %(default)s) * INTERVAL '1 second'
+                        ELSE next_check END
+                WHERE COALESCE(host, '') = %(host)s AND resource_path = %(path)s
+            """, {"update_interval": check_interval is not None, "interval": check_interval or 0,
+                  "priority": priority, "default": SCHEDULE_DEFAULT_INTERVAL, "host": host or "", "path": resource_path})
+            updated = cur.rowcount > 0
+        conn.commit()
+        if not updated:
+            print(f"Ресурс {resource_path} не найден в базе данных")
+        return updated
+    except psycopg2.Error as e:
+        print(f"Ошибка при изменении расписания {resource_path}: {e}")
+        conn.rollback()
+        return False
+
+# Расписание ресурсов
+"""
+Возвращает расписание ресурсов хоста host (по умолчанию LOCAL_HOST, см. host_scope) в порядке очереди:
+(путь, хост, интервал, приоритет, последняя проверка, следующая проверка)
+"""
+def get_schedule(conn, host: str = None) -> list:
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT resource_path, host, check_interval, priority, last_checked, next_check
+                FROM resource_monitoring
+                WHERE {host_scope()}
+                ORDER BY next_check NULLS FIRST, priority DESC, resource_path, COALESCE(host, '')
+            """, (host or LOCAL_HOST,))
+            return cur.fetchall()
+    except psycopg2.Error as e:
+        print(f"Ошибка при получении расписания: {e}")
+        conn.rollback()
+        return []
+
 # Запуск фоновой проверки
 """
 Использует глобальные переменные
-Проверяет не запущена ли уже фоновая проверка
-Создает новый поток
-В этом потоке запускает проверку
-При проверке: запускает функцию проверки хэшей, записывает в список все пути с нарушениями, записывает кол-во путей с нарушениями
+Запускает в новом потоке периодическую проверку, проверку по событиям (watch_events) или по расписанию (scheduled),
+см. модуль scheduler; в выборочном режиме раз в full_interval секунд выполняется полная проверка
 Если найдено нарушение, то фоновая проверка останавливается
 """
-def start_background_check(conn, interval: int, alert_callback: Callable[[int, list], None] = None, refresh_callback: Callable[[], None] = None) -> None:
+def start_background_check(conn, interval: int, alert_callback: Callable[[int, list], None] = None, refresh_callback: Callable[[], None] = None, mode: str = CHECK_MODE_PARANOID, watch_events: bool = False, debounce: float = 2.0, scheduled: bool = False, max_runtime: float = None, io_rate: float = None, throttle: Throttle = None, full_interval: float = None) -> None:
+    from scheduler import FullCheckCadence, run_event_watch, run_scheduler
     global _stop_background
     global _background_thread
     global _background_event
@@ -297,32 +2080,90 @@ def start_background_check(conn, interval: int, alert_callback: Callable[[int, l
         return
 
     _background_event = threading.Event()
+    stop_event = _background_event
+
+    # Обработка результатов цикла, возвращает False, если проверку нужно прекратить
+    def handle_results(results: dict) -> bool:
+        failed_paths = [resource_label(*key) for key, status in results.items() if status == "failed"]
+        failed_count = len(failed_paths)
+        metrics.set_gauge("ic_background_last_cycle_timestamp_seconds", time.time())
+        if failed_count:
+            metrics.inc("ic_background_violations_total", failed_count)
+        if failed_count > 0 and alert_callback:
+            alert_callback(failed_count, failed_paths)
+            return False
+        if refresh_callback:
+            refresh_callback()
+        return True
 
     def periodic_check():
         global _stop_background
         global _background_event
+        cadence = FullCheckCadence(mode, full_interval)
         while not _stop_background:
             if _background_event is None:
                 break
-            print(f"Начало фоновой проверки в {datetime.now()}")
-            results = check_all_hashes(conn)
-            failed_paths = [path for path, status in results.items() if status == "failed"]
-            failed_count = len(failed_paths)
-            if failed_count > 0 and alert_callback:
-                alert_callback(failed_count, failed_paths)
+            cycle_mode = cadence.cycle_mode()
+            print(f"Начало фоновой проверки ({cycle_mode}) в {datetime.now()}")
+            try:
+                with use_connection(conn) as cycle_conn, metrics.timer("ic_background_cycle_seconds", kind="periodic"):
+                    results = check_all_hashes(cycle_conn, stop_event, mode=cycle_mode, throttle=throttle)
+            except psycopg2.Error as e:
+                metrics.inc("ic_db_errors_total", kind="connection")
+                metrics.report(logging.ERROR, "Ошибка подключения к БД при фоновой проверке", f"Ошибка подключения к БД при фоновой проверке: {e}", error=str(e))
+                results = {}
+            if stop_event.is_set() or not handle_results(results):
                 break
-            if refresh_callback:
-                refresh_callback()
             if _background_event and not _stop_background:
                 _background_event.wait(interval)
 
+    def event_check():
+        while not stop_event.is_set():
+            try:
+                run_event_watch(conn, interval, stop_event, mode, handle_results, debounce, throttle, full_interval)
+                return
+            except psycopg2.Error as e:
+                print(f"Ошибка подключения к БД при фоновой проверке: {e}")
+                stop_event.wait(min(interval, 30))
+            except OSError as e:
+                print(f"Не удалось запустить наблюдение inotify ({e}), используется периодическая проверка")
+                periodic_check()
+                return
+
+    def scheduled_check():
+        while not stop_event.is_set():
+            try:
+                run_scheduler(conn, interval, stop_event, mode, handle_results, max_runtime, io_rate, throttle, full_interval)
+                return
+            except psycopg2.Error as e:
+                metrics.inc("ic_db_errors_total", kind="connection")
+                print(f"Ошибка подключения к БД при фоновой проверке: {e}")
+                stop_event.wait(SCHEDULER_MAX_SLEEP)
+
     if interval <= 0:
         print("Интервал должен быть положительным числом")
         return
 
-    _background_thread = threading.Thread(target=periodic_check, daemon=True)
+    target = periodic_check
+    if scheduled:
+        target = scheduled_check
+        if watch_events:
+            print("Проверка по расписанию не совмещается с проверкой по событиям, события не отслеживаются")
+    elif watch_events:
+        from watcher import inotify_available
+        if inotify_available():
+            target = event_check
+        else:
+            print("inotify недоступен, используется периодическая проверка")
+
+    _background_thread = threading.Thread(target=target, daemon=True)
     _background_thread.start()
-    print(f"Фоновая проверка запущена с интервалом {interval} секунд")
+    if target is scheduled_check:
+        print(f"Фоновая проверка по расписанию запущена, интервал по умолчанию {interval} секунд")
+    elif target is event_check:
+        print(f"Фоновая проверка по событиям запущена, полная проверка каждые {interval} секунд")
+    else:
+        print(f"Фоновая проверка запущена с интервалом {interval} секунд")
 
 # Остановка фоновой проверки
 """
@@ -0,0 +1,191 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+import metrics
+
+# Настройки кэша хэшей
+HASH_CACHE_SIZE = 100000 # Кол-во записей в памяти, при превышении вытесняются давно не использованные
+HASH_CACHE_PERSIST_SIZE = 1000000 # Кол-во записей в файле кэша, при закрытии лишние удаляются
+HASH_CACHE_FLUSH_SIZE = 500 # Кол-во новых записей, после которого они записываются в файл
+HASH_CACHE_PATH = None # Файл SQLite для сохранения кэша между запусками, None - кэш только на время проверки
+
+# Кэш хэшей файлов по содержимому
+"""
+Ключ - (устройство, inode, размер, mtime_ns, ctime_ns, режим, алгоритм): один и тот же файл, зарегистрированный отдельно
+и внутри папки или попавший в пересекающиеся папки (в том числе через жесткие ссылки), читается один раз.
+ctime_ns меняется при любой записи и не восстанавливается через os.utime, поэтому файл, перезаписанный
+с сохранением размера и mtime, не получает старый хэш
+Записи хранятся в памяти (не больше max_entries, вытесняются давно не использованные - LRU)
+Если файл с таким ключом уже считается в другом потоке, get_or_compute ждет его результата вместо повторного чтения
+Если задан path, записи дополнительно сохраняются в файл SQLite, поэтому перезапущенный демон использует
+уже рассчитанные хэши. Промахи в памяти ищутся в файле, новые записи пишутся пачками по HASH_CACHE_FLUSH_SIZE
+Кэш используется только в процессе, который его создал (в дочерних процессах пула он отключен)
+"""
+class HashCache:
+    def __init__(self, max_entries: int = None, path: str = None):
+        self.max_entries = max_entries or HASH_CACHE_SIZE
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # Ключ -> хэш, в порядке использования
+        self._pending = {} # Ключ -> Event для хэшей, которые сейчас считаются
+        self._new_rows = [] # Записи, еще не сохраненные в файл
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._db = None
+        if path:
+            try:
+                self._db = sqlite3.connect(path, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                # Таблица прежнего формата (ключ без ctime_ns и режима) не используется
+                self._db.execute("DROP TABLE IF EXISTS file_hashes")
+                self._db.execute("""
+                    CREATE TABLE IF NOT EXISTS file_hashes_v2 (
+                        device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, ctime_ns INTEGER, mode INTEGER,
+                        algorithm TEXT, hash TEXT NOT NULL, used REAL NOT NULL,
+                        PRIMARY KEY (device, inode, size, mtime_ns, ctime_ns, mode, algorithm)
+                    )
+                """)
+                self._db.commit()
+            except sqlite3.Error as e:
+                metrics.report(logging.WARNING, "Не удалось открыть файл кэша хэшей", f"Не удалось открыть файл кэша хэшей {path}: {e}", path=path, error=str(e))
+                self._db = None
+
+    # Ключ кэша по результату stat
+    @staticmethod
+    def key(st: os.stat_result, algorithm: str) -> tuple:
+        return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_mode, algorithm
+
+    # Кэш доступен в текущем процессе
+    @property
+    def active(self) -> bool:
+        return os.getpid() == self._pid
+
+    # Поиск хэша
+    """
+    Возвращает хэш или None
+    """
+    def get(self, key: tuple) -> str:
+        with self._lock:
+            value = self._lookup(key)
+            self._count(value is not None)
+        return value
+
+    # Сохранение хэша
+    def put(self, key: tuple, value: str) -> None:
+        with self._lock:
+            self._store(key, value)
+
+    # Хэш из кэша или расчет через compute
+    """
+    compute вызывается без аргументов и возвращает хэш или None (ошибка чтения, не кэшируется)
+    Одновременные запросы одного ключа ждут первого расчета
+    """
+    def get_or_compute(self, key: tuple, compute: Callable[[], str]) -> str:
+        while True:
+            with self._lock:
+                value = self._lookup(key)
+                if value is not None:
+                    self._count(True)
+                    return value
+                event = self._pending.get(key)
+                if event is None:
+                    self._pending[key] = threading.Event()
+                    self._count(False)
+                    break
+            event.wait()
+        try:
+            value = compute()
+        finally:
+            with self._lock:
+                if value is not None:
+                    self._store(key, value)
+                self._pending.pop(key).set()
+        return value
+
+    # Запись новых хэшей в файл
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    # Сохранение новых записей и закрытие файла
+    """
+    В файле остается не больше HASH_CACHE_PERSIST_SIZE последних использованных записей
+    """
+    def close(self) -> None:
+        with self._lock:
+            if self._db is None or not self.active:
+                return
+            self._flush()
+            try:
+                self._db.execute("""
+                    DELETE FROM file_hashes_v2 WHERE rowid IN (
+                        SELECT rowid FROM file_hashes_v2 ORDER BY used DESC LIMIT -1 OFFSET ?
+                    )
+                """, (HASH_CACHE_PERSIST_SIZE,))
+                self._db.commit()
+            except sqlite3.Error as e:
+                metrics.report(logging.WARNING, "Ошибка при очистке файла кэша хэшей", f"Ошибка при очистке файла кэша хэшей {self.path}: {e}", path=self.path, error=str(e))
+            self._db.close()
+            self._db = None
+
+    # Поиск в памяти, затем в файле (вызывается под блокировкой)
+    def _lookup(self, key: tuple) -> str:
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+            return value
+        if self._db is None:
+            return None
+        try:
+            row = self._db.execute("""
+                SELECT hash FROM file_hashes_v2
+                WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ? AND ctime_ns = ? AND mode = ? AND algorithm = ?
+            """, key).fetchone()
+        except sqlite3.Error as e:
+            metrics.report(logging.WARNING, "Ошибка при чтении файла кэша хэшей", f"Ошибка при чтении файла кэша хэшей {self.path}: {e}", path=self.path, error=str(e))
+            return None
+        if row is None:
+            return None
+        self._remember(key, row[0])
+        self._new_rows.append((*key, row[0], time.time()))
+        return row[0]
+
+    # Добавление записи (вызывается под блокировкой)
+    def _store(self, key: tuple, value: str) -> None:
+        self._remember(key, value)
+        if self._db is not None:
+            self._new_rows.append((*key, value, time.time()))
+            if len(self._new_rows) >= HASH_CACHE_FLUSH_SIZE:
+                self._flush()
+
+    # Запись в память с вытеснением давно не использованных (вызывается под блокировкой)
+    def _remember(self, key: tuple, value: str) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    # Запись накопленных строк в файл (вызывается под блокировкой)
+    def _flush(self) -> None:
+        if self._db is None or not self._new_rows:
+            return
+        try:
+            self._db.executemany("INSERT OR REPLACE INTO file_hashes_v2 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", self._new_rows)
+            self._db.commit()
+        except sqlite3.Error as e:
+            metrics.report(logging.WARNING, "Ошибка при записи файла кэша хэшей", f"Ошибка при записи файла кэша хэшей {self.path}: {e}", path=self.path, error=str(e))
+        self._new_rows.clear()
+
+    # Учет попаданий и промахов (вызывается под блокировкой)
+    def _count(self, hit: bool) -> None:
+        if hit:
+            self.hits += 1
+            metrics.inc("ic_hash_cache_hits_total")
+        else:
+            self.misses += 1
+            metrics.inc("ic_hash_cache_misses_total")
@@ -1,9 +1,21 @@
+import os
 import tkinter as tk
-from tkinter import ttk, filedialog, messagebox
+from tkinter import ttk, filedialog, messagebox, simpledialog
 import functions as func
+import throttle
+from db import Database
 import threading
 from datetime import datetime
 
+# Кол-во строк таблицы, добавляемых при прокрутке к концу
+PAGE_SIZE = 500
+# Пункт выбора алгоритма: пересчитывать каждый ресурс его сохраненным алгоритмом
+KEEP_ALGORITHM = "Сохранённый"
+
+# Идентификатор строки таблицы: одноимённые ресурсы разных хостов - разные строки
+def row_id(host, path):
+    return f"{host or ''}\t{path}"
+
 class IntegrityMonitoringApp:
     # Инициализация окна приложения
     def __init__(self, root):
@@ -12,24 +24,46 @@ class IntegrityMonitoringApp:
         self.root.geometry("800x600")
         self.root.minsize(1045, 500)
 
-        # Подключение к БД
+        # Подключение к БД (пул: у каждого потока своё соединение)
+        # Параметры - из переменных окружения IC_DB_* (как у cli.py), без пароля psycopg2 использует PGPASSWORD или ~/.pgpass
         try:
-            self.conn = func.connect_to_db(
-                dbname="ic_db",
-                user="postgres",
-                password="Qwerty123",
+            self.db = Database(
+                dbname=os.environ.get("IC_DB_NAME", "ic_db"),
+                user=os.environ.get("IC_DB_USER", "postgres"),
+                password=os.environ.get("IC_DB_PASSWORD"),
+                host=os.environ.get("IC_DB_HOST", "localhost"),
+                port=os.environ.get("IC_DB_PORT", "5432"),
             )
+            ready = self.db.run(func.init_db)
+        except RuntimeError as e: # Не установлен psycopg2
+            messagebox.showerror("Ошибка", str(e))
+            self.root.destroy()
+            return
         except func.psycopg2.Error:
             messagebox.showerror("Ошибка", "Не удалось подключиться к базе данных")
             self.root.destroy()
             return
+        if not ready:
+            messagebox.showerror("Ошибка", "Не удалось подготовить схему БД (возможно, схема новее, чем поддерживает программа)")
+            self.db.close()
+            self.root.destroy()
+            return
 
         # Флаги и переменные 
         self.background_check_running = False # Флаг фоновой проверки
-        self.check_status = {} # Словарь результатов проверки
+        self.check_status = self.db.run(func.get_last_statuses) # Словарь результатов проверки (последние сохранённые статусы)
+        self.check_changes = {} # Изменённые файлы в папках с нарушениями
         self.operation_running = False # Флаг работы текущей операции
         self.stop_operation_event = threading.Event() # Остановка текущей операции
         self.progress_window_active = False # Окно прогресса
+        self.resources = [] # Последний полученный из БД список ресурсов
+        self.row_cache = {} # Отображаемые строки: идентификатор строки -> (значения, теги)
+        self.row_keys = {} # Идентификатор строки -> ключ ресурса (хост, путь)
+        self.loaded_count = PAGE_SIZE # Кол-во строк, созданных в таблице
+        self.has_more = False # В БД есть ресурсы после загруженных
+        self.page_loading = False # Идёт загрузка следующей страницы
+        self.refresh_running = False # Идёт загрузка списка ресурсов
+        self.refresh_pending = False # Нужна повторная загрузка после текущей
 
         # Создание виджетов
         self.create_widgets()
@@ -46,12 +80,27 @@ class IntegrityMonitoringApp:
         self.add_file_button.pack(side="left", padx=5)
         self.add_folder_button = ttk.Button(button_frame, text="Добавить папку", command=self.add_folder)
         self.add_folder_button.pack(side="left", padx=5)
+        self.bulk_add_button = ttk.Button(button_frame, text="Массовое добавление", command=self.bulk_add)
+        self.bulk_add_button.pack(side="left", padx=5)
         self.remove_button = ttk.Button(button_frame, text="Удалить", command=self.remove_resource)
         self.remove_button.pack(side="left", padx=5)
+        self.schedule_button = ttk.Button(button_frame, text="Расписание", command=self.edit_schedule)
+        self.schedule_button.pack(side="left", padx=5)
         self.calculate_button = ttk.Button(button_frame, text="Рассчитать хэши", command=self.calculate_hashes)
         self.calculate_button.pack(side="left", padx=5)
+        # Алгоритм новых эталонов (перевод ресурсов на выбранный алгоритм)
+        # По умолчанию каждый ресурс пересчитывается своим сохраненным алгоритмом
+        self.algorithm_var = tk.StringVar(value=KEEP_ALGORITHM)
+        ttk.Combobox(button_frame, textvariable=self.algorithm_var, values=[KEEP_ALGORITHM] + list(func.HASH_ALGORITHMS), state="readonly", width=16).pack(side="left", padx=5)
         self.check_button = ttk.Button(button_frame, text="Проверить целостность", command=self.check_hashes)
         self.check_button.pack(side="left", padx=5)
+        # Режим проверки: быстрая (по отпечаткам метаданных), полная (чтение всех данных)
+        # или выборочная (большие файлы - по выборочному дайджесту, в фоновой проверке полная проверка выполняется реже)
+        self.check_mode_var = tk.StringVar(value="Полная")
+        ttk.Combobox(button_frame, textvariable=self.check_mode_var, values=["Полная", "Быстрая", "Выборочная"], state="readonly", width=11).pack(side="left", padx=5)
+        # Щадящий режим: ограничение скорости чтения и пауза при высокой нагрузке системы
+        self.low_impact_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(button_frame, text="Щадящий режим", variable=self.low_impact_var).pack(side="left", padx=5)
 
         # Фрейм для фоновой проверки
         bg_frame = ttk.Frame(button_frame)
@@ -61,6 +110,11 @@ class IntegrityMonitoringApp:
         ttk.Entry(bg_frame, textvariable=self.interval_var, width=5).pack(side="left", padx=2)
         self.interval_unit = tk.StringVar(value="сек.")
         ttk.Combobox(bg_frame, textvariable=self.interval_unit, values=["сек.", "мин.", "ч."], state="readonly", width=10).pack(side="left", padx=2)
+        self.watch_events_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(bg_frame, text="По событиям", variable=self.watch_events_var).pack(side="left", padx=2)
+        # Проверка по расписанию: интервал - интервал ресурсов без собственного
+        self.scheduled_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(bg_frame, text="По расписанию", variable=self.scheduled_var).pack(side="left", padx=2)
         self.start_bg_button = ttk.Button(bg_frame, text="Запустить фоновую проверку", command=self.start_background_check)
         self.start_bg_button.pack(side="left", padx=2)
 
@@ -69,7 +123,7 @@ class IntegrityMonitoringApp:
         self.tree_frame.pack(fill="both", expand=True, padx=5, pady=5)
 
         # Настройка таблицы
-        columns = ("status", "path", "name", "type", "added_date", "hash_date")
+        columns = ("status", "path", "host", "name", "type", "added_date", "hash_date")
         self.tree = ttk.Treeview(self.tree_frame, columns=columns, show="headings")
         style = ttk.Style()
         # Теги для цветов
@@ -82,22 +136,25 @@ class IntegrityMonitoringApp:
         # Заголовки и ширина столбцов
         self.tree.heading("status", text="Статус")
         self.tree.heading("path", text="Путь")
+        self.tree.heading("host", text="Хост")
         self.tree.heading("name", text="Имя")
         self.tree.heading("type", text="Тип")
         self.tree.heading("added_date", text="Добавлен")
         self.tree.heading("hash_date", text="Дата хэша")
         self.tree.column("status", width=1, anchor=tk.CENTER)
         self.tree.column("path", width=200)
+        self.tree.column("host", width=40)
         self.tree.column("name", width=100)
         self.tree.column("type", width=1)
         self.tree.column("added_date", width=12)
         self.tree.column("hash_date", width=12)
 
         # Настройка полосы прокрутки
-        scrollbar = ttk.Scrollbar(self.tree_frame, orient="vertical", command=self.tree.yview)
-        scrollbar.pack(side="right", fill="y")
-        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.scrollbar = ttk.Scrollbar(self.tree_frame, orient="vertical", command=self.tree.yview)
+        self.scrollbar.pack(side="right", fill="y")
+        self.tree.configure(yscrollcommand=self.on_tree_scroll)
         self.tree.pack(fill="both", expand=True)
+        self.tree.bind("<Double-1>", self.show_changes)
 
         # Обновление таблицы ресурсов
         self.refresh_resources()
@@ -107,14 +164,22 @@ class IntegrityMonitoringApp:
         # Настройка окна
         progress_window = tk.Toplevel(self.root)
         progress_window.title(title)
-        progress_window.geometry("300x100")
+        progress_window.geometry("420x170")
         progress_window.resizable(False, False)
         progress_window.transient(self.root)
         progress_window.grab_set()
 
         # Отображение текущей операции
         progress_label = ttk.Label(progress_window, text=message)
-        progress_label.pack(pady=10)
+        progress_label.pack(pady=(10, 5))
+
+        # Полоса прогресса, объём и скорость, текущий путь
+        self.progress_bar = ttk.Progressbar(progress_window, orient="horizontal", length=390, mode="determinate")
+        self.progress_bar.pack(padx=15)
+        self.progress_stats_label = ttk.Label(progress_window, text="")
+        self.progress_stats_label.pack()
+        self.progress_path_label = ttk.Label(progress_window, text="", width=60)
+        self.progress_path_label.pack(padx=15)
 
         # Кнопка остановки операции
         stop_button = ttk.Button(progress_window, text="Остановить", command=lambda: self.stop_current_operation(progress_window))
@@ -125,6 +190,22 @@ class IntegrityMonitoringApp:
         self.progress_window_active = True
         return progress_window
 
+    # Обновление окна прогресса
+    def update_progress(self, info):
+        # Окно могло быть закрыто кнопкой остановки до прихода уведомления
+        if not self.progress_window_active:
+            return
+        self.progress_bar.config(maximum=max(info["total"], 1), value=info["done"])
+        self.progress_stats_label.config(text=func.format_progress(info))
+        current = info["current"] or ""
+        # Длинный путь сокращается с начала, чтобы было видно имя файла
+        self.progress_path_label.config(text=current if len(current) <= 60 else "..." + current[-57:])
+
+    # Передача прогресса из рабочего потока в поток интерфейса
+    def progress_callback(self, info):
+        # Уведомления уже прорежены ProgressTracker, поэтому after не переполняется
+        self.root.after(0, lambda: self.update_progress(info))
+
     # Создание окна таймера при фоновой проверке
     def create_timer_window(self, interval_in_seconds):
         # Настройка окна
@@ -147,11 +228,22 @@ class IntegrityMonitoringApp:
         self.disable_main_buttons()
         return timer_window, timer_label
 
+    # Выбранный режим проверки
+    def get_check_mode(self):
+        modes = {"Быстрая": func.CHECK_MODE_FAST, "Выборочная": func.CHECK_MODE_SAMPLED}
+        return modes.get(self.check_mode_var.get(), func.CHECK_MODE_PARANOID)
+
+    # Ограничение нагрузки для выбранного режима
+    def get_throttle(self):
+        return throttle.low_impact() if self.low_impact_var.get() else None
+
     # Отключение кнопок на основном окне
     def disable_main_buttons(self):
         self.add_file_button.config(state="disabled")
         self.add_folder_button.config(state="disabled")
+        self.bulk_add_button.config(state="disabled")
         self.remove_button.config(state="disabled")
+        self.schedule_button.config(state="disabled")
         self.calculate_button.config(state="disabled")
         self.check_button.config(state="disabled")
         self.start_bg_button.config(state="disabled")
@@ -160,7 +252,9 @@ class IntegrityMonitoringApp:
     def enable_main_buttons(self):
         self.add_file_button.config(state="normal")
         self.add_folder_button.config(state="normal")
+        self.bulk_add_button.config(state="normal")
         self.remove_button.config(state="normal")
+        self.schedule_button.config(state="normal")
         self.calculate_button.config(state="normal")
         self.check_button.config(state="normal")
         self.start_bg_button.config(state="normal")
@@ -186,7 +280,7 @@ class IntegrityMonitoringApp:
         # Диалог выбора файла
         path = filedialog.askopenfilename(title="Выберите файл", filetypes=[("Все файлы", "*.*")])
         if path:
-            if func.add_resource_to_db(self.conn, path):
+            if self.db.run(func.add_resource_to_db, path):
                 self.refresh_resources() # Обновление таблицы
 
     # Добавление папки в БД
@@ -194,9 +288,45 @@ class IntegrityMonitoringApp:
         # Диалог выбора папки
         path = filedialog.askdirectory(title="Выберите папку")
         if path:
-            if func.add_resource_to_db(self.conn, path):
+            if self.db.run(func.add_resource_to_db, path):
                 self.refresh_resources() # Обновление таблицы
 
+    # Массовое добавление файлов из папки
+    def bulk_add(self):
+        # Проверка не выполняется ли уже операция
+        if self.operation_running:
+            return
+        root = filedialog.askdirectory(title="Выберите папку для поиска файлов")
+        if not root:
+            return
+        include = simpledialog.askstring("Массовое добавление", "Добавлять файлы по шаблонам через пробел\n(пусто - все файлы)",
+                                         parent=self.root, initialvalue="")
+        if include is None:
+            return
+        exclude = simpledialog.askstring("Массовое добавление", "Исключить файлы и папки по шаблонам через пробел",
+                                         parent=self.root, initialvalue=" ".join(func.COMMON_IGNORE_PATTERNS))
+        if exclude is None:
+            return
+
+        # Обход папки и запись в БД в отдельном потоке, кнопки на это время отключаются
+        self.operation_running = True
+        self.disable_main_buttons()
+        def run_bulk_add():
+            paths = func.discover_resources(root, include.split(), exclude.split())
+            results = self.db.run(func.add_resources_bulk, paths, retry=False)
+            self.root.after(0, lambda: self.finish_bulk_add(results))
+
+        # Запуск отдельного потока
+        threading.Thread(target=run_bulk_add, daemon=True).start()
+
+    # Завершение массового добавления
+    def finish_bulk_add(self, results):
+        self.enable_main_buttons() # Включение кнопок на основном окне
+        self.operation_running = False
+        messagebox.showinfo("Массовое добавление", f"Добавлено: {len(results['added'])}\nУже в БД: {len(results['existing'])}\nОшибок: {len(results['failed'])}")
+        if results["added"]:
+            self.refresh_resources() # Обновление таблицы
+
     # Удаление ресурса из БД
     def remove_resource(self):
         # Получение выбранного ресурса по строке
@@ -205,14 +335,48 @@ class IntegrityMonitoringApp:
             messagebox.showwarning("Предупреждение", "Выберите ресурс для удаления")
             return
 
-        path = self.tree.item(selected[0])["values"][1] # Получение пути
+        host, path = self.row_keys[selected[0]] # Получение хоста и пути
         # Подтверждение удаления и удаление
-        if messagebox.askyesno("Подтверждение", f"Удалить ресурс {path}?"):
-            func.remove_resource_from_db(self.conn, path)
-            if path in self.check_status:
-                del self.check_status[path]
+        if messagebox.askyesno("Подтверждение", f"Удалить ресурс {func.resource_label(host, path)}?"):
+            self.db.run(func.remove_resource_from_db, path, host)
+            self.check_status.pop((host, path), None)
+            self.check_changes.pop((host, path), None)
             self.refresh_resources() # Обновление таблицы
 
+    # Изменение интервала и приоритета проверки ресурса
+    def edit_schedule(self):
+        selected = self.tree.selection()
+        if not selected:
+            messagebox.showwarning("Предупреждение", "Выберите ресурс")
+            return
+        host, path = self.row_keys[selected[0]] # Получение хоста и пути
+        interval = simpledialog.askinteger("Расписание", f"Интервал проверки {func.resource_label(host, path)}, сек.\n(0 - общий интервал фоновой проверки)",
+                                           parent=self.root, minvalue=0)
+        if interval is None:
+            return
+        priority = simpledialog.askinteger("Расписание", "Приоритет (больше - раньше)", parent=self.root, initialvalue=0)
+        if priority is None:
+            return
+        self.db.run(func.set_resource_schedule, path, interval, priority, host)
+
+    # Просмотр изменений в папке с нарушением
+    def show_changes(self, event=None):
+        selected = self.tree.selection()
+        if not selected:
+            return
+        host, path = self.row_keys[selected[0]] # Получение хоста и пути
+        changes = self.check_changes.get((host, path))
+        if not changes:
+            return
+        lines = []
+        for kind, label in (("added", "Добавлены"), ("removed", "Удалены"), ("modified", "Изменены")):
+            if changes[kind]:
+                lines.append(f"{label} ({len(changes[kind])}):")
+                lines.extend(changes[kind][:50])
+                if len(changes[kind]) > 50:
+                    lines.append("...")
+        messagebox.showinfo("Изменения", f"{path}\n\n" + "\n".join(lines))
+
     # Расчет хэшей
     def calculate_hashes(self):
         # Проверка не выполняется ли уже операция
@@ -223,23 +387,22 @@ class IntegrityMonitoringApp:
         self.stop_operation_event.clear()
         self.progress_window_active = False
 
-        # Сброс тегов для всех строк в таблице
-        for item in self.tree.get_children():
-            current_tags = self.tree.item(item, "tags")
-            new_tags = tuple(tag for tag in current_tags if tag in ("oddrow", "evenrow"))
-            self.tree.item(item, tags=new_tags)
-            values = self.tree.item(item, "values")
-            self.tree.item(item, values=( "", *values[1:] ))
-
-        # Сброс словаря статусов проверки
+        # Сброс словаря статусов проверки и статусов в таблице
         self.check_status.clear()
+        self.check_changes.clear()
+        self.render_rows()
 
         # Создание окна прогресса
         progress_window = self.create_progress_window("Расчёт хэшей", "Идёт расчёт эталонов...")
         
         # Запуск расчета хэшей
+        algorithm = self.algorithm_var.get()
+        if algorithm == KEEP_ALGORITHM:
+            algorithm = None
+        throttle_settings = self.get_throttle()
         def run_calculate():
-            updated_count = func.update_all_hashes(self.conn, self.stop_operation_event)
+            updated_count = self.db.run(func.update_all_hashes, self.stop_operation_event, algorithm=algorithm,
+                                        progress_callback=self.progress_callback, throttle=throttle_settings, retry=False)
             self.root.after(0, lambda: self.finish_operation(progress_window))
 
         # Запуск отдельного потока
@@ -260,18 +423,23 @@ class IntegrityMonitoringApp:
         progress_window = self.create_progress_window("Проверка целостности", "Идёт проверка целостности...")
 
         # Запуск проверки
+        mode = self.get_check_mode()
+        throttle_settings = self.get_throttle()
         def run_check():
-            results = func.check_all_hashes(self.conn, self.stop_operation_event)
-            self.root.after(0, lambda: self.finish_operation(progress_window, results))
+            changes = {}
+            results = self.db.run(func.check_all_hashes, self.stop_operation_event, mode=mode, changes=changes,
+                                  progress_callback=self.progress_callback, throttle=throttle_settings, retry=False)
+            self.root.after(0, lambda: self.finish_operation(progress_window, results, changes))
         
         # Запуск отдельного потока
         threading.Thread(target=run_check, daemon=True).start()
 
     # Завершение текущей операции
-    def finish_operation(self, progress_window, results=None):
+    def finish_operation(self, progress_window, results=None, changes=None):
         # Результаты проверки
         if results is not None:
             self.check_status = results
+            self.check_changes = changes or {}
         self.refresh_resources() # Обновление таблицы
         self.progress_window_active = False
         progress_window.destroy() # Закрытии окна прогресса
@@ -315,10 +483,14 @@ class IntegrityMonitoringApp:
             
             # Запсук фоновой проверки
             func.start_background_check(
-                self.conn,
+                self.db,
                 interval_in_seconds,
                 lambda count, paths: self.violations_alert(count, paths, timer_window),
-                lambda: self.root.after(0, self.refresh_resources)
+                lambda: self.root.after(0, self.refresh_resources),
+                self.get_check_mode(),
+                self.watch_events_var.get(),
+                scheduled=self.scheduled_var.get(),
+                throttle=self.get_throttle()
             )
             update_timer(interval_in_seconds) # Запуск таймера
 
@@ -336,45 +508,135 @@ class IntegrityMonitoringApp:
 
     # Обновление таблицы ресурсов
     def refresh_resources(self):
-        # Получения списка ресурсов
-        resources = func.list_all_resources(self.conn)
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-        
-        # Заполнение таблицы
-        for res in resources:
-            path, name, rtype, added, _, hash_date = res
-            # Форматирование дат
-            hash_date_str = hash_date.strftime("%d-%m-%Y %H:%M:%S") if hash_date else "Нет данных"
-            added_str = added.strftime("%d-%m-%Y %H:%M:%S") if added else "Нет данных"
-
-            # Тип ресурса
-            if rtype == "file":
-                rtype = "Файл"
-            elif rtype == "folder":
-                rtype = "Папка"
-
-            # Статус проверки и цвет строки
-            status = ""
-            tags = ("oddrow",) if len(self.tree.get_children()) % 2 == 0 else ("evenrow",)
-            if path in self.check_status:
-                if self.check_status[path] == "passed":
-                    status = "\u2714"
-                    tags = ("passed",)
-                elif self.check_status[path] == "failed":
-                    status = "\u2718"
-                    tags = ("failed",)
-                elif self.check_status[path] == "unavailable":
-                    status = "N/A"
-                    tags = ("unavailable",)
-                elif self.check_status[path] == "no_hash":
-                    status = "\u003F"
-                    tags = ("unavailable",)
-            self.tree.insert("", "end", values=(status, path, name, rtype, added_str, hash_date_str), tags=tags)
+        # Повторные запросы во время загрузки объединяются в одну следующую загрузку
+        if self.refresh_running:
+            self.refresh_pending = True
+            return
+        self.refresh_running = True
+
+        # Получение уже загруженных страниц в отдельном потоке, чтобы не блокировать интерфейс
+        limit = self.loaded_count
+        def fetch():
+            resources = self.db.run(func.list_resources_page, None, limit)
+            self.root.after(0, lambda: self.apply_resources(resources, limit))
+
+        threading.Thread(target=fetch, daemon=True).start()
+
+    # Применение полученного списка ресурсов
+    def apply_resources(self, resources, limit):
+        self.refresh_running = False
+        self.resources = resources
+        self.has_more = len(resources) >= limit
+        self.render_rows()
+        if self.refresh_pending:
+            self.refresh_pending = False
+            self.refresh_resources()
+
+    # Значения и теги строки таблицы
+    def format_row(self, res, index):
+        path, name, rtype, added, _, hash_date, host = res
+        # Форматирование дат
+        hash_date_str = hash_date.strftime("%d-%m-%Y %H:%M:%S") if hash_date else "Нет данных"
+        added_str = added.strftime("%d-%m-%Y %H:%M:%S") if added else "Нет данных"
+
+        # Тип ресурса
+        if rtype == "file":
+            rtype = "Файл"
+        elif rtype == "folder":
+            rtype = "Папка"
+
+        # Статус проверки и цвет строки
+        status = ""
+        tags = ("oddrow",) if index % 2 == 0 else ("evenrow",)
+        check_status = self.check_status.get((host, path))
+        if check_status is not None:
+            if check_status == "passed":
+                status = "\u2714"
+                tags = ("passed",)
+            elif check_status == "failed":
+                status = "\u2718"
+                tags = ("failed",)
+            elif check_status == "unavailable":
+                status = "N/A"
+                tags = ("unavailable",)
+            elif check_status == "no_hash":
+                status = "\u003F"
+                tags = ("unavailable",)
+        return (status, path, host or "", name, rtype, added_str, hash_date_str), tags
+
+    # Отрисовка строк таблицы
+    def render_rows(self):
+        # Создаются только первые loaded_count строк, строки идентифицируются хостом и путём ресурса
+        visible = self.resources[:self.loaded_count]
+        rows = {}
+        order = []
+        for res in visible:
+            iid = row_id(res[6], res[0])
+            if iid in rows:
+                continue
+            values, tags = self.format_row(res, len(order))
+            rows[iid] = (values, tags)
+            self.row_keys[iid] = (res[6], res[0])
+            order.append(iid)
+
+        # Удаление строк, которых больше нет
+        stale = [iid for iid in self.row_cache if iid not in rows]
+        if stale:
+            self.tree.delete(*stale)
+            for iid in stale:
+                del self.row_cache[iid]
+                self.row_keys.pop(iid, None)
+
+        # Если порядок оставшихся строк изменился, они переставляются
+        kept = [iid for iid in order if iid in self.row_cache]
+        if list(self.tree.get_children()) != kept:
+            for index, iid in enumerate(kept):
+                self.tree.move(iid, "", index)
+
+        # Добавление новых строк и обновление изменившихся
+        for index, iid in enumerate(order):
+            row = rows[iid]
+            cached = self.row_cache.get(iid)
+            if cached is None:
+                self.tree.insert("", index, iid=iid, values=row[0], tags=row[1])
+            elif cached != row:
+                self.tree.item(iid, values=row[0], tags=row[1])
+            self.row_cache[iid] = row
+
+    # Прокрутка таблицы
+    def on_tree_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        # При прокрутке к концу загружается следующая страница строк
+        if float(last) > 0.95 and self.has_more and not self.page_loading and not self.refresh_running:
+            self.load_next_page()
+
+    # Загрузка следующей страницы ресурсов
+    def load_next_page(self):
+        self.page_loading = True
+        after = func.page_key(self.resources[-1]) if self.resources else None
+
+        # Страница запрашивается по ключу последней загруженной строки
+        def fetch():
+            page = self.db.run(func.list_resources_page, after, PAGE_SIZE)
+            self.root.after(0, lambda: self.append_page(page, after))
+
+        threading.Thread(target=fetch, daemon=True).start()
+
+    # Добавление загруженной страницы
+    def append_page(self, page, after):
+        self.page_loading = False
+        # Список мог обновиться, пока загружалась страница
+        current = func.page_key(self.resources[-1]) if self.resources else None
+        if current != after:
+            return
+        self.resources = self.resources + page
+        self.loaded_count = max(PAGE_SIZE, len(self.resources))
+        self.has_more = len(page) >= PAGE_SIZE
+        self.render_rows()
 
     # Закрытие соединения с БД и закрытие главного окна
     def on_closing(self):
-        self.conn.close()
+        self.db.close()
         self.root.destroy()
 
 # Запуск приложения
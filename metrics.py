@@ -0,0 +1,229 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Журнал системы контроля целостности
+# Пока журнал не настроен (setup_logging), записи никуда не выводятся: без обработчика logging отправил бы их
+# в stderr через lastResort, и сообщения, которые уже напечатаны (report), появлялись бы дважды
+logger = logging.getLogger("ic")
+logger.addHandler(logging.NullHandler())
+
+# Реестр метрик
+"""
+Счетчики (counter), текущие значения (gauge) и суммарные времена (summary: _sum и _count)
+Метрика идентифицируется именем и набором меток, обновление защищено блокировкой,
+поэтому метрики можно обновлять из рабочих потоков пула
+В режиме процессов пула метрики hash_file считаются в дочерних процессах и в родительский не попадают
+"""
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {} # Имя -> тип метрики
+        self._help = {} # Имя -> описание
+        self._values = {} # (имя, метки) -> значение или [сумма, кол-во]
+
+    # Описание метрики
+    def describe(self, name: str, metric_type: str, help_text: str) -> None:
+        with self._lock:
+            self._types[name] = metric_type
+            self._help[name] = help_text
+
+    # Увеличение счетчика
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._types.setdefault(name, "counter")
+            self._values[key] = self._values.get(key, 0) + value
+
+    # Установка текущего значения
+    def set(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._types.setdefault(name, "gauge")
+            self._values[key] = value
+
+    # Учет длительности
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._types.setdefault(name, "summary")
+            entry = self._values.setdefault(key, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += 1
+
+    # Замер длительности блока with
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    # Значение метрики
+    """
+    Для summary возвращает (сумма, кол-во), для отсутствующей метрики - 0
+    """
+    def value(self, name: str, **labels):
+        with self._lock:
+            value = self._values.get((name, tuple(sorted(labels.items()))), 0)
+            return tuple(value) if isinstance(value, list) else value
+
+    # Сброс всех значений
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    # Метрики в текстовом формате Prometheus
+    def render(self) -> str:
+        with self._lock:
+            values = {key: (list(value) if isinstance(value, list) else value) for key, value in self._values.items()}
+            types = dict(self._types)
+            help_texts = dict(self._help)
+        lines = []
+        for name in sorted({name for name, _ in values}):
+            if name in help_texts:
+                lines.append(f"# HELP {name} {help_texts[name]}")
+            lines.append(f"# TYPE {name} {types.get(name, 'untyped')}")
+            for (metric_name, labels), value in sorted(values.items(), key=lambda item: item[0]):
+                if metric_name != name:
+                    continue
+                label_text = _format_labels(labels)
+                if isinstance(value, list):
+                    lines.append(f"{name}_sum{label_text} {value[0]:.6f}")
+                    lines.append(f"{name}_count{label_text} {value[1]}")
+                else:
+                    lines.append(f"{name}{label_text} {value}")
+        return "\n".join(lines) + "\n"
+
+    # Запись метрик в файл
+    """
+    Файл заменяется атомарно, поэтому подходит для textfile collector node_exporter
+    """
+    def write_textfile(self, path: str) -> None:
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metrics_")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(self.render())
+            os.replace(tmp_path, path)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+
+# Метки в текстовом формате Prometheus
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        escaped.append(f'{key}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+# Общий реестр процесса
+registry = Registry()
+inc = registry.inc
+set_gauge = registry.set
+observe = registry.observe
+timer = registry.timer
+
+registry.describe("ic_hash_files_total", "counter", "Прочитанные файлы")
+registry.describe("ic_hash_bytes_total", "counter", "Прочитанные байты")
+registry.describe("ic_hash_file_seconds", "summary", "Время расчета хэша файла")
+registry.describe("ic_hash_errors_total", "counter", "Ошибки чтения файлов и папок")
+registry.describe("ic_resource_hash_seconds", "summary", "Время расчета хэша ресурса")
+registry.describe("ic_db_query_seconds", "summary", "Время выполнения запросов к БД")
+registry.describe("ic_db_errors_total", "counter", "Ошибки запросов к БД")
+registry.describe("ic_check_results_total", "counter", "Результаты проверки ресурсов по статусам")
+registry.describe("ic_check_seconds", "summary", "Время проверки целостности")
+registry.describe("ic_throttle_seconds_total", "counter", "Время пауз щадящего режима по причинам")
+registry.describe("ic_background_cycle_seconds", "summary", "Время цикла фоновой проверки")
+registry.describe("ic_background_violations_total", "counter", "Нарушения, найденные фоновой проверкой")
+registry.describe("ic_background_last_cycle_timestamp_seconds", "gauge", "Время завершения последнего цикла фоновой проверки")
+registry.describe("ic_bulk_add_seconds", "summary", "Время массового добавления ресурсов")
+registry.describe("ic_hash_cache_hits_total", "counter", "Хэши файлов, взятые из кэша без чтения")
+registry.describe("ic_hash_cache_misses_total", "counter", "Хэши файлов, рассчитанные чтением (промахи кэша)")
+registry.describe("ic_agent_leased_total", "counter", "Ресурсы, взятые агентами в аренду")
+
+# HTTP-обработчик /metrics
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Запросы сборщика не пишутся в stderr
+    def log_message(self, format, *args):
+        logger.debug("metrics %s", format % args)
+
+# Запуск HTTP-сервера метрик
+"""
+Отдает метрики по адресу http://host:port/metrics из фонового потока
+Возвращает сервер (для остановки - shutdown())
+"""
+def start_http_server(port: int, host: str = "") -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Форматирование записей журнала в JSON
+"""
+Каждая запись - одна строка JSON с временем, уровнем, сообщением и полями, переданными через extra
+"""
+class JsonFormatter(logging.Formatter):
+    _reserved = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime"}
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        data.update({key: value for key, value in record.__dict__.items() if key not in self._reserved})
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+# Настройка журнала
+"""
+Направляет журнал "ic" в stream (по умолчанию stderr) с уровнем level, в JSON или в текстовом виде
+"""
+def setup_logging(level: str = "INFO", json_format: bool = False, stream=None) -> None:
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.handlers[:] = [handler]
+    logger.setLevel(level.upper())
+    logger.propagate = False
+
+# Журнал настроен
+"""
+Возвращает True, если у журнала "ic" есть обработчик, выводящий записи (после setup_logging)
+"""
+def logging_configured() -> bool:
+    return any(not isinstance(handler, logging.NullHandler) for handler in logger.handlers)
+
+# Сообщение об ошибке или событии
+"""
+Один канал на сообщение: если журнал настроен (CLI), запись уходит только в журнал, иначе (GUI) печатается
+text - полный текст сообщения (по умолчанию message), message - краткое описание события, в журнале оно
+передается в поле event вместе с полями fields, чтобы записи JSON можно было отбирать по событию
+"""
+def report(level: int, message: str, text: str = None, **fields) -> None:
+    if logging_configured():
+        logger.log(level, text or message, extra={"event": message, **fields})
+    else:
+        print(text or message)
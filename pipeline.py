@@ -0,0 +1,321 @@
+import asyncio
+import itertools
+import json
+import os
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
+from datetime import datetime
+import functions as func
+import metrics
+from db import Database
+from metrics import logger
+from throttle import Throttle
+
+# Необязательные драйверы: psycopg2 (ThreadedStore) и асинхронный psycopg 3 (PsycopgAsyncStore)
+try:
+    import psycopg2
+    import psycopg2.extras
+except ImportError:
+    psycopg2 = None
+try:
+    import psycopg
+except ImportError:
+    psycopg = None
+DRIVER_ERRORS = tuple(driver.Error for driver in (psycopg2, psycopg) if driver is not None) # Ошибки установленных драйверов
+
+# Настройки асинхронной проверки
+PIPELINE_QUEUE_SIZE = 64 # Размер очередей задач и результатов, при заполнении чтение ресурсов из БД приостанавливается
+PIPELINE_BATCH_SIZE = func.UPDATE_BATCH_SIZE # Кол-во проверенных ресурсов, записываемых в БД одной транзакцией
+
+_cursor_names = itertools.count(1) # Номера для уникальных имен серверных курсоров psycopg 3
+
+# Запросы хранилищ (одинаковы для psycopg2 и psycopg 3)
+# Ресурсы выбираются по условию functions.host_scope, строки сопоставляются по ключу (хост, путь)
+_RESOURCES_QUERY = """
+    SELECT resource_path, host, hash, hash_algorithm, ignore_patterns, file_size, file_mtime_ns, file_ctime_ns, file_inode, file_device
+    FROM resource_monitoring
+"""
+_MANIFEST_QUERY = """
+    SELECT rel_path, entry_type, file_size, file_mtime_ns, hash
+    FROM resource_files
+    WHERE COALESCE(host, '') = %s AND resource_path = %s
+"""
+_FINGERPRINT_UPDATE = """
+    UPDATE resource_monitoring
+    SET file_size = %s, file_mtime_ns = %s, file_ctime_ns = %s, file_inode = %s, file_device = %s
+    WHERE COALESCE(host, '') = %s AND resource_path = %s
+"""
+_SCHEDULE_UPDATE = f"""
+    UPDATE resource_monitoring
+    SET last_checked = %s, next_check = %s + COALESCE(check_interval, %s) * INTERVAL '1 second'
+    WHERE resource_path = ANY(%s) AND {func.host_scope()}
+"""
+
+# Хранилище на пуле соединений psycopg2
+"""
+Блокирующие вызовы psycopg2 выполняются в потоках (asyncio.to_thread) на соединениях из Database,
+поэтому задержки БД не останавливают цикл событий
+Ресурсы читаются серверным курсором порциями по RESOURCE_ITERSIZE
+Методы хранилища: resources, load_manifest, write_batch, save_run, close (см. PsycopgAsyncStore)
+"""
+class ThreadedStore:
+    def __init__(self, db: Database):
+        self.db = db
+
+    # Поток строк ресурсов
+    """
+    Читаются ресурсы хоста host (functions.host_scope), если передан resource_paths - только эти ресурсы
+    Возвращает асинхронный генератор строк (путь, хост, хэш, алгоритм, правила исключения, отпечаток...)
+    """
+    async def resources(self, host: str, resource_paths: list = None):
+        rows = self._stream(host, resource_paths)
+        try:
+            while True:
+                chunk = await asyncio.to_thread(lambda: list(itertools.islice(rows, func.RESOURCE_ITERSIZE)))
+                if not chunk:
+                    return
+                for row in chunk:
+                    yield row
+        finally:
+            await asyncio.to_thread(rows.close)
+
+    # Серверный курсор на отдельном соединении
+    def _stream(self, host: str, resource_paths: list = None):
+        query, params = func.scoped_resources_query(_RESOURCES_QUERY, resource_paths, host)
+        with self.db.connection() as conn:
+            yield from func.stream_query(conn, query, params)
+
+    # Сохраненный манифест папки
+    async def load_manifest(self, resource_path: str, resource_host: str = None) -> tuple:
+        return await asyncio.to_thread(self.db.run, func.load_folder_manifest, resource_path, resource_host)
+
+    # Запись пачки отпечатков и расписания
+    async def write_batch(self, fingerprint_updates: list, checked_paths: list, default_interval: int, host: str) -> None:
+        await asyncio.to_thread(self.db.run, _write_batch, fingerprint_updates, checked_paths, default_interval, host, retry=False)
+
+    # Сохранение проверки в check_runs и check_results
+    async def save_run(self, started_at: datetime, mode: str, results: dict, result_rows: list, bytes_hashed: int, stopped: bool, host: str = None) -> int:
+        return await asyncio.to_thread(self.db.run, func.save_check_run, started_at, mode, results, result_rows,
+                                       bytes_hashed, stopped, None, host, retry=False)
+
+    # Соединения принадлежат Database и закрываются вместе с ним
+    async def close(self) -> None:
+        pass
+
+# Запись пачки отпечатков и расписания на соединении psycopg2
+def _write_batch(conn, fingerprint_updates: list, checked_paths: list, default_interval: int, host: str) -> None:
+    try:
+        with conn.cursor() as cur:
+            if fingerprint_updates:
+                psycopg2.extras.execute_batch(cur, _FINGERPRINT_UPDATE, fingerprint_updates, page_size=1000)
+            if checked_paths:
+                checked_at = datetime.now()
+                cur.execute(_SCHEDULE_UPDATE, (checked_at, checked_at, default_interval, checked_paths, host))
+        conn.commit()
+    except psycopg2.Error as e:
+        print(f"Ошибка при записи результатов проверки в БД: {e}")
+        conn.rollback()
+
+# Хранилище на асинхронном драйвере psycopg 3
+"""
+conninfo - строка подключения libpq ("dbname=ic_db user=postgres host=localhost")
+Запросы выполняются без потоков, на время каждого чтения ресурсов открывается отдельное соединение,
+записи и манифесты идут через одно общее соединение (драйвер выполняет их по очереди)
+Если psycopg 3 не установлен, выбрасывает RuntimeError
+"""
+class PsycopgAsyncStore:
+    def __init__(self, conninfo: str):
+        if psycopg is None:
+            raise RuntimeError("Модуль psycopg (psycopg 3) не установлен")
+        self.conninfo = conninfo
+        self._conn = None
+        self._lock = asyncio.Lock()
+
+    # Общее соединение для записей и манифестов
+    async def _connection(self):
+        async with self._lock:
+            if self._conn is None or self._conn.closed:
+                self._conn = await psycopg.AsyncConnection.connect(self.conninfo)
+            return self._conn
+
+    # Поток строк ресурсов (см. ThreadedStore.resources)
+    async def resources(self, host: str, resource_paths: list = None):
+        query, params = func.scoped_resources_query(_RESOURCES_QUERY, resource_paths, host)
+        async with await psycopg.AsyncConnection.connect(self.conninfo) as conn:
+            async with conn.cursor(name=f"ic_async_stream_{next(_cursor_names)}") as cur:
+                cur.itersize = func.RESOURCE_ITERSIZE
+                await cur.execute(query, params)
+                async for row in cur:
+                    yield row
+
+    # Сохраненный манифест папки (см. functions.load_folder_manifest)
+    async def load_manifest(self, resource_path: str, resource_host: str = None) -> tuple:
+        conn = await self._connection()
+        files, dirs = {}, {}
+        async with conn.cursor() as cur:
+            await cur.execute(_MANIFEST_QUERY, (resource_host or "", resource_path))
+            for rel_path, entry_type, size, mtime_ns, entry_hash in await cur.fetchall():
+                if entry_type == "dir":
+                    dirs[rel_path] = entry_hash
+                else:
+                    files[rel_path] = (size, mtime_ns, entry_hash)
+        await conn.commit()
+        return files, dirs
+
+    # Запись пачки отпечатков и расписания
+    async def write_batch(self, fingerprint_updates: list, checked_paths: list, default_interval: int, host: str) -> None:
+        conn = await self._connection()
+        try:
+            async with conn.cursor() as cur:
+                if fingerprint_updates:
+                    await cur.executemany(_FINGERPRINT_UPDATE, fingerprint_updates)
+                if checked_paths:
+                    checked_at = datetime.now()
+                    await cur.execute(_SCHEDULE_UPDATE, (checked_at, checked_at, default_interval, checked_paths, host))
+            await conn.commit()
+        except psycopg.Error as e:
+            print(f"Ошибка при записи результатов проверки в БД: {e}")
+            await conn.rollback()
+
+    # Сохранение проверки в check_runs и check_results (запросы и значения - как в functions.save_check_run)
+    async def save_run(self, started_at: datetime, mode: str, results: dict, result_rows: list, bytes_hashed: int, stopped: bool, host: str = None) -> int:
+        conn = await self._connection()
+        run_query, results_query = func.check_run_queries()
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute(run_query, func.check_run_values(started_at, mode, results, bytes_hashed, stopped, None, host))
+                run_id = (await cur.fetchone())[0]
+                await cur.executemany(results_query, func.check_result_values(run_id, result_rows, None, host))
+            await conn.commit()
+            return run_id
+        except psycopg.Error as e:
+            print(f"Ошибка при сохранении результатов проверки: {e}")
+            await conn.rollback()
+            return None
+
+    # Закрытие общего соединения
+    async def close(self) -> None:
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+# Асинхронная проверка целостности
+"""
+Конвейер чтение из store -> workers обработчиков в executor -> запись пачками по batch_size, звенья связаны
+очередями размера queue_size, поэтому память не зависит от кол-ва ресурсов
+Параметры и результат - как у functions.check_all_hashes; при отмене полученные результаты записываются
+Возвращает словарь {(хост, путь): статус}
+"""
+async def check_pipeline(store, mode: str = func.CHECK_MODE_PARANOID, workers: int = None, resource_paths: list = None,
+                         changes: dict = None, record: bool = True, queue_size: int = None, batch_size: int = None,
+                         executor: Executor = None, throttle: Throttle = None, default_interval: int = None, host: str = None) -> dict:
+    loop = asyncio.get_running_loop()
+    host = host or func.LOCAL_HOST
+    workers = workers or func.HASH_WORKERS
+    batch_size = batch_size or PIPELINE_BATCH_SIZE
+    default_interval = default_interval or func.SCHEDULE_DEFAULT_INTERVAL
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    stop_flag = threading.Event() # Прерывание пауз throttle в рабочих потоках при отмене
+    cache = func.open_hash_cache(persist=mode == func.CHECK_MODE_FAST)
+    task_queue = asyncio.Queue(queue_size or PIPELINE_QUEUE_SIZE)
+    result_queue = asyncio.Queue(queue_size or PIPELINE_QUEUE_SIZE)
+    started_at = datetime.now()
+    results = {}
+    result_rows = []
+    fingerprint_updates = []
+    checked_paths = []
+    totals = {"bytes": 0}
+
+    # Чтение ресурсов и постановка задач
+    async def produce():
+        async for resource_path, resource_host, stored_hash, stored_algorithm, ignore_patterns, *fingerprint in store.resources(host, resource_paths):
+            fingerprint = tuple(fingerprint) if None not in fingerprint else None
+            task = {"path": resource_path, "host": resource_host, "algorithm": stored_algorithm, "ignore": func.resource_ignore_rules(ignore_patterns)}
+            manifest = None
+            if stored_hash and os.path.isdir(resource_path):
+                manifest = await store.load_manifest(resource_path, resource_host)
+            if stored_hash and mode == func.CHECK_MODE_FAST:
+                task["fingerprint"] = fingerprint
+                if manifest is not None:
+                    task["stored_files"] = manifest[0]
+            await task_queue.put((task, stored_hash, fingerprint, manifest))
+        for _ in range(workers):
+            await task_queue.put(None)
+
+    # Расчет хэшей в executor
+    async def hash_tasks():
+        while True:
+            item = await task_queue.get()
+            if item is None:
+                await result_queue.put(None)
+                return
+            task, *stored = item
+            result = await loop.run_in_executor(executor, func.hash_task, task, throttle, cache, stop_flag)
+            await result_queue.put((result, *stored))
+
+    # Запись накопленных отпечатков и расписания
+    async def flush():
+        if fingerprint_updates or checked_paths:
+            await store.write_batch(list(fingerprint_updates), list(checked_paths), default_interval, host)
+            fingerprint_updates.clear()
+            checked_paths.clear()
+
+    # Оценка и запись результатов
+    async def consume():
+        running = workers
+        while running:
+            item = await result_queue.get()
+            if item is None:
+                running -= 1
+                continue
+            result, stored_hash, stored_fingerprint, manifest = item
+            resource_path = result["path"]
+            key = (result["host"], resource_path)
+            totals["bytes"] += result.get("bytes", 0)
+            results[key], resource_changes, fingerprint = func.evaluate_check_result(result, stored_hash, stored_fingerprint, manifest)
+            if fingerprint:
+                fingerprint_updates.append((*fingerprint, result["host"] or "", resource_path))
+            if resource_changes and changes is not None:
+                changes[key] = resource_changes
+            metrics.inc("ic_check_results_total", status=results[key], mode=mode)
+            result_rows.append((resource_path, results[key], datetime.now(), json.dumps(resource_changes) if resource_changes else None, result["host"]))
+            checked_paths.append(resource_path)
+            if len(checked_paths) >= batch_size:
+                await flush()
+
+    jobs = [asyncio.create_task(produce()), *(asyncio.create_task(hash_tasks()) for _ in range(workers)), asyncio.create_task(consume())]
+    stopped = False
+    try:
+        await asyncio.gather(*jobs)
+    except BaseException:
+        stopped = True
+        stop_flag.set()
+        for job in jobs:
+            job.cancel()
+        await asyncio.gather(*jobs, return_exceptions=True)
+        raise
+    finally:
+        try:
+            await asyncio.shield(_finish(store, flush, started_at, mode, results, result_rows, totals["bytes"], stopped, record, host))
+        finally:
+            func.close_hash_cache(cache)
+            if own_executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+    return results
+
+# Завершение проверки: последняя пачка, метрики и запись проверки
+async def _finish(store, flush, started_at: datetime, mode: str, results: dict, result_rows: list, bytes_hashed: int, stopped: bool, record: bool, host: str) -> None:
+    await flush()
+    duration = (datetime.now() - started_at).total_seconds()
+    metrics.observe("ic_check_seconds", duration, mode=mode)
+    counts = {}
+    for status in results.values():
+        counts[status] = counts.get(status, 0) + 1
+    logger.info("Проверка целостности завершена", extra={"mode": mode, "seconds": round(duration, 3), "bytes": bytes_hashed,
+                                                         "counts": counts, "stopped": stopped, "pipeline": True})
+    if stopped:
+        print("Проверка целостности остановлена пользователем")
+    if record and results:
+        await store.save_run(started_at, mode, results, result_rows, bytes_hashed, stopped, host)
@@ -0,0 +1,187 @@
+import threading
+import time
+from datetime import datetime
+from typing import Callable
+import functions as func
+import metrics
+from throttle import Throttle
+
+# Необязательный драйвер PostgreSQL (см. functions.py)
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+# Ресурсы, которые пора проверять
+"""
+Ресурсы с наступившим next_check (или без него) по убыванию приоритета, среди равных - сначала давно ожидающие
+Выбираются ресурсы хоста host (по умолчанию LOCAL_HOST): без хоста и закрепленные за этим хостом (host_scope),
+ресурсы других хостов проверяют их агенты (agents.run_agent)
+Возвращает список (путь, приоритет, сохраненный размер) и время ближайшей будущей проверки (None, если такой нет)
+"""
+def get_due_resources(conn, now: datetime = None, host: str = None) -> tuple:
+    now = now or datetime.now()
+    host = host or func.LOCAL_HOST
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT resource_path, priority, file_size
+                FROM resource_monitoring
+                WHERE {func.host_scope()} AND (next_check IS NULL OR next_check <= %s)
+                ORDER BY priority DESC, next_check NULLS FIRST
+            """, (host, now))
+            due = cur.fetchall()
+            cur.execute(f"SELECT MIN(next_check) FROM resource_monitoring WHERE {func.host_scope()} AND next_check > %s", (host, now))
+            next_due = cur.fetchone()[0]
+        conn.commit()
+        return due, next_due
+    except psycopg2.Error as e:
+        print(f"Ошибка при получении очереди проверок: {e}")
+        conn.rollback()
+        return [], None
+
+# Отбор ресурсов в пределах объема
+"""
+Берет ресурсы по порядку, пока суммарный сохраненный размер не превысит max_bytes
+Первый ресурс берется всегда, чтобы большой ресурс не откладывался бесконечно
+Ресурсы без сохраненного размера считаются нулевыми
+"""
+def select_within_budget(due: list, max_bytes: int = None) -> list:
+    if max_bytes is None:
+        return [row[0] for row in due]
+    selected, total = [], 0
+    for resource_path, _, file_size in due:
+        if selected and total + (file_size or 0) > max_bytes:
+            break
+        selected.append(resource_path)
+        total += file_size or 0
+    return selected
+
+# Флаг остановки цикла планировщика
+"""
+Считается установленным, если установлен внешний флаг остановки или наступил срок deadline (time.monotonic)
+"""
+class _CycleStop(threading.Event):
+    def __init__(self, stop_event: threading.Event = None, deadline: float = None):
+        super().__init__()
+        self.stop_event = stop_event
+        self.deadline = deadline
+
+    def is_set(self) -> bool:
+        if self.stop_event is not None and self.stop_event.is_set():
+            return True
+        return self.deadline is not None and time.monotonic() >= self.deadline or super().is_set()
+
+# Периодичность полной проверки
+"""
+В выборочном режиме (CHECK_MODE_SAMPLED) раз в full_interval секунд (по умолчанию FULL_CHECK_INTERVAL) очередной
+полный проход фоновой проверки выполняется в режиме CHECK_MODE_PARANOID, чтобы изменения вне выборки
+обнаруживались не позже этого срока; остальные режимы не меняются
+"""
+class FullCheckCadence:
+    def __init__(self, mode: str, full_interval: float = None):
+        self.mode = mode
+        self.full_interval = full_interval or func.FULL_CHECK_INTERVAL
+        self.next_full = time.monotonic() + self.full_interval
+
+    # Режим очередного полного прохода, при наступлении срока отсчитывает следующий
+    def cycle_mode(self) -> str:
+        if self.mode != func.CHECK_MODE_SAMPLED or time.monotonic() < self.next_full:
+            return self.mode
+        self.next_full = time.monotonic() + self.full_interval
+        return func.CHECK_MODE_PARANOID
+
+# Один цикл проверки по расписанию
+"""
+Проверяет ресурсы, которым пора, в порядке приоритета
+Бюджет цикла: max_bytes - объем по сохраненным размерам, max_runtime - время, после которого пул
+перестает брать новые ресурсы; непроверенные ресурсы остаются в очереди на следующий цикл
+Если наступил срок полной проверки (cadence), вместо очереди проверяются все ресурсы в полном режиме
+Возвращает результаты проверки и время ближайшей будущей проверки
+"""
+def run_scheduled_check(conn, stop_event: threading.Event, mode: str, default_interval: int, max_runtime: float = None, max_bytes: int = None, throttle: Throttle = None, cadence: FullCheckCadence = None) -> tuple:
+    if cadence is not None and cadence.cycle_mode() != mode:
+        print(f"Начало полной проверки по расписанию в {datetime.now()}")
+        results = func.check_all_hashes(conn, stop_event, mode=func.CHECK_MODE_PARANOID, default_interval=default_interval, throttle=throttle)
+        return results, get_due_resources(conn)[1]
+    due, next_due = get_due_resources(conn)
+    resource_paths = select_within_budget(due, max_bytes)
+    if not resource_paths:
+        return {}, next_due
+    if len(resource_paths) < len(due):
+        print(f"Проверка по расписанию: {len(resource_paths)} из {len(due)} ресурсов в пределах бюджета")
+    cycle_stop = _CycleStop(stop_event, time.monotonic() + max_runtime if max_runtime else None)
+    results = func.check_all_hashes(conn, cycle_stop, mode=mode, resource_paths=resource_paths, default_interval=default_interval, throttle=throttle)
+    if len(results) < len(due):
+        next_due = datetime.now()
+    return results, next_due
+
+# Фоновая проверка по расписанию
+"""
+Циклически проверяет ресурсы, которым пора (run_scheduled_check), и ждет до ближайшей следующей проверки,
+но не меньше SCHEDULER_MIN_SLEEP и не больше SCHEDULER_MAX_SLEEP секунд
+default_interval - интервал ресурсов без собственного check_interval
+io_rate - средний объем чтения в МБ/с: бюджет цикла - io_rate, умноженный на время с начала прошлого цикла
+full_interval - период полной проверки в выборочном режиме (FullCheckCadence)
+После каждой проверки вызывает on_results(results); если он вернул False, проверка прекращается
+"""
+def run_scheduler(conn, default_interval: int, stop_event: threading.Event, mode: str, on_results: Callable[[dict], bool], max_runtime: float = None, io_rate: float = None, throttle: Throttle = None, full_interval: float = None) -> None:
+    cadence = FullCheckCadence(mode, full_interval)
+    last_cycle = None
+    while not stop_event.is_set():
+        cycle_started = time.monotonic()
+        max_bytes = None
+        if io_rate:
+            elapsed = cycle_started - last_cycle if last_cycle is not None else func.SCHEDULER_MAX_SLEEP
+            max_bytes = int(io_rate * 2**20 * min(max(elapsed, func.SCHEDULER_MIN_SLEEP), func.SCHEDULER_MAX_SLEEP))
+        last_cycle = cycle_started
+        with func.use_connection(conn) as cycle_conn, metrics.timer("ic_background_cycle_seconds", kind="scheduled"):
+            results, next_due = run_scheduled_check(cycle_conn, stop_event, mode, default_interval, max_runtime, max_bytes, throttle, cadence)
+        if stop_event.is_set():
+            break
+        if results and not on_results(results):
+            break
+        delay = func.SCHEDULER_MAX_SLEEP
+        if next_due is not None:
+            delay = (next_due - datetime.now()).total_seconds()
+        stop_event.wait(min(max(delay, func.SCHEDULER_MIN_SLEEP), func.SCHEDULER_MAX_SLEEP))
+
+# Фоновая проверка по событиям файловой системы
+"""
+Ставит наблюдение inotify на все ресурсы (watcher.ResourceWatcher)
+Проверяет только ресурсы, в которых были события, после затишья debounce секунд
+Раз в interval секунд, а также при переполнении очереди событий выполняется полная проверка всех ресурсов
+и обновляется набор наблюдаемых ресурсов; в выборочном режиме раз в full_interval секунд она выполняется
+в полном режиме (FullCheckCadence)
+После каждой проверки вызывает on_results(results); если он вернул False, наблюдение прекращается
+"""
+def run_event_watch(conn, interval: int, stop_event: threading.Event, mode: str, on_results: Callable[[dict], bool], debounce: float, throttle: Throttle = None, full_interval: float = None) -> None:
+    from watcher import ResourceWatcher
+    cadence = FullCheckCadence(mode, full_interval)
+    resource_watcher = ResourceWatcher(debounce=debounce)
+    next_sweep = 0
+    try:
+        while not stop_event.is_set():
+            resource_watcher.poll(timeout=0.5)
+            if stop_event.is_set():
+                break
+            if resource_watcher.overflowed or time.monotonic() >= next_sweep:
+                sweep_mode = cadence.cycle_mode()
+                print(f"Начало полной фоновой проверки ({sweep_mode}) в {datetime.now()}")
+                with func.use_connection(conn) as cycle_conn, metrics.timer("ic_background_cycle_seconds", kind="full"):
+                    resource_watcher.sync([row[0] for row in func.stream_query(cycle_conn, *func.scoped_resources_query("SELECT resource_path FROM resource_monitoring"))])
+                    resource_watcher.overflowed = False
+                    resource_watcher.pending.clear()
+                    results = func.check_all_hashes(cycle_conn, stop_event, mode=sweep_mode, throttle=throttle)
+                next_sweep = time.monotonic() + interval
+            else:
+                touched = resource_watcher.pop_ready()
+                if not touched:
+                    continue
+                print(f"Проверка изменённых ресурсов ({len(touched)}) в {datetime.now()}")
+                with func.use_connection(conn) as cycle_conn, metrics.timer("ic_background_cycle_seconds", kind="events"):
+                    results = func.check_all_hashes(cycle_conn, stop_event, mode=mode, resource_paths=touched, throttle=throttle)
+            if stop_event.is_set() or not on_results(results):
+                break
+    finally:
+        resource_watcher.close()
@@ -0,0 +1,650 @@
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Iterable, Iterator
+import functions as func
+import metrics
+from db import Database
+from metrics import logger
+from throttle import Throttle
+
+# Необязательный драйвер PostgreSQL: без него доступна только встроенная БД
+try:
+    import psycopg2
+    import psycopg2.extras
+except ImportError:
+    psycopg2 = None
+
+# Хранилища данных
+"""
+PostgresStorage - сервер PostgreSQL через пул Database и функции functions.py
+SQLiteStorage - встроенная БД в одном файле для агентов на отдельных хостах: без сервера и сетевых задержек
+Оба хранилища предоставляют одинаковые методы: init, add_resources, remove_resource, iter_resources,
+last_statuses, update_hashes, check, close и версию схемы schema_version. Остальные операции (расписание,
+история, фоновая проверка, выборочный режим, проверка части ресурсов) доступны только для PostgreSQL
+через PostgresStorage.db
+"""
+
+# Хранилище на сервере PostgreSQL
+class PostgresStorage:
+    schema_version = func.SCHEMA_VERSION
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    # Создание или обновление схемы
+    def init(self) -> bool:
+        return self.db.run(func.init_db)
+
+    # Массовое добавление ресурсов (см. functions.add_resources_bulk)
+    def add_resources(self, resource_paths: Iterable[str], ignore_patterns: list = None, batch_size: int = None, host: str = None) -> dict:
+        return self.db.run(func.add_resources_bulk, resource_paths, ignore_patterns, batch_size, host, retry=False)
+
+    # Удаление ресурса
+    def remove_resource(self, resource_path: str, host: str = None) -> bool:
+        return self.db.run(func.remove_resource_from_db, resource_path, host)
+
+    # Поток ресурсов (см. functions.iter_resources)
+    def iter_resources(self) -> Iterator[tuple]:
+        with self.db.connection() as conn:
+            yield from func.iter_resources(conn)
+
+    # Последние статусы ресурсов
+    def last_statuses(self) -> dict:
+        return self.db.run(func.get_last_statuses)
+
+    # Расчет эталонов (см. functions.update_all_hashes)
+    def update_hashes(self, stop_flag: threading.Event = None, **kwargs) -> int:
+        return self.db.run(func.update_all_hashes, stop_flag, retry=False, **kwargs)
+
+    # Проверка целостности (см. functions.check_all_hashes)
+    def check(self, stop_flag: threading.Event = None, **kwargs) -> dict:
+        return self.db.run(func.check_all_hashes, stop_flag, retry=False, **kwargs)
+
+    # Закрытие пула
+    def close(self) -> None:
+        self.db.close()
+
+# Миграции встроенной БД
+"""
+Список (версия, описание, SQL-скрипт) ведется так же, как functions.MIGRATIONS: таблицы и колонки - те же,
+что в схеме PostgreSQL, и изменение схемы PostgreSQL, затрагивающее эти таблицы, добавляет сюда свою версию
+Время хранится строками ISO 8601 (сравниваются как строки), правила исключения - JSON-списком
+Колонка check_runs.synced - проверка уже отправлена на центральный сервер (SQLiteStorage.sync_to)
+Версия 1 идемпотентна и приводит к ней базы, созданные до появления версий; примененная версия хранится
+в PRAGMA user_version, примененные версии не меняются
+"""
+SQLITE_MIGRATIONS = [
+    (1, "Базовая схема", f"""
+    CREATE TABLE IF NOT EXISTS resource_monitoring (
+        resource_path TEXT PRIMARY KEY,
+        resource_name TEXT,
+        resource_type TEXT,
+        added_date TEXT,
+        hash TEXT,
+        hash_date TEXT,
+        file_size INTEGER,
+        file_mtime_ns INTEGER,
+        file_ctime_ns INTEGER,
+        file_inode INTEGER,
+        file_device INTEGER,
+        hash_algorithm TEXT NOT NULL DEFAULT '{func.DEFAULT_HASH_ALGORITHM}',
+        check_interval INTEGER,
+        priority INTEGER NOT NULL DEFAULT 0,
+        next_check TEXT,
+        last_checked TEXT,
+        ignore_patterns TEXT
+    );
+    CREATE INDEX IF NOT EXISTS resource_monitoring_list_idx ON resource_monitoring (COALESCE(added_date, ''), resource_path);
+    CREATE TABLE IF NOT EXISTS resource_files (
+        resource_path TEXT NOT NULL,
+        rel_path TEXT NOT NULL,
+        entry_type TEXT NOT NULL,
+        file_size INTEGER,
+        file_mtime_ns INTEGER,
+        hash TEXT,
+        PRIMARY KEY (resource_path, rel_path)
+    );
+    CREATE TABLE IF NOT EXISTS hash_history (
+        resource_path TEXT NOT NULL,
+        hash TEXT,
+        hash_algorithm TEXT,
+        hash_date TEXT,
+        archived_date TEXT
+    );
+    CREATE TABLE IF NOT EXISTS check_runs (
+        run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        started_at TEXT NOT NULL,
+        finished_at TEXT,
+        duration_seconds REAL,
+        check_mode TEXT,
+        total_count INTEGER,
+        passed_count INTEGER,
+        failed_count INTEGER,
+        unavailable_count INTEGER,
+        no_hash_count INTEGER,
+        bytes_hashed INTEGER,
+        stopped INTEGER NOT NULL DEFAULT 0,
+        synced INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS check_results (
+        run_id INTEGER NOT NULL REFERENCES check_runs (run_id) ON DELETE CASCADE,
+        resource_path TEXT NOT NULL,
+        status TEXT NOT NULL,
+        checked_at TEXT NOT NULL,
+        details TEXT
+    );
+    CREATE INDEX IF NOT EXISTS check_results_path_idx ON check_results (resource_path, checked_at DESC);
+    CREATE INDEX IF NOT EXISTS check_runs_unsynced_idx ON check_runs (run_id) WHERE synced = 0;
+    """),
+    (2, "Хост и агент проверок и результатов", """
+    ALTER TABLE check_runs ADD COLUMN agent_id TEXT;
+    ALTER TABLE check_runs ADD COLUMN host TEXT;
+    ALTER TABLE check_results ADD COLUMN host TEXT;
+    ALTER TABLE check_results ADD COLUMN agent_id TEXT;
+    """),
+    (3, "Хост ресурса в результатах проверки", """
+    ALTER TABLE check_results ADD COLUMN resource_host TEXT;
+    """),
+    (4, "Хост встроенной БД", """
+    CREATE TABLE IF NOT EXISTS storage_info (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    """),
+]
+SQLITE_SCHEMA_VERSION = SQLITE_MIGRATIONS[-1][0] # Версия встроенной схемы, которую ожидает этот код
+
+SYNC_BATCH_SIZE = 1000 # Кол-во строк, отправляемых на центральный сервер одним запросом
+
+# Время в формате хранения SQLite
+def _ts(value: datetime) -> str:
+    return value.isoformat(sep=" ") if value is not None else None
+
+# Время из формата хранения SQLite
+def _dt(value: str) -> datetime:
+    return datetime.fromisoformat(value) if value else None
+
+# Значение в формате хранения SQLite: время - строкой, признак - числом
+def _sqlite_value(value):
+    if isinstance(value, datetime):
+        return _ts(value)
+    return int(value) if isinstance(value, bool) else value
+
+# Встроенное хранилище SQLite
+"""
+Файл открывается в режиме WAL (чтение не блокирует запись), synchronous=NORMAL
+Все запросы идут через одно соединение под блокировкой, записи выполняются пачками по UPDATE_BATCH_SIZE
+в одной транзакции (executemany)
+Расчет хэшей - тот же пул hash_resources и та же оценка результатов evaluate_check_result, что и для PostgreSQL
+Хост встроенной БД (host) записывается в storage_info при первом init (LOCAL_HOST) и не меняется: с ним
+записываются проверки и ресурсы отправляются на сервер (sync_to)
+Выборочный режим и проверка части ресурсов не поддерживаются (check выбрасывает ValueError)
+"""
+class SQLiteStorage:
+    schema_version = SQLITE_SCHEMA_VERSION
+
+    def __init__(self, path: str):
+        self.path = path
+        self.host = func.LOCAL_HOST # До init - текущий хост
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        print(f"Открыта встроенная база данных {path}")
+
+    # Транзакция под блокировкой
+    """
+    Фиксируется при успешном выходе из блока, откатывается при исключении
+    Возвращает курсор
+    """
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            started = time.perf_counter()
+            try:
+                with self._conn:
+                    yield self._conn.cursor()
+            except sqlite3.Error:
+                metrics.inc("ic_db_errors_total", kind="sqlite")
+                raise
+            finally:
+                metrics.observe("ic_db_query_seconds", time.perf_counter() - started, operation="SQLITE")
+
+    # Создание или обновление схемы
+    """
+    Применяет не выполненные миграции SQLITE_MIGRATIONS по порядку, каждую в своей транзакции вместе с новой версией
+    Если схема файла новее, чем знает этот код, изменения не выполняются и возвращается False (как functions.init_db)
+    Записывает хост встроенной БД, если он еще не записан, и читает его в host
+    """
+    def init(self) -> bool:
+        try:
+            with self._lock:
+                applied = self._conn.execute("PRAGMA user_version").fetchone()[0]
+                if applied > SQLITE_SCHEMA_VERSION:
+                    print(f"Схема встроенной БД версии {applied} новее поддерживаемой ({SQLITE_SCHEMA_VERSION}), обновите программу")
+                    return False
+                for version, description, script in SQLITE_MIGRATIONS:
+                    if version <= applied:
+                        continue
+                    self._conn.executescript(f"BEGIN; {script}; PRAGMA user_version = {version}; COMMIT;")
+                    logger.info("Применена миграция схемы встроенной БД", extra={"version": version, "description": description})
+            with self._transaction() as cur:
+                cur.execute("INSERT OR IGNORE INTO storage_info (key, value) VALUES ('host', ?)", (func.LOCAL_HOST,))
+                self.host = cur.execute("SELECT value FROM storage_info WHERE key = 'host'").fetchone()[0]
+            return True
+        except sqlite3.Error as e:
+            if self._conn.in_transaction:
+                self._conn.rollback()
+            print(f"Ошибка при создании схемы БД: {e}")
+            return False
+
+    # Массовое добавление ресурсов
+    """
+    Как functions.add_resources_bulk: пачки по batch_size через INSERT ... ON CONFLICT DO NOTHING
+    host не сохраняется: ресурсы встроенной БД проверяются на ее хосте (self.host, с ним sync_to отправляет их на сервер)
+    Возвращает словарь со списками added, existing и failed
+    """
+    def add_resources(self, resource_paths: Iterable[str], ignore_patterns: list = None, batch_size: int = None, host: str = None) -> dict:
+        batch_size = batch_size or func.BULK_INSERT_BATCH_SIZE
+        results = {"added": [], "existing": [], "failed": []}
+        batch, seen = [], set()
+
+        def flush():
+            try:
+                with self._transaction() as cur:
+                    for path, name, rtype, added, patterns in batch:
+                        cur.execute("""
+                            INSERT INTO resource_monitoring (resource_path, resource_name, resource_type, added_date, ignore_patterns)
+                            VALUES (?, ?, ?, ?, ?)
+                            ON CONFLICT (resource_path) DO NOTHING
+                        """, (path, name, rtype, _ts(added), json.dumps(patterns) if patterns else None))
+                        results["added" if cur.rowcount > 0 else "existing"].append(path)
+            except sqlite3.Error as e:
+                print(f"Ошибка при добавлении пачки из {len(batch)} ресурсов в БД: {e}")
+                results["failed"].extend(row[0] for row in batch)
+            batch.clear()
+
+        for resource_path in resource_paths:
+            resource_path = os.path.abspath(resource_path)
+            if resource_path in seen:
+                continue
+            seen.add(resource_path)
+            row = func._resource_row(resource_path, ignore_patterns)
+            if row is None:
+                results["failed"].append(resource_path)
+                continue
+            batch.append(row)
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+        return results
+
+    # Удаление ресурса и его манифеста (host не используется, см. add_resources)
+    def remove_resource(self, resource_path: str, host: str = None) -> bool:
+        try:
+            with self._transaction() as cur:
+                cur.execute("DELETE FROM resource_monitoring WHERE resource_path = ?", (resource_path,))
+                removed = cur.rowcount > 0
+                cur.execute("DELETE FROM resource_files WHERE resource_path = ?", (resource_path,))
+        except sqlite3.Error as e:
+            print(f"Ошибка при удалении ресурса {resource_path}: {e}")
+            return False
+        print(f"Ресурс {resource_path} успешно удалён из БД" if removed else f"Ресурс {resource_path} не найден в базе данных")
+        return removed
+
+    # Поток строк запроса (см. functions.stream_query)
+    """
+    Строки читаются курсором отдельного соединения по мере обработки, поэтому таблица не загружается в память целиком,
+    а запись пачек во время чтения не блокируется (WAL)
+    """
+    def _stream(self, query: str, params: tuple = ()) -> Iterator[tuple]:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        try:
+            yield from conn.execute(query, params)
+        finally:
+            conn.close()
+
+    # Кол-во ресурсов и их суммарный сохраненный размер (см. functions.count_resources)
+    def _count_resources(self) -> tuple:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*), COALESCE(SUM(file_size), 0) FROM resource_monitoring").fetchone()
+
+    # Поток ресурсов в формате functions.iter_resources (хост - None, см. add_resources)
+    def iter_resources(self) -> Iterator[tuple]:
+        for path, name, rtype, added, hash_value, hash_date in self._stream("""
+            SELECT resource_path, resource_name, resource_type, added_date, hash, hash_date
+            FROM resource_monitoring
+            ORDER BY COALESCE(added_date, ''), resource_path
+        """):
+            yield path, name, rtype, _dt(added), hash_value, _dt(hash_date), None
+
+    # Последние статусы ресурсов (см. functions.get_last_statuses)
+    def last_statuses(self) -> dict:
+        with self._lock:
+            return {(None, path): status for path, status in self._conn.execute("""
+                SELECT resource_path, status FROM (
+                    SELECT c.resource_path, c.status,
+                           ROW_NUMBER() OVER (PARTITION BY c.resource_path ORDER BY c.checked_at DESC) AS position
+                    FROM check_results c
+                    JOIN resource_monitoring r ON r.resource_path = c.resource_path
+                    WHERE r.hash_date IS NULL OR c.checked_at >= r.hash_date
+                )
+                WHERE position = 1
+            """)}
+
+    # Сохраненный манифест папки (см. functions.load_folder_manifest)
+    def load_folder_manifest(self, resource_path: str) -> tuple:
+        files, dirs = {}, {}
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT rel_path, entry_type, file_size, file_mtime_ns, hash FROM resource_files WHERE resource_path = ?
+            """, (resource_path,)).fetchall()
+        for rel_path, entry_type, size, mtime_ns, entry_hash in rows:
+            if entry_type == "dir":
+                dirs[rel_path] = entry_hash
+            else:
+                files[rel_path] = (size, mtime_ns, entry_hash)
+        return files, dirs
+
+    # Запись пачки эталонов (см. functions._flush_hash_updates)
+    def _flush_hash_updates(self, rows: list, manifests: list) -> int:
+        if not rows:
+            return 0
+        try:
+            with self._transaction() as cur:
+                cur.executemany("""
+                    INSERT INTO hash_history (resource_path, hash, hash_algorithm, hash_date, archived_date)
+                    SELECT resource_path, hash, hash_algorithm, hash_date, ?
+                    FROM resource_monitoring
+                    WHERE resource_path = ? AND hash IS NOT NULL AND (hash <> ? OR hash_algorithm <> ?)
+                """, [(hash_date, path, hash_value, algorithm) for path, hash_value, algorithm, hash_date, *_ in rows])
+                cur.executemany("""
+                    UPDATE resource_monitoring
+                    SET hash = ?, hash_algorithm = ?, hash_date = ?, file_size = ?, file_mtime_ns = ?, file_ctime_ns = ?,
+                        file_inode = ?, file_device = ?
+                    WHERE resource_path = ?
+                """, [(*values, path) for path, *values in rows])
+                cur.executemany("DELETE FROM resource_files WHERE resource_path = ?", [(path,) for path, _, _ in manifests])
+                entries = []
+                for path, files, dirs in manifests:
+                    entries += [(path, rel_path, "file", size, mtime_ns, file_hash) for rel_path, size, mtime_ns, file_hash in files]
+                    entries += [(path, rel_dir, "dir", None, None, dir_hash) for rel_dir, dir_hash in dirs.items()]
+                cur.executemany("INSERT INTO resource_files VALUES (?, ?, ?, ?, ?, ?)", entries)
+            return len(rows)
+        except sqlite3.Error as e:
+            print(f"Ошибка при записи пачки из {len(rows)} хэшей в БД: {e}")
+            return 0
+
+    # Расчет эталонов (параметры - как у functions.update_all_hashes)
+    def update_hashes(self, stop_flag: threading.Event = None, workers: int = None, use_processes: bool = None,
+                      algorithm: str = None, batch_size: int = None, progress_callback: Callable[[dict], None] = None,
+                      throttle: Throttle = None) -> int:
+        if algorithm is not None and algorithm not in func.HASH_ALGORITHMS:
+            print(f"Алгоритм хэширования {algorithm} недоступен")
+            return 0
+        batch_size = batch_size or func.UPDATE_BATCH_SIZE
+        total, total_bytes = self._count_resources()
+        if not total:
+            print("В базе данных нет ресурсов для расчета хэшей")
+            return 0
+        algorithms = {} # Алгоритмы ресурсов, переданных в пул и еще не рассчитанных
+
+        def generate_tasks():
+            for path, stored_algorithm, patterns in self._stream("SELECT resource_path, hash_algorithm, ignore_patterns FROM resource_monitoring"):
+                algorithms[path] = algorithm or stored_algorithm
+                yield {"path": path, "algorithm": algorithms[path], "ignore": func.resource_ignore_rules(json.loads(patterns) if patterns else None)}
+
+        progress = None
+        if progress_callback is not None:
+            progress = func.ProgressTracker(progress_callback, total, total_bytes)
+        updated_count = 0
+        rows, manifests = [], []
+        cache = func.open_hash_cache()
+        try:
+            for result in func.hash_resources(generate_tasks(), stop_flag, workers, use_processes, progress, throttle, cache):
+                resource_algorithm = algorithms.pop(result["path"])
+                if not result["hash"]:
+                    func._resource_message(f"Не удалось рассчитать хэш для {result['path']}, пропускаем", path=result["path"], status="unavailable")
+                    continue
+                rows.append((result["path"], result["hash"], resource_algorithm, _ts(datetime.now()), *(result["fingerprint"] or (None,) * 5)))
+                if "files" in result:
+                    manifests.append((result["path"], result["files"], result["dirs"]))
+                if len(rows) >= batch_size:
+                    updated_count += self._flush_hash_updates(rows, manifests)
+                    rows, manifests = [], []
+        finally:
+            func.close_hash_cache(cache)
+        updated_count += self._flush_hash_updates(rows, manifests)
+        if progress is not None:
+            progress.emit(force=True)
+        if stop_flag and stop_flag.is_set():
+            print(f"Расчёт хэшей остановлен, сохранено {updated_count} хэшей")
+        else:
+            print(f"Хэши успешно рассчитаны и обновлены для {updated_count} ресурсов")
+        return updated_count
+
+    # Проверка целостности (параметры - как у functions.check_all_hashes)
+    """
+    Отпечатки и расписание записываются пачками по UPDATE_BATCH_SIZE, проверка сохраняется в check_runs и check_results
+    Выборочного режима и отбора по resource_paths во встроенной БД нет: выбрасывает ValueError
+    Возвращает словарь {(None, путь): статус}, как у functions.check_all_hashes
+    """
+    def check(self, stop_flag: threading.Event = None, workers: int = None, use_processes: bool = None,
+              mode: str = func.CHECK_MODE_PARANOID, changes: dict = None, record: bool = True,
+              resource_paths: list = None, progress_callback: Callable[[dict], None] = None,
+              default_interval: int = None, throttle: Throttle = None) -> dict:
+        if mode == func.CHECK_MODE_SAMPLED:
+            raise ValueError("Режим sampled не поддерживается встроенной БД")
+        if resource_paths is not None:
+            raise ValueError("Проверка части ресурсов не поддерживается встроенной БД")
+        started_at = datetime.now()
+        total, total_bytes = self._count_resources()
+        if not total:
+            print("В базе данных нет ресурсов для проверки")
+            return {}
+        stored, manifests = {}, {}
+
+        def generate_tasks():
+            for resource_path, stored_hash, stored_algorithm, patterns, *fingerprint in self._stream("""
+                SELECT resource_path, hash, hash_algorithm, ignore_patterns, file_size, file_mtime_ns, file_ctime_ns, file_inode, file_device
+                FROM resource_monitoring
+            """):
+                fingerprint = tuple(fingerprint) if None not in fingerprint else None
+                stored[resource_path] = (stored_hash, fingerprint)
+                task = {"path": resource_path, "algorithm": stored_algorithm,
+                        "ignore": func.resource_ignore_rules(json.loads(patterns) if patterns else None)}
+                if stored_hash and os.path.isdir(resource_path):
+                    manifests[resource_path] = self.load_folder_manifest(resource_path)
+                if stored_hash and mode == func.CHECK_MODE_FAST:
+                    task["fingerprint"] = fingerprint
+                    if resource_path in manifests:
+                        task["stored_files"] = manifests[resource_path][0]
+                yield task
+
+        progress = None
+        if progress_callback is not None:
+            progress = func.ProgressTracker(progress_callback, total, total_bytes if mode == func.CHECK_MODE_PARANOID else None)
+        results, result_rows, fingerprint_updates, checked_paths = {}, [], [], []
+        bytes_hashed = 0
+
+        def flush_updates():
+            checked_at = datetime.now()
+            next_check = default_interval or func.SCHEDULE_DEFAULT_INTERVAL
+            with self._transaction() as cur:
+                cur.executemany("""
+                    UPDATE resource_monitoring
+                    SET file_size = ?, file_mtime_ns = ?, file_ctime_ns = ?, file_inode = ?, file_device = ?
+                    WHERE resource_path = ?
+                """, fingerprint_updates)
+                cur.executemany("""
+                    UPDATE resource_monitoring
+                    SET last_checked = ?, next_check = datetime(?, '+' || COALESCE(check_interval, ?) || ' seconds')
+                    WHERE resource_path = ?
+                """, [(_ts(checked_at), _ts(checked_at), next_check, path) for path in checked_paths])
+            fingerprint_updates.clear()
+            checked_paths.clear()
+
+        cache = func.open_hash_cache(persist=mode == func.CHECK_MODE_FAST)
+        try:
+            for result in func.hash_resources(generate_tasks(), stop_flag, workers, use_processes, progress, throttle, cache):
+                resource_path = result["path"]
+                bytes_hashed += result.get("bytes", 0)
+                stored_hash, stored_fingerprint = stored.pop(resource_path)
+                key = (None, resource_path)
+                results[key], resource_changes, fingerprint = func.evaluate_check_result(
+                    result, stored_hash, stored_fingerprint, manifests.pop(resource_path, None))
+                if fingerprint:
+                    fingerprint_updates.append((*fingerprint, resource_path))
+                if resource_changes and changes is not None:
+                    changes[key] = resource_changes
+                metrics.inc("ic_check_results_total", status=results[key], mode=mode)
+                result_rows.append((resource_path, results[key], _ts(datetime.now()), json.dumps(resource_changes) if resource_changes else None, None))
+                checked_paths.append(resource_path)
+                if len(checked_paths) >= func.UPDATE_BATCH_SIZE:
+                    flush_updates()
+            flush_updates()
+        except sqlite3.Error as e:
+            print(f"Ошибка при проверке хэшей в БД: {e}")
+        finally:
+            func.close_hash_cache(cache)
+
+        if progress is not None:
+            progress.emit(force=True)
+        stopped = bool(stop_flag and stop_flag.is_set())
+        if stopped:
+            print("Проверка целостности остановлена пользователем")
+        duration = (datetime.now() - started_at).total_seconds()
+        metrics.observe("ic_check_seconds", duration, mode=mode)
+        logger.info("Проверка целостности завершена", extra={"mode": mode, "seconds": round(duration, 3), "bytes": bytes_hashed,
+                                                             "stopped": stopped, "storage": "sqlite"})
+        if record:
+            self.save_check_run(started_at, mode, results, result_rows, bytes_hashed, stopped)
+        return results
+
+    # Сохранение результатов проверки (см. functions.save_check_run)
+    """
+    Колонки и значения - те же, что на сервере (functions.CHECK_RUN_COLUMNS и CHECK_RESULT_COLUMNS), хост - хост встроенной БД
+    """
+    def save_check_run(self, started_at: datetime, mode: str, results: dict, result_rows: list, bytes_hashed: int = 0, stopped: bool = False) -> int:
+        run_values = func.check_run_values(started_at, mode, results, bytes_hashed, stopped, None, self.host)
+        try:
+            with self._transaction() as cur:
+                cur.execute(f"""
+                    INSERT INTO check_runs ({", ".join(func.CHECK_RUN_COLUMNS)})
+                    VALUES ({", ".join("?" * len(func.CHECK_RUN_COLUMNS))})
+                """, [_sqlite_value(value) for value in run_values])
+                run_id = cur.lastrowid
+                cur.executemany(f"""
+                    INSERT INTO check_results ({", ".join(func.CHECK_RESULT_COLUMNS)})
+                    VALUES ({", ".join("?" * len(func.CHECK_RESULT_COLUMNS))})
+                """, func.check_result_values(run_id, result_rows, None, self.host))
+            return run_id
+        except sqlite3.Error as e:
+            print(f"Ошибка при сохранении результатов проверки: {e}")
+            return None
+
+    # Отправка данных на центральный сервер PostgreSQL
+    """
+    Ресурсы с эталонами и отпечатками переносятся одним INSERT ... ON CONFLICT DO UPDATE по ключу (хост, путь)
+    пачками по SYNC_BATCH_SIZE с хостом встроенной БД (host из storage_info): ресурсы проверяются на этом хосте
+    (манифесты папок, история эталонов и расписание остаются локальными)
+    Не отправленные проверки копируются в check_runs и check_results с новыми run_id, хостом и агентом и помечаются
+    как отправленные после фиксации на сервере, поэтому при ошибке они будут отправлены при следующей синхронизации
+    Проверкам и результатам, записанным до появления колонок host и resource_host, приписывается хост встроенной БД
+    Возвращает словарь с кол-вом отправленных ресурсов (resources) и проверок (runs)
+    """
+    def sync_to(self, db: Database) -> dict:
+        with self._lock:
+            runs = self._conn.execute(f"""
+                SELECT run_id, {", ".join(func.CHECK_RUN_COLUMNS)}
+                FROM check_runs WHERE synced = 0 ORDER BY run_id
+            """).fetchall()
+        resource_rows = ((path, name, rtype, _dt(added), hash_value, algorithm, _dt(hash_date), *fingerprint,
+                          json.loads(patterns) if patterns else None, self.host)
+                         for path, name, rtype, added, hash_value, algorithm, hash_date, *fingerprint, patterns in self._stream("""
+                             SELECT resource_path, resource_name, resource_type, added_date, hash, hash_algorithm, hash_date,
+                                    file_size, file_mtime_ns, file_ctime_ns, file_inode, file_device, ignore_patterns
+                             FROM resource_monitoring
+                         """))
+        synced = {"resources": 0, "runs": 0}
+        while True:
+            batch = list(itertools.islice(resource_rows, SYNC_BATCH_SIZE))
+            if not batch:
+                break
+            synced["resources"] += db.run(_push_resources, batch, retry=False)
+        for run in runs:
+            with self._lock:
+                result_rows = self._conn.execute("""
+                    SELECT resource_path, status, checked_at, details, resource_host, host, agent_id FROM check_results WHERE run_id = ?
+                """, (run[0],)).fetchall()
+            if db.run(_push_check_run, run, result_rows, self.host, retry=False) is None:
+                break
+            with self._transaction() as cur:
+                cur.execute("UPDATE check_runs SET synced = 1 WHERE run_id = ?", (run[0],))
+            synced["runs"] += 1
+        logger.info("Синхронизация с центральной БД завершена", extra=synced)
+        return synced
+
+    # Закрытие соединения
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+# Запись пачки ресурсов агента на сервер
+"""
+Эталон на сервере заменяется только более новым (по hash_date)
+Возвращает кол-во отправленных ресурсов
+"""
+def _push_resources(conn, rows: list) -> int:
+    try:
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(cur, f"""
+                INSERT INTO resource_monitoring (resource_path, resource_name, resource_type, added_date, hash, hash_algorithm,
+                                                 hash_date, file_size, file_mtime_ns, file_ctime_ns, file_inode, file_device,
+                                                 ignore_patterns, host)
+                VALUES %s
+                {func.RESOURCE_CONFLICT} DO UPDATE
+                SET hash = EXCLUDED.hash, hash_algorithm = EXCLUDED.hash_algorithm, hash_date = EXCLUDED.hash_date,
+                    file_size = EXCLUDED.file_size, file_mtime_ns = EXCLUDED.file_mtime_ns, file_ctime_ns = EXCLUDED.file_ctime_ns,
+                    file_inode = EXCLUDED.file_inode, file_device = EXCLUDED.file_device, ignore_patterns = EXCLUDED.ignore_patterns
+                WHERE resource_monitoring.hash_date IS NULL OR resource_monitoring.hash_date <= EXCLUDED.hash_date
+            """, rows, page_size=len(rows))
+        conn.commit()
+        return len(rows)
+    except psycopg2.Error as e:
+        print(f"Ошибка при отправке ресурсов на сервер: {e}")
+        conn.rollback()
+        return 0
+
+# Запись проверки агента на сервер
+"""
+Запросы - functions.check_run_queries, проверке и результатам без сохраненного хоста (и хоста ресурса)
+приписывается storage_host - хост, с которым ресурсы встроенной БД отправляются на сервер
+Возвращает идентификатор проверки на сервере или None
+"""
+def _push_check_run(conn, run: tuple, result_rows: list, storage_host: str) -> int:
+    _, started_at, finished_at, *counts, stopped, agent_id, host = run
+    host = host or storage_host
+    run_query, results_query = func.check_run_queries("%s")
+    try:
+        with conn.cursor() as cur:
+            cur.execute(run_query, (_dt(started_at), _dt(finished_at), *counts, bool(stopped), agent_id, host))
+            run_id = cur.fetchone()[0]
+            psycopg2.extras.execute_values(cur, results_query, [
+                (run_id, path, status, _dt(checked_at), details, resource_host or storage_host, result_host or host, result_agent or agent_id)
+                for path, status, checked_at, details, resource_host, result_host, result_agent in result_rows
+            ], page_size=SYNC_BATCH_SIZE)
+        conn.commit()
+        return run_id
+    except psycopg2.Error as e:
+        print(f"Ошибка при отправке проверки на сервер: {e}")
+        conn.rollback()
+        return None
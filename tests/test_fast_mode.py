@@ -0,0 +1,52 @@
+import os
+
+import functions as func
+
+
+# Задача быстрого режима для файла с сохраненным отпечатком
+def fast_task(path, fingerprint):
+    return {"path": path, "host": None, "algorithm": "sha256", "fingerprint": fingerprint}
+
+
+# При прежнем отпечатке файл не перечитывается и считается совпавшим с эталоном
+def test_unchanged_fingerprint_skips_read(tmp_path):
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"content")
+    stored_hash = func.calculate_hash(str(path))
+    stored_fingerprint = func.get_fingerprint(str(path))
+
+    result = func._hash_worker(fast_task(str(path), stored_fingerprint))
+
+    assert not result["rehashed"]
+    assert result["hash"] is None and result["bytes"] == 0
+    assert func.evaluate_check_result(result, stored_hash, stored_fingerprint) == ("passed", None, None)
+
+
+# touch меняет отпечаток: файл перечитывается, при совпавшем хэше возвращается новый отпечаток для записи
+def test_touched_file_refreshes_fingerprint(tmp_path):
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"content")
+    stored_hash = func.calculate_hash(str(path))
+    stored_fingerprint = func.get_fingerprint(str(path))
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    result = func._hash_worker(fast_task(str(path), stored_fingerprint))
+    status, changes, fingerprint = func.evaluate_check_result(result, stored_hash, stored_fingerprint)
+
+    assert result["rehashed"]
+    assert (status, changes) == ("passed", None)
+    assert fingerprint == func.get_fingerprint(str(path)) != stored_fingerprint
+
+
+# Изменение содержимого обнаруживается, отпечаток при нарушении не обновляется
+def test_modified_file_fails(tmp_path):
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"content")
+    stored_hash = func.calculate_hash(str(path))
+    stored_fingerprint = func.get_fingerprint(str(path))
+    path.write_bytes(b"changed content")
+
+    result = func._hash_worker(fast_task(str(path), stored_fingerprint))
+
+    assert func.evaluate_check_result(result, stored_hash, stored_fingerprint) == ("failed", None, None)
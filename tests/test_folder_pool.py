@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+import functions as func
+from throttle import Throttle
+
+
+# Дерево с несколькими уровнями вложенности и файлами больше HASH_CHUNK_SIZE
+def make_tree(root, monkeypatch):
+    monkeypatch.setattr(func, "HASH_CHUNK_SIZE", 4096)
+    for i in range(6):
+        sub = root / f"dir{i}" / f"sub{i % 3}"
+        sub.mkdir(parents=True)
+        for j in range(5):
+            (sub / f"file{j}.bin").write_bytes(os.urandom(64 + 5000 * j))
+        (root / f"dir{i}" / "top.txt").write_bytes(b"top %d" % i)
+    (root / "big.bin").write_bytes(os.urandom(50000))
+
+
+def manifest_and_digest(root, algorithm="sha256"):
+    manifest = func.build_folder_manifest(str(root), algorithm=algorithm)
+    return manifest, func.folder_digests(manifest, algorithm)
+
+
+# Упорядоченная сборка в пуле дает тот же манифест и хэши, что и последовательный обход
+@pytest.mark.parametrize("algorithm", ["sha256", "sha256+chunked1"])
+@pytest.mark.parametrize("idle", [False, True])
+def test_pool_matches_sequential(tmp_path, monkeypatch, idle, algorithm):
+    make_tree(tmp_path, monkeypatch)
+    monkeypatch.setattr(func, "FOLDER_WORKERS", 1)
+    sequential = manifest_and_digest(tmp_path, algorithm)
+
+    monkeypatch.setattr(func, "FOLDER_WORKERS", 4)
+    monkeypatch.setattr(func, "set_idle_priority", lambda: True)
+    monkeypatch.setattr(func, "_folder_pools", {})
+    func._worker_local.throttle = Throttle(idle_priority=idle)
+    try:
+        pooled = manifest_and_digest(tmp_path, algorithm)
+    finally:
+        func._worker_local.throttle = None
+        for pool, _ in func._folder_pools.values():
+            pool.shutdown()
+
+    assert pooled == sequential
+    assert list(func._folder_pools) == [idle]
@@ -0,0 +1,85 @@
+import pytest
+
+pytest.importorskip("psycopg2")
+import functions as func
+
+
+# Соединение, которое ведет себя как PostgreSQL с курсорами WITH HOLD:
+# курсор, объявленный в транзакции, которая затем откатывается, уничтожается
+class FakeConnection:
+    def __init__(self, rows, failing_batches):
+        self.rows = rows
+        self.failing_batches = set(failing_batches)
+        self.batches = 0
+        self.declared = [] # Курсоры, объявленные в текущей транзакции
+        self.pending = [] # Пути, записанные в текущей транзакции
+        self.saved = [] # Пути, записанные в зафиксированных транзакциях
+
+    def cursor(self, name=None, withhold=False):
+        return FakeCursor(self, name)
+
+    def commit(self):
+        self.declared.clear()
+        self.saved += self.pending
+        self.pending = []
+
+    def rollback(self):
+        for cur in self.declared:
+            cur.closed = True
+        self.declared.clear()
+        self.pending = []
+
+
+class FakeCursor:
+    def __init__(self, conn, name):
+        self.conn = conn
+        self.name = name
+        self.closed = False
+        self.itersize = None
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.closed = True
+
+    def execute(self, query, params=None):
+        if self.name:
+            self.conn.declared.append(self)
+        elif "COUNT(*)" in query:
+            self.result = (len(self.conn.rows), 0)
+
+    def fetchone(self):
+        return self.result
+
+    def __iter__(self):
+        for row in self.conn.rows:
+            if self.closed:
+                raise func.psycopg2.ProgrammingError(f'cursor "{self.name}" does not exist')
+            yield row
+
+
+# Запись пачки: строки попадают в транзакцию соединения, заданные пачки завершаются ошибкой
+def fake_execute_values(cur, query, rows, page_size=None):
+    cur.conn.batches += 1
+    if cur.conn.batches in cur.conn.failing_batches:
+        raise func.psycopg2.OperationalError("batch failed")
+    cur.conn.pending += [row[0] for row in rows]
+
+
+# Ошибка записи первой пачки теряет только эту пачку, чтение ресурсов продолжается
+def test_failed_first_batch_keeps_stream(tmp_path, monkeypatch):
+    paths = []
+    for i in range(40):
+        path = tmp_path / f"file{i:02d}.bin"
+        path.write_bytes(b"data %d" % i)
+        paths.append(str(path))
+    conn = FakeConnection([(path, "sha256", None, None, None) for path in paths], failing_batches=[1])
+    monkeypatch.setattr(func.psycopg2.extras, "execute_values", fake_execute_values)
+
+    updated = func.update_all_hashes(conn, workers=1, use_processes=False, batch_size=5)
+
+    assert updated == len(paths) - 5
+    assert len(conn.saved) == len(paths) - 5
+    assert set(conn.saved) < set(paths)
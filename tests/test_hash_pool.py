@@ -0,0 +1,40 @@
+import hashlib
+import os
+
+import pytest
+
+import functions as func
+
+
+# Файлы разного размера, включая пустой и больше буфера чтения
+def make_files(root, count=12):
+    paths = []
+    for i in range(count):
+        path = root / f"file{i:02d}.bin"
+        path.write_bytes(os.urandom(i * 3000))
+        paths.append(str(path))
+    return paths
+
+
+# Хэш файла совпадает с хэшем его содержимого при чтении через буфер, mmap и в формате по частям для малых файлов
+@pytest.mark.parametrize("mmap_threshold", [None, 0])
+def test_hash_file_matches_plain_hash(tmp_path, monkeypatch, mmap_threshold):
+    monkeypatch.setattr(func, "HASH_BUFFER_SIZE", 4096)
+    monkeypatch.setattr(func, "HASH_MMAP_THRESHOLD", mmap_threshold)
+    for path in make_files(tmp_path)[1:]:
+        with open(path, "rb") as f:
+            expected = hashlib.sha256(f.read()).hexdigest()
+        assert func.hash_file(path) == expected
+        assert func.hash_file(path, "sha256" + func.CHUNKED_SUFFIX) == expected
+
+
+# Пул потоков выдает для каждого ресурса тот же хэш, что и последовательный расчет
+def test_pool_matches_sequential(tmp_path):
+    paths = make_files(tmp_path)
+    tasks = [{"path": path, "host": None, "algorithm": "sha256"} for path in paths]
+    sequential = {result["path"]: result["hash"] for result in func.hash_resources(tasks, workers=1)}
+    pooled = {result["path"]: result["hash"] for result in func.hash_resources(tasks, workers=4)}
+
+    assert pooled == sequential
+    assert sorted(pooled) == sorted(paths)
+    assert all(pooled.values())
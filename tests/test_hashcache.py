@@ -0,0 +1,53 @@
+import os
+import time
+
+from hashcache import HashCache
+
+
+# Перезапись содержимого с тем же размером и восстановленными временами
+def rewrite_keep_times(path, data):
+    st = os.stat(path)
+    time.sleep(0.01)
+    with open(path, "wb") as f:
+        f.write(data)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+# Файл, перезаписанный с сохранением размера и mtime, не получает старый хэш из кэша
+def test_rewrite_with_restored_times_is_miss(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"a" * 100)
+    cache = HashCache()
+    cache.put(HashCache.key(os.stat(path), "sha256"), "old")
+
+    rewrite_keep_times(path, b"b" * 100)
+    st = os.stat(path)
+    assert cache.get(HashCache.key(st, "sha256")) is None
+    assert cache.get_or_compute(HashCache.key(st, "sha256"), lambda: "new") == "new"
+
+
+# То же для записей, сохраненных в файл кэша
+def test_rewrite_with_restored_times_is_miss_persisted(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"a" * 100)
+    db_path = str(tmp_path / "cache.sqlite")
+    cache = HashCache(path=db_path)
+    key = HashCache.key(os.stat(path), "sha256")
+    cache.put(key, "old")
+    cache.close()
+
+    cache = HashCache(path=db_path)
+    assert cache.get(key) == "old"
+    rewrite_keep_times(path, b"b" * 100)
+    assert cache.get(HashCache.key(os.stat(path), "sha256")) is None
+    cache.close()
+
+
+# Смена прав меняет ключ
+def test_mode_change_is_miss(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"a" * 100)
+    cache = HashCache()
+    cache.put(HashCache.key(os.stat(path), "sha256"), "old")
+    os.chmod(path, 0o600)
+    assert cache.get(HashCache.key(os.stat(path), "sha256")) is None
@@ -0,0 +1,97 @@
+import functions as func
+
+
+# Курсор, который записывает запросы и возвращает заданное число измененных строк
+class RecordingCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = conn.rowcount
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        self.conn.queries.append((" ".join(query.split()), params))
+
+    def fetchall(self):
+        return []
+
+
+# Соединение, запоминающее запросы и фиксацию транзакции
+class RecordingConnection:
+    def __init__(self, rowcount=1):
+        self.rowcount = rowcount
+        self.queries = []
+        self.committed = False
+
+    def cursor(self):
+        return RecordingCursor(self)
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        pass
+
+
+# Условие хоста включает ресурсы без хоста, отбор по путям добавляется только по запросу
+def test_scoped_resources_query():
+    assert func.host_scope("r.host") == "(r.host IS NULL OR r.host = %s)"
+
+    query, params = func.scoped_resources_query("SELECT 1 FROM resource_monitoring", host="agent-1")
+    assert query == "SELECT 1 FROM resource_monitoring WHERE (host IS NULL OR host = %s)"
+    assert params == ["agent-1"]
+
+    query, params = func.scoped_resources_query("SELECT 1 FROM resource_monitoring", ("/a", "/b"))
+    assert query.endswith(" AND resource_path = ANY(%s)")
+    assert params == [func.LOCAL_HOST, ["/a", "/b"]]
+
+
+# Подпись и ключ страницы различают одинаковые пути разных хостов
+def test_resource_label_and_page_key():
+    assert func.resource_label(None, "/etc/hosts") == "/etc/hosts"
+    assert func.resource_label("agent-1", "/etc/hosts") == "agent-1:/etc/hosts"
+
+    row = ("/etc/hosts", "hosts", "file", None, "h", None, None)
+    assert func.page_key(row) == (None, "/etc/hosts", "")
+    assert func.page_key(row[:6] + ("agent-1",)) == (None, "/etc/hosts", "agent-1")
+
+
+# Удаление ищет ресурс по ключу (хост, путь): без хоста - пустая строка
+def test_remove_uses_host_key():
+    conn = RecordingConnection()
+    assert func.remove_resource_from_db(conn, "/etc/hosts", "agent-1")
+    assert [params for _, params in conn.queries] == [("agent-1", "/etc/hosts")] * 2
+    assert all("COALESCE(host, '') = %s" in query for query, _ in conn.queries)
+    assert conn.committed
+
+    conn = RecordingConnection(rowcount=0)
+    assert not func.remove_resource_from_db(conn, "/etc/hosts")
+    assert conn.queries[0][1] == ("", "/etc/hosts")
+    assert not conn.committed
+
+
+# Расписание меняется только у ресурса с заданным хостом
+def test_schedule_uses_host_key():
+    conn = RecordingConnection()
+    assert func.set_resource_schedule(conn, "/etc/hosts", check_interval=60, host="agent-1")
+    query, params = conn.queries[0]
+    assert "WHERE COALESCE(host, '') = %(host)s AND resource_path = %(path)s" in query
+    assert (params["host"], params["path"], params["interval"]) == ("agent-1", "/etc/hosts", 60)
+    assert params["priority"] is None
+
+
+# Следующая страница продолжается после ключа (дата, путь, хост) последней строки
+def test_list_page_after_key():
+    conn = RecordingConnection()
+    func.list_resources_page(conn, limit=10, host="agent-1")
+    func.list_resources_page(conn, after=(None, "/etc/hosts", ""), limit=10, host="agent-1")
+    (first_query, first_params), (next_query, next_params) = conn.queries
+
+    assert first_params == ["agent-1", 10]
+    assert "> (COALESCE(%s::timestamp, '-infinity'::timestamp), %s, %s)" in next_query
+    assert next_params == ["agent-1", None, "/etc/hosts", "", 10]
+    assert first_query.endswith("LIMIT %s") and next_query.endswith("LIMIT %s")
@@ -0,0 +1,41 @@
+import functions as func
+
+
+# Хэши файлов и папок манифеста для diff_manifests
+def snapshot(root):
+    manifest = func.build_folder_manifest(str(root))
+    return {rel_path: file_hash for rel_path, _, _, file_hash in manifest}, func.folder_digests(manifest)
+
+
+# Добавленные, удаленные и измененные файлы во вложенных папках
+def test_diff_reports_changes(tmp_path):
+    (tmp_path / "a" / "b").mkdir(parents=True)
+    (tmp_path / "c").mkdir()
+    (tmp_path / "a" / "b" / "kept.txt").write_text("kept")
+    (tmp_path / "a" / "b" / "edited.txt").write_text("old")
+    (tmp_path / "a" / "gone.txt").write_text("gone")
+    (tmp_path / "c" / "same.txt").write_text("same")
+    old = snapshot(tmp_path)
+
+    (tmp_path / "a" / "b" / "edited.txt").write_text("new")
+    (tmp_path / "a" / "gone.txt").unlink()
+    (tmp_path / "a" / "b" / "new.txt").write_text("new")
+    new = snapshot(tmp_path)
+
+    assert func.diff_manifests(*old, *new) == {
+        "added": ["a/b/new.txt"],
+        "removed": ["a/gone.txt"],
+        "modified": ["a/b/edited.txt"],
+    }
+    assert func.diff_manifests(*old, *old) == {"added": [], "removed": [], "modified": []}
+
+
+# Поддерево с прежним хэшем не обходится
+def test_diff_skips_unchanged_subtree():
+    old_files = {"x/file.txt": "1", "y/file.txt": "2"}
+    # Хэш папки x не изменился, поэтому расхождение в ее файлах не проверяется
+    new_files = {"x/file.txt": "ignored", "y/file.txt": "3"}
+    old_dirs = {".": "root1", "x": "same", "y": "y1"}
+    new_dirs = {".": "root2", "x": "same", "y": "y2"}
+
+    assert func.diff_manifests(old_files, old_dirs, new_files, new_dirs)["modified"] == ["y/file.txt"]
@@ -0,0 +1,108 @@
+import sqlite3
+
+import functions as func
+import storage
+from storage import SQLiteStorage
+
+
+# Курсор, который записывает выполненные запросы и отдает заданные примененные версии
+class RecordingCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        self.conn.queries.append((query, params))
+
+    def fetchall(self):
+        return [(version,) for version in self.conn.applied]
+
+
+# Соединение PostgreSQL с уже примененными версиями схемы
+class RecordingConnection:
+    def __init__(self, applied):
+        self.applied = applied
+        self.queries = []
+        self.committed = False
+        self.rolled_back = False
+
+    def cursor(self):
+        return RecordingCursor(self)
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        self.rolled_back = True
+
+
+# Версии миграций идут подряд с 1, а ожидаемая версия схемы - последняя из них
+def test_versions_are_consecutive():
+    for migrations, schema_version in ((func.MIGRATIONS, func.SCHEMA_VERSION),
+                                       (storage.SQLITE_MIGRATIONS, storage.SQLITE_SCHEMA_VERSION)):
+        versions = [version for version, _, _ in migrations]
+        assert versions == list(range(1, len(versions) + 1))
+        assert schema_version == versions[-1]
+
+
+# Применяются только недостающие версии, каждая записывается в schema_migrations
+def test_init_db_applies_missing_versions():
+    conn = RecordingConnection(applied=range(1, func.SCHEMA_VERSION))
+    assert func.init_db(conn)
+    recorded = [params for query, params in conn.queries if query.startswith("INSERT INTO schema_migrations")]
+    assert recorded == [(func.SCHEMA_VERSION, func.MIGRATIONS[-1][1])]
+    assert conn.committed
+
+
+# Схема новее поддерживаемой не изменяется
+def test_init_db_refuses_newer_schema():
+    conn = RecordingConnection(applied=[func.SCHEMA_VERSION + 1])
+    assert not func.init_db(conn)
+    assert conn.rolled_back and not conn.committed
+    assert not any(query.startswith("INSERT INTO schema_migrations") for query, _ in conn.queries)
+
+
+# Версия встроенной БД
+def user_version(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+
+
+# База без версии (созданная до появления миграций) и база старой версии обновляются до текущей
+def test_sqlite_upgrades_old_files(tmp_path):
+    base_script = storage.SQLITE_MIGRATIONS[0][2]
+    for name, version in (("unversioned.db", 0), ("v1.db", 1)):
+        path = str(tmp_path / name)
+        conn = sqlite3.connect(path)
+        conn.executescript(f"{base_script}; PRAGMA user_version = {version};")
+        conn.close()
+
+        store = SQLiteStorage(path)
+        try:
+            assert store.init()
+        finally:
+            store.close()
+        assert user_version(path) == storage.SQLITE_SCHEMA_VERSION
+
+
+# Встроенная БД новее поддерживаемой не открывается
+def test_sqlite_refuses_newer_schema(tmp_path):
+    path = str(tmp_path / "future.db")
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA user_version = 99")
+    conn.close()
+
+    store = SQLiteStorage(path)
+    try:
+        assert not store.init()
+    finally:
+        store.close()
+    assert user_version(path) == 99
@@ -0,0 +1,53 @@
+import functions as func
+import scheduler
+
+
+# Смещения для одного seed повторяются, первый и последний блоки входят всегда
+def test_offsets_are_deterministic():
+    offsets = func.sample_offsets(1000 * 16, seed=42, blocks=4, block_size=16)
+    assert offsets == func.sample_offsets(1000 * 16, seed=42, blocks=4, block_size=16)
+    assert len(offsets) == 4 + 2
+    assert offsets[0] == 0 and offsets[-1] == 999 * 16
+    assert offsets == sorted(set(offsets))
+    assert offsets != func.sample_offsets(1000 * 16, seed=43, blocks=4, block_size=16)
+
+
+# В небольшом файле берутся все блоки
+def test_offsets_small_file():
+    assert func.sample_offsets(5 * 16 + 1, seed=1, blocks=4, block_size=16) == [0, 16, 32, 48, 64, 80]
+    assert func.sample_offsets(0, seed=1, blocks=4, block_size=16) == [0]
+
+
+# Полный проход в режиме paranoid выполняется раз в full_interval и только в выборочном режиме
+def test_full_check_cadence(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(scheduler.time, "monotonic", lambda: now[0])
+    cadence = scheduler.FullCheckCadence(func.CHECK_MODE_SAMPLED, full_interval=60)
+    fast_cadence = scheduler.FullCheckCadence(func.CHECK_MODE_FAST, full_interval=60)
+
+    assert cadence.cycle_mode() == func.CHECK_MODE_SAMPLED
+    now[0] += 60
+    assert cadence.cycle_mode() == func.CHECK_MODE_PARANOID
+    assert cadence.cycle_mode() == func.CHECK_MODE_SAMPLED
+    assert fast_cadence.cycle_mode() == func.CHECK_MODE_FAST
+
+
+# Выборочный дайджест считается при прежнем отпечатке, при изменении отпечатка файл хэшируется полностью
+def test_worker_sampled(tmp_path, monkeypatch):
+    monkeypatch.setattr(func, "SAMPLE_BLOCKS", 2)
+    monkeypatch.setattr(func, "SAMPLE_BLOCK_SIZE", 16)
+    path = tmp_path / "big.bin"
+    path.write_bytes(bytes(range(256)) * 4)
+    task = {"path": str(path), "fingerprint": func.get_fingerprint(str(path)), "sampled": (7, func.sample_kind())}
+
+    result = func._hash_worker(task)
+    assert result["sampled"] and not result["rehashed"]
+    assert result["hash"].startswith(func.SAMPLED_PREFIX)
+    assert result["fingerprint"] == task["fingerprint"]
+    assert result["bytes"] == 4 * 16
+    assert func._hash_worker(task)["hash"] == result["hash"]
+
+    path.write_bytes(b"changed")
+    result = func._hash_worker(task)
+    assert result["rehashed"] and not result.get("sampled")
+    assert result["hash"] == func.calculate_hash(str(path))
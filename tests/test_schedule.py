@@ -0,0 +1,31 @@
+import threading
+import time
+
+import scheduler
+
+
+# Очередь (путь, приоритет, сохраненный размер)
+DUE = [("/a", 5, 100), ("/b", 3, 300), ("/c", 1, None), ("/d", 0, 50)]
+
+
+# Ресурсы берутся по порядку, пока сохраненный размер не превысит бюджет
+def test_budget_stops_at_limit():
+    assert scheduler.select_within_budget(DUE, 400) == ["/a", "/b", "/c"]
+    assert scheduler.select_within_budget(DUE, 450) == ["/a", "/b", "/c", "/d"]
+    assert scheduler.select_within_budget(DUE) == ["/a", "/b", "/c", "/d"]
+
+
+# Первый ресурс берется даже сверх бюджета, чтобы большой ресурс не откладывался бесконечно
+def test_budget_takes_first_resource():
+    assert scheduler.select_within_budget(DUE, 10) == ["/a"]
+    assert scheduler.select_within_budget([], 10) == []
+
+
+# Флаг цикла срабатывает по сроку или по внешнему флагу остановки
+def test_cycle_stop_deadline_and_event():
+    stop_event = threading.Event()
+    assert scheduler._CycleStop(stop_event, time.monotonic() - 1).is_set()
+    cycle_stop = scheduler._CycleStop(stop_event, time.monotonic() + 60)
+    assert not cycle_stop.is_set()
+    stop_event.set()
+    assert cycle_stop.is_set()
@@ -0,0 +1,75 @@
+import pytest
+
+import functions as func
+from storage import SQLiteStorage
+
+
+# Встроенная БД с несколькими файлами-ресурсами
+def open_store(tmp_path, count=3):
+    store = SQLiteStorage(str(tmp_path / "ic.db"))
+    assert store.init()
+    paths = []
+    for i in range(count):
+        path = tmp_path / f"file{i:02d}.txt"
+        path.write_text(f"data {i}")
+        paths.append(str(path))
+    assert store.add_resources(paths)["added"] == paths
+    return store, paths
+
+
+# Эталон, проверка без изменений, обнаружение изменения и последние статусы по ключу (хост, путь)
+def test_baseline_and_check(tmp_path):
+    store, paths = open_store(tmp_path)
+    try:
+        assert store.update_hashes(workers=1) == len(paths)
+        assert store.check(workers=1) == {(None, path): "passed" for path in paths}
+
+        with open(paths[0], "w") as f:
+            f.write("changed")
+        results = store.check(workers=1)
+        assert results[(None, paths[0])] == "failed"
+        assert store.last_statuses()[(None, paths[0])] == "failed"
+        assert store.last_statuses()[(None, paths[1])] == "passed"
+    finally:
+        store.close()
+
+
+# Ошибка записи одной пачки эталонов теряет только эту пачку
+def test_failed_batch_keeps_others(tmp_path):
+    store, paths = open_store(tmp_path, count=12)
+    try:
+        # Триггер отклоняет обновление первого ресурса, а с ним и всю первую пачку
+        store._conn.execute(f"""
+            CREATE TRIGGER fail_first BEFORE UPDATE OF hash ON resource_monitoring
+            WHEN NEW.resource_path = '{paths[0]}' BEGIN SELECT RAISE(ABORT, 'batch failed'); END
+        """)
+        assert store.update_hashes(workers=1, batch_size=4) == len(paths) - 4
+        hashes = dict(store._conn.execute("SELECT resource_path, hash FROM resource_monitoring").fetchall())
+        assert [path for path in paths if hashes[path] is None] == paths[:4]
+    finally:
+        store.close()
+
+
+# Хост встроенной БД записывается при первом init и не меняется при следующих
+def test_host_is_recorded(tmp_path):
+    store, _ = open_store(tmp_path, count=0)
+    try:
+        assert store.host == func.LOCAL_HOST
+        store._conn.execute("UPDATE storage_info SET value = 'agent-1' WHERE key = 'host'")
+        store._conn.commit()
+        assert store.init()
+        assert store.host == "agent-1"
+    finally:
+        store.close()
+
+
+# Выборочный режим и проверка части ресурсов во встроенной БД недоступны
+def test_unsupported_check_options(tmp_path):
+    store, paths = open_store(tmp_path, count=1)
+    try:
+        with pytest.raises(ValueError):
+            store.check(mode=func.CHECK_MODE_SAMPLED)
+        with pytest.raises(ValueError):
+            store.check(resource_paths=paths)
+    finally:
+        store.close()
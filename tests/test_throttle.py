@@ -0,0 +1,56 @@
+import throttle
+
+
+# Часы и паузы ведра токенов под управлением теста: пауза сразу сдвигает часы
+class FakeTime:
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds, stop_flag=None):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+# Подмена часов и пауз модуля throttle
+def fake_time(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(throttle.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(throttle, "_sleep", clock.sleep)
+    return clock
+
+
+# Запрос в пределах запаса не ждет, сверх запаса - ждет, пока долг не погасится по скорости rate
+def test_bucket_waits_for_deficit(monkeypatch):
+    clock = fake_time(monkeypatch)
+    bucket = throttle.TokenBucket(rate=100, burst=100)
+
+    assert bucket.consume(60) == 0
+    assert bucket.consume(60) == 0.2
+    assert clock.sleeps == [0.2]
+
+
+# Запрос больше запаса не блокируется навсегда, а средняя скорость держится на rate
+def test_bucket_average_rate(monkeypatch):
+    clock = fake_time(monkeypatch)
+    bucket = throttle.TokenBucket(rate=1000)
+    started = clock.now
+    for _ in range(10):
+        bucket.consume(2500)
+
+    # Запас в начале - одна секунда, остальное читается со скоростью rate
+    assert clock.now - started == 24.0
+
+
+# Запас восстанавливается во время простоя, но не больше burst
+def test_bucket_refills_up_to_burst(monkeypatch):
+    clock = fake_time(monkeypatch)
+    bucket = throttle.TokenBucket(rate=10, burst=20)
+    bucket.consume(20)
+    clock.now += 60
+
+    assert bucket.consume(20) == 0
+    assert bucket.consume(5) == 0.5
@@ -0,0 +1,55 @@
+import pytest
+
+import watcher
+
+if not watcher.inotify_available():
+    pytest.skip("inotify недоступен", allow_module_level=True)
+
+
+# Часы наблюдателя, которые двигает тест
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+# Запись в файл-ресурс через inotify ставит его в очередь ожидания
+def watch_write(tmp_path, monkeypatch, debounce=2.0, max_delay=30.0):
+    path = tmp_path / "file.txt"
+    path.write_text("a")
+    resource_watcher = watcher.ResourceWatcher([str(path)], debounce=debounce, max_delay=max_delay)
+    path.write_text("b")
+    assert resource_watcher.poll(timeout=2.0) > 0
+    first_seen, last_seen = resource_watcher.pending[str(path)]
+    clock = Clock(last_seen)
+    monkeypatch.setattr(watcher.time, "monotonic", clock)
+    return resource_watcher, str(path), first_seen, clock
+
+
+# Ресурс выдается только после debounce секунд без событий, и только один раз
+def test_debounce_delays_until_quiet(tmp_path, monkeypatch):
+    resource_watcher, path, _, clock = watch_write(tmp_path, monkeypatch)
+    try:
+        clock.now += 1.0
+        assert resource_watcher.pop_ready() == []
+        clock.now += 1.0
+        assert resource_watcher.pop_ready() == [path]
+        assert resource_watcher.pop_ready() == []
+    finally:
+        resource_watcher.close()
+
+
+# Непрерывные события не откладывают проверку дольше max_delay
+def test_max_delay_limits_debounce(tmp_path, monkeypatch):
+    resource_watcher, path, first_seen, clock = watch_write(tmp_path, monkeypatch, max_delay=5.0)
+    try:
+        clock.now = first_seen + 4.0
+        resource_watcher.pending[path] = (first_seen, clock.now)
+        assert resource_watcher.pop_ready() == []
+        clock.now = first_seen + 5.0
+        resource_watcher.pending[path] = (first_seen, clock.now)
+        assert resource_watcher.pop_ready() == [path]
+    finally:
+        resource_watcher.close()
@@ -0,0 +1,210 @@
+import ctypes
+import ctypes.util
+import os
+import platform
+import threading
+import time
+import metrics
+
+# Настройки щадящего режима проверки
+LOW_IMPACT_BYTES_PER_SEC = 20 * 1024 * 1024 # Объем чтения, байт/сек
+LOW_IMPACT_FILES_PER_SEC = 200 # Кол-во открываемых файлов в секунду
+LOW_IMPACT_MAX_LOAD = 1.0 # Средняя загрузка за минуту на одно ядро, выше которой чтение приостанавливается
+LOW_IMPACT_MAX_IOWAIT = 0.2 # Доля времени ожидания ввода-вывода, выше которой чтение приостанавливается
+
+PRESSURE_CHECK_INTERVAL = 1.0 # Период оценки нагрузки системы, сек
+BACKOFF_MIN = 0.5 # Первая пауза при высокой нагрузке, сек
+BACKOFF_MAX = 8.0 # Предельная пауза, сек
+
+IDLE_NICE = 19 # Приоритет планировщика для фонового чтения
+
+# Приоритет ввода-вывода (linux/ioprio.h)
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+# Номер системного вызова ioprio_set по архитектурам
+_IOPRIO_SET_SYSCALLS = {
+    "x86_64": 251, "amd64": 251, "i386": 289, "i686": 289,
+    "aarch64": 30, "arm64": 30, "armv7l": 314, "ppc64le": 273, "ppc64": 273, "s390x": 282,
+}
+
+# Ведро токенов
+"""
+Пополняется со скоростью rate единиц в секунду, но не больше burst (по умолчанию - запас на одну секунду)
+consume резервирует нужное кол-во сразу, уходя в долг, и спит, пока долг не погасится, поэтому
+запрос больше burst (например, блок чтения) не блокируется навсегда, а средняя скорость держится на rate
+"""
+class TokenBucket:
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Получение amount токенов
+    """
+    Возвращает время ожидания в секундах
+    """
+    def consume(self, amount: float, stop_flag: threading.Event = None) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            _sleep(delay, stop_flag)
+        return delay
+
+# Пауза с прерыванием по флагу остановки
+def _sleep(seconds: float, stop_flag: threading.Event = None) -> None:
+    if stop_flag is not None:
+        # Флаг может считаться установленным без set() (например, по сроку), поэтому ждем короткими отрезками
+        deadline = time.monotonic() + seconds
+        while not stop_flag.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            stop_flag.wait(min(remaining, 0.5))
+    else:
+        time.sleep(seconds)
+
+# Доля времени ожидания ввода-вывода
+"""
+Читает счетчики строки cpu из /proc/stat
+Возвращает (iowait, всего) в тиках или None, если /proc/stat недоступен
+"""
+def _read_cpu_times() -> tuple:
+    try:
+        with open("/proc/stat", encoding="ascii") as f:
+            fields = f.readline().split()
+    except OSError:
+        return None
+    if not fields or fields[0] != "cpu":
+        return None
+    values = [int(value) for value in fields[1:]]
+    return (values[4] if len(values) > 4 else 0), sum(values)
+
+# Нагрузка системы
+"""
+Средняя загрузка за минуту на одно ядро (os.getloadavg) и доля iowait с прошлого замера (previous)
+Возвращает (загрузка, iowait, текущие счетчики); недоступные значения - None
+"""
+def system_pressure(previous: tuple = None) -> tuple:
+    try:
+        load = os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (OSError, AttributeError):
+        load = None
+    current = _read_cpu_times()
+    iowait = None
+    if current is not None and previous is not None and current[1] > previous[1]:
+        iowait = (current[0] - previous[0]) / (current[1] - previous[1])
+    return load, iowait, current
+
+# Низкий приоритет ввода-вывода и планировщика для текущего потока
+"""
+В Linux ioprio и nice действуют на поток, поэтому вызывается в каждом рабочем потоке
+Класс ввода-вывода idle: диск читается, только когда он не нужен другим процессам (планировщики BFQ/CFQ)
+Ошибки (нет прав, другая ОС) не прерывают проверку
+Возвращает True, если удалось установить приоритет ввода-вывода
+"""
+def set_idle_priority() -> bool:
+    try:
+        current = os.nice(0)
+        if current < IDLE_NICE:
+            os.nice(IDLE_NICE - current)
+    except (OSError, AttributeError):
+        pass
+    syscall_number = _IOPRIO_SET_SYSCALLS.get(platform.machine().lower())
+    if syscall_number is None:
+        return False
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        return libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) == 0
+    except (OSError, AttributeError):
+        return False
+
+# Ограничение нагрузки при чтении
+"""
+bytes_per_sec и files_per_sec - ведра токенов на объем чтения и кол-во открываемых файлов (общие для всех потоков)
+max_load и max_iowait - при более высокой нагрузке системы чтение приостанавливается с паузой от BACKOFF_MIN,
+удваиваемой до BACKOFF_MAX, пока нагрузка не спадет
+idle_priority - рабочие потоки читают с приоритетом ввода-вывода idle и nice IDLE_NICE
+Вызывается из hash_file через file_started и bytes_read, stop_flag операции передается в каждый вызов
+(один Throttle может использоваться несколькими операциями, поэтому флаг остановки в нем не хранится)
+"""
+class Throttle:
+    def __init__(self, bytes_per_sec: float = None, files_per_sec: float = None, max_load: float = None,
+                 max_iowait: float = None, idle_priority: bool = False):
+        self.bytes_per_sec = bytes_per_sec
+        self.files_per_sec = files_per_sec
+        self.max_load = max_load
+        self.max_iowait = max_iowait
+        self.idle_priority = idle_priority
+        self._bytes = TokenBucket(bytes_per_sec) if bytes_per_sec else None
+        self._files = TokenBucket(files_per_sec) if files_per_sec else None
+        self._lock = threading.Lock()
+        self._next_pressure_check = 0
+        self._cpu_times = _read_cpu_times()
+        self._backoff = 0
+        self.throttled_seconds = 0.0 # Суммарное время пауз
+
+    # Параметры для создания такого же ограничения в другом процессе
+    """
+    Ограничения скорости делятся на parts, чтобы parts процессов вместе не превышали заданные значения
+    """
+    def settings(self, parts: int = 1) -> dict:
+        return {
+            "bytes_per_sec": self.bytes_per_sec / parts if self.bytes_per_sec else None,
+            "files_per_sec": self.files_per_sec / parts if self.files_per_sec else None,
+            "max_load": self.max_load,
+            "max_iowait": self.max_iowait,
+            "idle_priority": self.idle_priority,
+        }
+
+    # Начало чтения файла
+    """
+    stop_flag - флаг остановки операции, прерывает паузы
+    """
+    def file_started(self, stop_flag: threading.Event = None) -> None:
+        self._wait_for_pressure(stop_flag)
+        if self._files is not None:
+            self._add_delay(self._files.consume(1, stop_flag), "files")
+
+    # Прочитан блок
+    def bytes_read(self, byte_count: int, stop_flag: threading.Event = None) -> None:
+        if self._bytes is not None and byte_count:
+            self._add_delay(self._bytes.consume(byte_count, stop_flag), "bytes")
+
+    # Учет времени пауз
+    def _add_delay(self, delay: float, reason: str) -> None:
+        if delay:
+            with self._lock:
+                self.throttled_seconds += delay
+            metrics.inc("ic_throttle_seconds_total", delay, reason=reason)
+
+    # Пауза при высокой нагрузке системы
+    def _wait_for_pressure(self, stop_flag: threading.Event = None) -> None:
+        if self.max_load is None and self.max_iowait is None:
+            return
+        while not (stop_flag is not None and stop_flag.is_set()):
+            with self._lock:
+                now = time.monotonic()
+                if now < self._next_pressure_check:
+                    delay = self._backoff
+                else:
+                    load, iowait, self._cpu_times = system_pressure(self._cpu_times)
+                    overloaded = ((self.max_load is not None and load is not None and load > self.max_load) or
+                                  (self.max_iowait is not None and iowait is not None and iowait > self.max_iowait))
+                    self._backoff = min(BACKOFF_MAX, max(BACKOFF_MIN, self._backoff * 2)) if overloaded else 0
+                    self._next_pressure_check = now + max(PRESSURE_CHECK_INTERVAL, self._backoff)
+                    delay = self._backoff
+            if not delay:
+                return
+            _sleep(delay, stop_flag)
+            self._add_delay(delay, "pressure")
+
+# Щадящий режим с настройками по умолчанию
+def low_impact() -> Throttle:
+    return Throttle(LOW_IMPACT_BYTES_PER_SEC, LOW_IMPACT_FILES_PER_SEC, LOW_IMPACT_MAX_LOAD, LOW_IMPACT_MAX_IOWAIT, idle_priority=True)
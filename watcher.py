@@ -0,0 +1,228 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+# Флаги inotify (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0o2000000)
+
+# События, после которых содержимое ресурса могло измениться
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+_EVENT_HEADER = struct.Struct("iIII") # wd, mask, cookie, len
+_READ_SIZE = 64 * 1024
+
+_libc = None
+
+# Загрузка функций inotify из libc
+"""
+Возвращает libc с inotify_init1, inotify_add_watch, inotify_rm_watch или None, если система их не поддерживает
+"""
+def _load_libc():
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+            _libc = libc
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc or None
+
+# Проверка поддержки inotify
+def inotify_available() -> bool:
+    return _load_libc() is not None
+
+# Наблюдение за ресурсами через inotify
+"""
+Для папки-ресурса наблюдение ставится на нее и все вложенные папки, новые подпапки добавляются по событию IN_CREATE
+Для файла-ресурса наблюдение ставится на родительскую папку, события других файлов в ней отбрасываются,
+так что замена файла через rename тоже замечается
+Каждое событие сопоставляется с ресурсом, в котором лежит затронутый путь, и ресурс попадает в очередь
+Ресурс выдается из очереди, когда по нему debounce секунд не было событий (серия записей дает одну проверку),
+но не позже чем через max_delay секунд после первого события
+Если очередь событий ядра переполнилась или не хватило лимита наблюдений, устанавливается overflowed -
+вызывающий код должен выполнить полную проверку
+"""
+class ResourceWatcher:
+    # Создание дескриптора inotify
+    def __init__(self, resource_paths=(), debounce: float = 2.0, max_delay: float = 30.0):
+        libc = _load_libc()
+        if libc is None:
+            raise OSError(errno.ENOSYS, "inotify недоступен в этой системе")
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.resources = set()
+        self._folders = set() # Ресурсы-папки (наблюдение за всем деревом)
+        self._original_paths = {} # Нормализованный путь -> путь ресурса в том виде, как он записан в БД
+        self.pending = {} # Ресурс -> (время первого события, время последнего события)
+        self.overflowed = False
+        self._watch_dirs = {} # wd -> путь папки
+        self._dir_watches = {} # путь папки -> wd
+        self.sync(resource_paths)
+
+    # Синхронизация набора ресурсов
+    """
+    Добавляет наблюдение для новых ресурсов, для удаленных снимает наблюдения (inotify_rm_watch) с папок,
+    которые больше не нужны ни одному ресурсу, и перестает сопоставлять с ними события
+    """
+    def sync(self, resource_paths) -> None:
+        originals = {os.path.normpath(path): path for path in resource_paths}
+        resource_paths = set(originals)
+        removed = self.resources - resource_paths
+        self.resources &= resource_paths
+        self._folders &= resource_paths
+        self._original_paths = originals
+        for resource_path in resource_paths - self.resources:
+            self.resources.add(resource_path)
+            if os.path.isdir(resource_path):
+                self._folders.add(resource_path)
+                self._watch_tree(resource_path)
+            else:
+                self._watch_dir(os.path.dirname(resource_path) or ".")
+        if removed:
+            self._remove_unused_watches()
+        for resource_path in list(self.pending):
+            if resource_path not in self.resources:
+                del self.pending[resource_path]
+
+    # Снятие наблюдений, не нужных ни одному ресурсу
+    """
+    Папка нужна, если она родительская для ресурса-файла или лежит внутри ресурса-папки (или совпадает с ним)
+    """
+    def _remove_unused_watches(self) -> None:
+        file_parents = {os.path.dirname(path) or "." for path in self.resources - self._folders}
+        for dir_path, wd in list(self._dir_watches.items()):
+            if dir_path in file_parents or self._resource_for(dir_path) in self._folders:
+                continue
+            self._libc.inotify_rm_watch(self.fd, wd)
+            del self._dir_watches[dir_path]
+            self._watch_dirs.pop(wd, None)
+
+    # Наблюдение за папкой
+    def _watch_dir(self, dir_path: str) -> None:
+        if dir_path in self._dir_watches:
+            return
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK | IN_ONLYDIR)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                print(f"Исчерпан лимит наблюдений inotify (fs.inotify.max_user_watches), {dir_path} будет проверяться только полной проверкой")
+                self.overflowed = True
+            elif err not in (errno.ENOENT, errno.ENOTDIR):
+                print(f"Не удалось наблюдать за {dir_path}: {os.strerror(err)}")
+            return
+        self._watch_dirs[wd] = dir_path
+        self._dir_watches[dir_path] = wd
+
+    # Наблюдение за папкой и всеми вложенными папками
+    def _watch_tree(self, dir_path: str) -> None:
+        self._watch_dir(dir_path)
+        for root, dirs, _ in os.walk(dir_path):
+            for name in dirs:
+                self._watch_dir(os.path.join(root, name))
+
+    # Ресурс, которому принадлежит путь
+    def _resource_for(self, path: str) -> str:
+        while True:
+            if path in self.resources:
+                return path
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+    # Чтение событий
+    """
+    Ждет события не дольше timeout секунд и разбирает все прочитанные события
+    Возвращает кол-во событий, сопоставленных с ресурсами
+    """
+    def poll(self, timeout: float = 1.0) -> int:
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return 0
+        matched = 0
+        now = time.monotonic()
+        while True:
+            try:
+                data = os.read(self.fd, _READ_SIZE)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(data):
+                wd, mask, _, name_len = _EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + _EVENT_HEADER.size:offset + _EVENT_HEADER.size + name_len].rstrip(b"\0")
+                offset += _EVENT_HEADER.size + name_len
+                matched += self._handle_event(wd, mask, os.fsdecode(name), now)
+            if len(data) < _READ_SIZE:
+                break
+        return matched
+
+    # Разбор одного события
+    def _handle_event(self, wd: int, mask: int, name: str, now: float) -> int:
+        if mask & IN_Q_OVERFLOW:
+            self.overflowed = True
+            return 0
+        dir_path = self._watch_dirs.get(wd)
+        if dir_path is None:
+            return 0
+        if mask & IN_IGNORED:
+            del self._watch_dirs[wd]
+            self._dir_watches.pop(dir_path, None)
+            return 0
+        path = os.path.join(dir_path, name) if name else dir_path
+        resource_path = self._resource_for(path)
+        if resource_path is None:
+            return 0
+        # Новая подпапка внутри папки-ресурса
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and os.path.isdir(path):
+            self._watch_tree(path)
+        first_seen = self.pending.get(resource_path, (now, now))[0]
+        self.pending[resource_path] = (first_seen, now)
+        return 1
+
+    # Ресурсы, готовые к проверке
+    """
+    Возвращает и удаляет из очереди ресурсы, по которым debounce секунд не было событий
+    или с первого события прошло max_delay секунд
+    """
+    def pop_ready(self) -> list:
+        now = time.monotonic()
+        ready = [
+            resource_path for resource_path, (first_seen, last_seen) in self.pending.items()
+            if now - last_seen >= self.debounce or now - first_seen >= self.max_delay
+        ]
+        for resource_path in ready:
+            del self.pending[resource_path]
+        return [self._original_paths.get(resource_path, resource_path) for resource_path in ready]
+
+    # Закрытие дескриптора inotify
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1